@@ -0,0 +1,80 @@
+# Speed of the feature engineering of the clean_*.ipynb notebooks (row by row .loc writes,
+# .apply(get_age), country code list comprehension) against cleaning.add_features, on
+# all_retailers.csv repeated --scale times. Run from the 'Final deliverables' folder:
+#   python code/bench_cleaning.py --scale 100
+# The notebook version takes minutes at that scale, so by default it only runs on the first
+# --legacy-rows rows and its time is extrapolated (it is linear in the number of rows).
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from cleaning import add_features
+from normalisation import COUNTRY_CODES
+
+
+def get_age(year):
+    try:
+        return 2022 - int(year)
+    except:
+        return None
+
+
+def notebook_features(data):
+    data = data.reset_index(drop=True)
+    data.loc[:, 'age'] = data['year'].apply(get_age)
+
+    for i, num in enumerate(data['num_review']):
+        if num > 5:
+            data.loc[i, 'score'] = data.loc[i, 'rating']
+        else:
+            data.loc[i, 'score'] = 0
+
+    for i, size in enumerate(data['size']):
+        data.loc[i, 'scaledprice'] = data.loc[i, 'price'] * 75 / size
+    data.loc[:, 'logprice'] = np.log10(data.loc[:, 'scaledprice'])
+
+    data['countrycode'] = [COUNTRY_CODES.get(c, 'unknown') for c in data['country']]
+    data['price_fixed'] = pd.to_numeric(data['price'], errors='coerce')
+    return data
+
+
+def load(scale):
+    data = pd.read_csv('./data/all_retailers.csv', index_col=0)
+    # Back to the columns the cleaning steps start from
+    data = data[['name', 'abv', 'year', 'size(cL)', 'country', 'wine_type', 'price', 'num_review', 'rating', 'url']]
+    data = data.rename(columns={'size(cL)': 'size'})
+    data['rating'] = pd.to_numeric(data['rating'], errors='coerce')
+    return pd.concat([data] * scale, ignore_index=True)
+
+
+def timed(function, data):
+    start = time.perf_counter()
+    function(data.copy())
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, default=100)
+    parser.add_argument('--legacy-rows', type=int, default=20000,
+                        help='rows given to the notebook version, 0 for all of them')
+    args = parser.parse_args()
+
+    data = load(args.scale)
+    rows = len(data)
+    print(f'{rows} rows')
+
+    vectorised = timed(add_features, data)
+    print(f'  vectorised  {vectorised:8.2f}s  {rows / vectorised:12.0f} rows/s')
+
+    legacy_rows = min(args.legacy_rows or rows, rows)
+    legacy = timed(notebook_features, data.head(legacy_rows)) * rows / legacy_rows
+    estimated = ' (extrapolated)' if legacy_rows < rows else ''
+    print(f'  notebook    {legacy:8.2f}s  {rows / legacy:12.0f} rows/s{estimated}')
+    print(f'  speedup     x{legacy / vectorised:.0f}')
+
+
+if __name__ == '__main__':
+    main()
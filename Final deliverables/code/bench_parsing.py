@@ -0,0 +1,82 @@
+# Throughput of the page extractors on cached pages (no network access):
+#   html.parser  the original get_* extractors on BeautifulSoup(content, 'html.parser')
+#   lxml         the same extractors on a soup built with the lxml tree builder
+#   spec         the single-pass extractor compiled from each retailer's SPEC (used by
+#                the scrapers)
+# Run from the 'Final deliverables' folder once a scrape has filled data/cache/, e.g.
+#   python code/bench_parsing.py --limit 500
+import argparse
+import json
+import time
+
+import parsing
+import scrape_decantalo
+import scrape_laithwaites
+import scrape_morrissons
+import scrape_virginwines
+from cache import PageCache
+
+RETAILERS = {
+    'decantalo': scrape_decantalo,
+    'laithwaites': scrape_laithwaites,
+    'morrissons': scrape_morrissons,
+    'virginwines': scrape_virginwines,
+}
+
+
+def load_pages(cache, module, limit):
+    pages = []
+    for listing in json.load(open(module.listing_urls_path)):
+        # Virgin Wines listings are plain URLs
+        wine_type, url = listing if isinstance(listing, list) else (None, listing)
+        entry = cache.lookup(url)
+        if entry is not None:
+            pages.append((wine_type, url, cache.read(entry)))
+        if len(pages) >= limit:
+            break
+    return pages
+
+
+def time_parse(parse, pages):
+    start = time.perf_counter()
+    for wine_type, url, content in pages:
+        try:
+            parse(wine_type, url, content)
+        except Exception:
+            # Broken listings fail in real runs too, they still cost the parse
+            pass
+    return time.perf_counter() - start
+
+
+def time_soup(module, pages, backend):
+    parsing.BACKEND = backend
+    return time_parse(module.parse_listing_soup, pages)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--limit', type=int, default=200, help='cached pages per retailer')
+    parser.add_argument('--retailer', choices=RETAILERS, action='append')
+    args = parser.parse_args()
+
+    cache = PageCache()
+    for name in args.retailer or RETAILERS:
+        module = RETAILERS[name]
+        pages = load_pages(cache, module, args.limit)
+        if not pages:
+            print(f'{name}: no cached pages, run the scraper first')
+            continue
+
+        timings = {
+            'html.parser': time_soup(module, pages, 'html.parser'),
+            'lxml': time_soup(module, pages, 'lxml'),
+            'spec': time_parse(module.parse_listing, pages),
+        }
+        print(f'{name} ({len(pages)} pages)')
+        for backend, seconds in timings.items():
+            speedup = timings['html.parser'] / seconds
+            print(f'  {backend:<12} {len(pages) / seconds:8.1f} pages/s  x{speedup:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+# Benchmark suite, to tell whether a parser or pipeline change helped:
+#   parse_<retailer>  pages/s of the scrapers' parse_listing on a frozen corpus of pages
+#   merge             the steps of Merge_dataset_for_DTVC.ipynb on the ready to merge CSVs
+#   aggregations      the 'most reviewed' tables of visualization.ipynb
+# The last two run on the CSVs repeated --scale times. Every benchmark is timed (best of
+# --repeat runs) and then run once more under tracemalloc for its peak memory (memory
+# allocated through Python: lxml's trees are not counted, pandas' arrays are).
+# Results are appended to data/bench/results.jsonl with the commit they were measured
+# on, and 'compare' shows the change against another commit.
+# Run from the 'Final deliverables' folder:
+#   python code/benchmark.py freeze --limit 200     (once, copies pages from data/cache/)
+#   python code/benchmark.py run --scale 20
+#   python code/benchmark.py compare                (against the previous commit measured)
+import argparse
+import glob
+import hashlib
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pandas as pd
+
+import normalisation
+from bench_parsing import RETAILERS, load_pages
+from cache import PageCache
+from normalisation import country_codes, normalise_countries, normalise_wine_types
+
+BENCH_DIR = Path('./data/bench')
+CORPUS_DIR = BENCH_DIR / 'corpus'
+RESULTS_PATH = BENCH_DIR / 'results.jsonl'
+# Slower (or bigger) than the base by more than this fraction is reported as a regression
+TOLERANCE = 0.1
+
+
+def freeze(limit, force=False):
+    # Copies cached pages to data/bench/corpus/<retailer>/, which later runs always use,
+    # whatever happens to the cache. An existing corpus is kept unless force is set.
+    cache = PageCache()
+    for name, module in RETAILERS.items():
+        directory = CORPUS_DIR / name
+        if (directory / 'manifest.json').exists() and not force:
+            print(f'{name}: corpus already frozen, --force to replace it')
+            continue
+        pages = load_pages(cache, module, limit)
+        if not pages:
+            print(f'{name}: no cached pages, run the scraper first')
+            continue
+
+        directory.mkdir(parents=True, exist_ok=True)
+        for path in directory.glob('*.html'):
+            path.unlink()
+        manifest = []
+        for number, (wine_type, url, content) in enumerate(pages):
+            path = directory / f'{number:05d}.html'
+            path.write_bytes(content)
+            manifest.append({'wine_type': wine_type, 'url': url, 'file': path.name})
+        with open(directory / 'manifest.json', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        print(f'{name}: {len(pages)} pages frozen')
+
+
+def load_corpus(name):
+    directory = CORPUS_DIR / name
+    if not (directory / 'manifest.json').exists():
+        return []
+    return [
+        (page['wine_type'], page['url'], (directory / page['file']).read_bytes())
+        for page in json.load(open(directory / 'manifest.json'))
+    ]
+
+
+def fingerprint(*parts):
+    # Identifies the input of a benchmark, results on different inputs are not compared
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+    return digest.hexdigest()[:12]
+
+
+def parse_all(parse, pages):
+    for wine_type, url, content in pages:
+        try:
+            parse(wine_type, url, content)
+        except Exception:
+            # Broken listings fail in real runs too, they still cost the parse
+            pass
+
+
+def load_ready_to_merge(scale):
+    # {retailer: cleaned listings}, each repeated scale times
+    frames = {}
+    for path in sorted(glob.glob('./data/ready to merge/*.csv')):
+        data = pd.read_csv(path)
+        frames[Path(path).name.split('_')[0]] = pd.concat([data] * scale, ignore_index=True)
+    return frames
+
+
+def merge(frames):
+    # Merge_dataset_for_DTVC.ipynb, from the loaded CSVs to the merged dataset
+    data = pd.concat(
+        [frame.assign(retailer=retailer) for retailer, frame in frames.items()],
+        ignore_index=True,
+    )
+    data['country'] = normalise_countries(data['country'])
+    data['year'] = data['year'].replace('Non Vintage', 'NV')
+    data['wine_type'] = normalise_wine_types(data['wine_type'])
+    data['countrycode'] = country_codes(data['country'])
+    return data
+
+
+def cold_merge(frames):
+    # The notebook runs in a fresh process, without the lookups cached by a previous run
+    normalisation.COUNTRY_TABLE.resolve.cache_clear()
+    normalisation.WINE_TYPE_TABLE.resolve.cache_clear()
+    normalisation.country_code.cache_clear()
+    return merge(frames)
+
+
+def get_most_reviewed(data, attribute):
+    # As in visualization.ipynb
+    num_review_by_attribute = (
+        data
+        .groupby(['retailer', attribute], as_index=False)
+        ['num_review'].sum()
+    )
+    most_reviewed = (
+        num_review_by_attribute
+        .sort_values('num_review', ascending=False)
+        .groupby(['retailer'], as_index=False).head(5)
+    )
+    most_reviewed['total_review'] = most_reviewed.groupby('retailer')['num_review'].transform('sum')
+    most_reviewed = most_reviewed.eval('pct_review = num_review / total_review')
+    return most_reviewed
+
+
+def aggregations(data):
+    # The tables behind the plots of visualization.ipynb
+    data = data.copy()
+    data['price_category'] = pd.qcut(data['price'], 10)
+    tables = [
+        get_most_reviewed(data, attribute)
+        for attribute in ('country', 'wine_type', 'price_category')
+    ]
+    for column, category in (('abv', 'abv_category'), ('age', 'age_category')):
+        subset = data.copy()
+        subset[column] = pd.to_numeric(subset[column], errors='coerce')
+        subset = subset.dropna(subset=column)
+        subset[category] = pd.qcut(subset[column], 5)
+        tables.append(get_most_reviewed(subset, category))
+    return tables
+
+
+def measure(function, *args, repeat=3):
+    # Best time of repeat runs, then the peak of the memory allocated by one more run
+    seconds = min(timed(function, *args) for _ in range(repeat))
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def benchmarks(scale, retailers):
+    # (name, unit, items, input fingerprint, function, args), inputs are loaded up front
+    for name in retailers:
+        pages = load_corpus(name)
+        if not pages:
+            print(f'parse_{name}: no frozen corpus, run freeze first')
+            continue
+        corpus = fingerprint(*(content for _, _, content in pages))
+        yield f'parse_{name}', 'pages', len(pages), corpus, parse_all, (RETAILERS[name].parse_listing, pages)
+
+    frames = load_ready_to_merge(scale)
+    rows = sum(len(frame) for frame in frames.values())
+    yield 'merge', 'rows', rows, fingerprint('ready to merge', rows), cold_merge, (frames,)
+
+    data = pd.read_csv('./data/all_retailers.csv', index_col=0)
+    data = pd.concat([data] * scale, ignore_index=True)
+    yield 'aggregations', 'rows', len(data), fingerprint('all_retailers', len(data)), aggregations, (data,)
+
+
+def current_commit():
+    def git(*args):
+        return subprocess.run(
+            ['git', *args], capture_output=True, text=True, cwd=Path(__file__).parent
+        ).stdout.strip()
+
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    # Uncommitted changes to the code make the result a different version
+    dirty = bool(git('status', '--porcelain', '--', '.'))
+    return commit + ('-dirty' if dirty else '')
+
+
+def run(scale, repeat, retailers):
+    commit = current_commit()
+    measured_at = datetime.now(timezone.utc).isoformat()
+    RESULTS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    print(f'{commit}, scale {scale}')
+    print(f'  {"benchmark":<24}{"items":>10}{"seconds":>10}{"items/s":>12}{"peak MB":>10}')
+
+    for name, unit, items, inputs, function, args in benchmarks(scale, retailers):
+        seconds, peak = measure(function, *args, repeat=repeat)
+        result = {
+            'commit': commit,
+            'measured_at': measured_at,
+            'benchmark': name,
+            'inputs': inputs,
+            'unit': unit,
+            'items': items,
+            'seconds': seconds,
+            'rate': items / seconds,
+            'peak_mb': peak / 1024 ** 2,
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+        }
+        with open(RESULTS_PATH, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+        print(f'  {name:<24}{items:>10}{seconds:>10.3f}{result["rate"]:>12.0f}{result["peak_mb"]:>10.1f}')
+
+
+def load_results():
+    if not RESULTS_PATH.exists():
+        return pd.DataFrame()
+    return pd.read_json(RESULTS_PATH, lines=True)
+
+
+def compare(commit=None, base=None, tolerance=TOLERANCE):
+    # Latest results of commit (default: the last one measured) against those of base
+    # (default: the commit measured before it). Returns the number of regressions.
+    results = load_results()
+    if results.empty:
+        print('No results yet, see run')
+        return 0
+    commits = list(dict.fromkeys(results['commit'][::-1]))
+    commit = commit or commits[0]
+    base = base or next((c for c in commits if c != commit), None)
+    if base is None:
+        print(f'Only {commit} has been measured')
+        return 0
+
+    def latest(c):
+        return results[results['commit'] == c].groupby('benchmark').last()
+
+    new, old = latest(commit), latest(base)
+    print(f'{commit} against {base}')
+    print(f'  {"benchmark":<24}{"items/s":>12}{"change":>9}{"peak MB":>10}{"change":>9}')
+    regressions = 0
+    for name in new.index.intersection(old.index):
+        if new.loc[name, 'inputs'] != old.loc[name, 'inputs']:
+            print(f'  {name:<24}  measured on different inputs, not compared')
+            continue
+        speed = new.loc[name, 'rate'] / old.loc[name, 'rate'] - 1
+        memory = new.loc[name, 'peak_mb'] / max(old.loc[name, 'peak_mb'], 0.01) - 1
+        regression = speed < -tolerance or memory > tolerance
+        regressions += regression
+        print(
+            f'  {name:<24}{new.loc[name, "rate"]:>12.0f}{speed:>+9.1%}'
+            f'{new.loc[name, "peak_mb"]:>10.1f}{memory:>+9.1%}'
+            + ('  REGRESSION' if regression else '')
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    frozen = commands.add_parser('freeze', help='copy cached pages to the benchmark corpus')
+    frozen.add_argument('--limit', type=int, default=200, help='pages per retailer')
+    frozen.add_argument('--force', action='store_true', help='replace the existing corpus')
+
+    runs = commands.add_parser('run', help='run the benchmarks and record the results')
+    runs.add_argument('--scale', type=int, default=20, help='copies of the CSVs')
+    runs.add_argument('--repeat', type=int, default=3)
+    runs.add_argument('--retailer', choices=RETAILERS, action='append')
+
+    compared = commands.add_parser('compare', help='compare the results of two commits')
+    compared.add_argument('--commit')
+    compared.add_argument('--base')
+    compared.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    if args.command == 'freeze':
+        freeze(args.limit, args.force)
+    elif args.command == 'run':
+        run(args.scale, args.repeat, args.retailer or list(RETAILERS))
+    elif compare(args.commit, args.base, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
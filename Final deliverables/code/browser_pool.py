@@ -0,0 +1,179 @@
+import argparse
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver import Chrome, ChromeOptions
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+# Longest time to wait for an element before giving up (seconds)
+WAIT = 15
+WORKERS = 4
+FIXTURES_DIR = Path(__file__).parent / 'fixtures' / 'discovery'
+
+
+def make_driver(headless=True):
+    options = ChromeOptions()
+    if headless:
+        options.add_argument('--headless=new')
+    options.add_argument('--window-size=1920,1080')
+    return Chrome(options=options)
+
+
+def wait_for(driver, xpath, timeout=WAIT):
+    # Wait for an element to be in the page instead of sleeping for a fixed time
+    return WebDriverWait(driver, timeout).until(
+        EC.presence_of_element_located((By.XPATH, xpath))
+    )
+
+
+def wait_for_all(driver, xpath, timeout=WAIT):
+    try:
+        return WebDriverWait(driver, timeout).until(
+            EC.presence_of_all_elements_located((By.XPATH, xpath))
+        )
+    except TimeoutException:
+        return []
+
+
+def wait_until_stale(driver, element, timeout=WAIT):
+    # The page (or the listings grid) has been replaced after navigating
+    WebDriverWait(driver, timeout).until(EC.staleness_of(element))
+
+
+def click_if_present(driver, xpath, timeout=5):
+    try:
+        button = WebDriverWait(driver, timeout).until(
+            EC.element_to_be_clickable((By.XPATH, xpath))
+        )
+    except TimeoutException:
+        return False
+    button.click()
+    return True
+
+
+def accept_cookies(driver):
+    # Morrisons and Laithwaites both use the OneTrust banner
+    click_if_present(driver, '//button[@id="onetrust-accept-btn-handler"]')
+
+
+class DriverPool:
+    # N browsers shared by the crawl workers, each one is used by a single worker at a time
+
+    def __init__(self, size=WORKERS, headless=True):
+        self.drivers = queue.Queue()
+        self.all_drivers = []
+        try:
+            for _ in range(size):
+                driver = make_driver(headless)
+                self.all_drivers.append(driver)
+                self.drivers.put(driver)
+        except BaseException:
+            # __exit__ won't run, the browsers already started would be left running
+            self.close()
+            raise
+
+    @contextmanager
+    def driver(self):
+        driver = self.drivers.get()
+        try:
+            yield driver
+        finally:
+            self.drivers.put(driver)
+
+    def close(self):
+        for driver in self.all_drivers:
+            driver.quit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def crawl_categories(wine_type_urls, discover_category, workers=WORKERS, headless=True):
+    # discover_category(driver, wine_type, url) -> [[wine_type, listing_url], ...]
+    # Categories are crawled in parallel, the listings keep the order of wine_type_urls.
+    workers = min(workers, len(wine_type_urls))
+
+    with DriverPool(workers, headless) as pool:
+        def crawl(wine_type, url):
+            with pool.driver() as driver:
+                listing_urls = discover_category(driver, wine_type, url)
+            print(f'Found {len(listing_urls)} {wine_type} listings')
+            return listing_urls
+
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(crawl, wine_type, url)
+                for wine_type, url in wine_type_urls.items()
+            ]
+            listing_urls = []
+            for future in futures:
+                listing_urls.extend(future.result())
+
+    print(f'Found {len(listing_urls)} listings in total')
+    return listing_urls
+
+
+@contextmanager
+def serve_fixtures(root=FIXTURES_DIR):
+    # Local copy of the category pages, so discovery can be exercised without network access
+    handler = partial(SimpleHTTPRequestHandler, directory=str(root))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+
+
+def fixture_urls(base_url, retailer, root=FIXTURES_DIR):
+    # Fixture categories are the <wine_type>.html files, further pages are <wine_type>-<n>.html
+    return {
+        path.stem: f'{base_url}/{retailer}/{path.name}'
+        for path in sorted((root / retailer).glob('*.html'))
+        if '-' not in path.stem
+    }
+
+
+def main():
+    import scrape_decantalo
+    import scrape_laithwaites
+    import scrape_morrissons
+
+    retailers = {
+        'decantalo': scrape_decantalo.discover_category,
+        'laithwaites': scrape_laithwaites.discover_category,
+        'morrissons': scrape_morrissons.discover_category,
+    }
+
+    parser = argparse.ArgumentParser(description='Run listing discovery against the local fixture site')
+    parser.add_argument('--retailer', choices=retailers, action='append')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--show', action='store_true', help='show the browsers')
+    args = parser.parse_args()
+
+    with serve_fixtures() as base_url:
+        for retailer in args.retailer or retailers:
+            listing_urls = crawl_categories(
+                fixture_urls(base_url, retailer),
+                retailers[retailer],
+                workers=args.workers,
+                headless=not args.show,
+            )
+            for wine_type, listing_url in listing_urls:
+                print(f'  {wine_type}: {listing_url}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import hashlib
+import sqlite3
+import time
+from collections import namedtuple
+from pathlib import Path
+from urllib.parse import urldefrag
+
+CACHE_DIR = Path('./data/cache')
+# Pages younger than this are served from disk without asking the server
+TTL = 24 * 60 * 60
+MAX_BYTES = 2 * 1024 ** 3
+
+Entry = namedtuple('Entry', ['url', 'sha', 'etag', 'last_modified', 'fetched_at', 'size'])
+
+
+def cache_key(url):
+    # The fragment never reaches the server, e.g. Decantalo's #/1-volume-75_cl/201-year-2021
+    return urldefrag(url).url
+
+
+class PageCache:
+    # Raw product HTML stored content-addressed under objects/, with an SQLite index
+    # mapping URLs to their content, validators (ETag / Last-Modified) and last access.
+    # Identical pages behind different URLs are only stored once.
+
+    def __init__(self, root=CACHE_DIR, ttl=TTL, max_bytes=MAX_BYTES):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        (self.root / 'objects').mkdir(parents=True, exist_ok=True)
+
+        # The fetcher uses the cache from its event loop thread
+        self.conn = sqlite3.connect(self.root / 'index.sqlite', check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                sha TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at);
+            CREATE INDEX IF NOT EXISTS pages_sha ON pages (sha);
+        ''')
+        self.total_bytes = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM pages GROUP BY sha)'
+        ).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    def object_path(self, sha):
+        return self.root / 'objects' / sha[:2] / sha
+
+    def lookup(self, url):
+        row = self.conn.execute(
+            'SELECT url, sha, etag, last_modified, fetched_at, size FROM pages WHERE url = ?',
+            (cache_key(url),),
+        ).fetchone()
+        if row is None:
+            return None
+        entry = Entry(*row)
+        if not self.object_path(entry.sha).exists():
+            # Deleted behind the index's back (e.g. by hand): a miss, the page is fetched again
+            with self.conn:
+                self.conn.execute('DELETE FROM pages WHERE url = ?', (entry.url,))
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry.fetched_at < self.ttl
+
+    def read(self, entry):
+        with self.conn:
+            self.conn.execute(
+                'UPDATE pages SET accessed_at = ? WHERE url = ?', (time.time(), entry.url)
+            )
+        return self.object_path(entry.sha).read_bytes()
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def revalidate(self, entry):
+        # The server answered 304 Not Modified: the cached copy is good for another TTL
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                'UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?',
+                (now, now, entry.url),
+            )
+
+    def store(self, url, content, headers):
+        sha = hashlib.sha256(content).hexdigest()
+        path = self.object_path(sha)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            # Write then rename, so a crash never leaves a truncated page behind
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_bytes(content)
+            tmp_path.replace(path)
+            self.total_bytes += len(content)
+
+        now = time.time()
+        with self.conn:
+            previous = self.conn.execute(
+                'SELECT sha FROM pages WHERE url = ?', (cache_key(url),)
+            ).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    cache_key(url),
+                    sha,
+                    headers.get('ETag'),
+                    headers.get('Last-Modified'),
+                    now,
+                    now,
+                    len(content),
+                ),
+            )
+        if previous and previous[0] != sha:
+            self.drop_object(previous[0])
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def drop_object(self, sha):
+        # Objects can be shared by several URLs, only delete unreferenced ones
+        if self.conn.execute('SELECT 1 FROM pages WHERE sha = ? LIMIT 1', (sha,)).fetchone():
+            return
+        path = self.object_path(sha)
+        if path.exists():
+            self.total_bytes -= path.stat().st_size
+            path.unlink()
+
+    def evict(self):
+        # Least recently used pages go first, until the cache is 10% under its budget
+        target = self.max_bytes * 0.9
+        cursor = self.conn.execute('SELECT url, sha FROM pages ORDER BY accessed_at')
+        for url, sha in cursor.fetchall():
+            if self.total_bytes <= target:
+                break
+            with self.conn:
+                self.conn.execute('DELETE FROM pages WHERE url = ?', (url,))
+            self.drop_object(sha)
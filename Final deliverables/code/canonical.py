@@ -0,0 +1,89 @@
+# Listings that are the same page. Decantalo lists a product once per vintage and bottle
+# size, as URL fragments (...-234.html#/19-volume-magnum/201-year-2021) that never reach
+# the server, and Morrisons lists some products under several categories (rosés under
+# 'white' too). Listings are grouped by canonical URL before fetching, each page is
+# fetched and parsed once, and the result is copied back to every listing of its group,
+# with the wine type of the listing's category and the vintage and size of its fragment.
+import re
+from urllib.parse import urldefrag, urlsplit, urlunsplit
+
+# Decantalo volume values without a number of cL or liters in them
+VOLUMES = {'magnum': 150, '375_cl_3_8': 37.5}
+VOLUME_PATTERN = re.compile(r'(\d+)_(cl|liters?)')
+FRAGMENT_PATTERN = re.compile(r'^\d+-(volume|year)-(.+)$')
+YEAR_PATTERN = re.compile(r'^\d{4}$')
+
+
+def canonical_url(url):
+    # Without the fragment, and with the scheme and host in lower case
+    parts = urlsplit(urldefrag(url).url)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', parts.query, ''))
+
+
+def volume(value):
+    # '75_cl' -> 75, '3_liters_jeroboam' -> 300, 'gift' -> None
+    if value in VOLUMES:
+        return float(VOLUMES[value])
+    match = VOLUME_PATTERN.search(value)
+    if match is None:
+        return None
+    size, unit = match.groups()
+    return float(size) * (1 if unit == 'cl' else 100)
+
+
+def variant(url):
+    # Fields set by the fragment of a listing, e.g. {'size (cL)': 150.0, 'year': '2021'}.
+    # The page itself shows the default combination whatever the fragment.
+    fields = {}
+    for segment in urldefrag(url).fragment.strip('/').split('/'):
+        match = FRAGMENT_PATTERN.match(segment)
+        if match is None:
+            continue
+        group, value = match.groups()
+        if group == 'volume':
+            size = volume(value)
+            if size is not None:
+                fields['size (cL)'] = size
+        else:
+            # 'without_vintage', left empty as on the product pages
+            fields['year'] = value if YEAR_PATTERN.match(value) else None
+    return fields
+
+
+def fan_out_row(row, wine_type, url):
+    # Copy of a parsed row for another listing of the same page. Only the fields the
+    # retailer's parser returns are overridden.
+    row = dict(row)
+    if 'url' in row:
+        row['url'] = url
+    if 'wine_type' in row and wine_type is not None:
+        row['wine_type'] = wine_type
+    for column, value in variant(url).items():
+        if column in row:
+            row[column] = value
+    return row
+
+
+class CanonicalIndex:
+    # Canonical URL -> listings (wine_type, url) of that page, in the order they are given
+
+    def __init__(self, listings):
+        self.groups = {}
+        for listing in listings:
+            group = self.groups.setdefault(canonical_url(listing[1]), [])
+            if listing not in group:
+                group.append(listing)
+
+    def __len__(self):
+        return sum(len(group) for group in self.groups.values())
+
+    def fetches(self):
+        # One listing per page, parsed with the wine type of the first listing
+        return [(group[0][0], url) for url, group in self.groups.items()]
+
+    def fan_out(self, results):
+        # fetcher.Result of every page -> a Result per listing of the page, failures included
+        for result in results:
+            for wine_type, url in self.groups[result.url]:
+                row = None if result.row is None else fan_out_row(result.row, wine_type, url)
+                yield result._replace(wine_type=wine_type, url=url, row=row)
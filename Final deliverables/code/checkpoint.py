@@ -0,0 +1,161 @@
+import csv
+import json
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Statuses that mean a listing does not need to be fetched again in the same run
+COMPLETED = ('done', 'skipped', 'dead')
+# Listings go to the dead letters (and are not retried) when they are gone, or when they
+# have failed this many runs in a row (each run already retries them a few times)
+GONE = (404, 410)
+MAX_FAILURES = 3
+DEAD_LETTERS_DIR = Path('./data/dead_letters')
+
+
+def write_csv(rows, path):
+    # rows: function returning an iterator over the rows. The first pass collects the
+    # columns (in the order they were first seen), the second one streams the rows out
+    # without holding them in memory
+    columns = {}
+    for row in rows():
+        columns.update(dict.fromkeys(row))
+
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(columns))
+        writer.writeheader()
+        for row in rows():
+            writer.writerow(row)
+
+
+class CheckpointStore:
+    # Append-only log of fetch results keyed by URL. Every attempt is a new row and is
+    # committed straight away, so a crash loses at most the listing being parsed.
+    # Once a run is published, the next one starts over (see start_run).
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS attempts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                wine_type TEXT,
+                status TEXT NOT NULL,
+                http_status INTEGER,
+                row TEXT,
+                error TEXT,
+                created_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS attempts_url ON attempts (url, id);
+            CREATE TABLE IF NOT EXISTS published (published_at TEXT NOT NULL);
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def record(self, result):
+        # result is a fetcher.Result
+        if result.error:
+            failures = self.conn.execute(
+                "SELECT COUNT(*) FROM attempts WHERE url = ? AND wine_type IS ? AND status = 'failed'",
+                (result.url, result.wine_type),
+            ).fetchone()[0]
+            status = 'dead' if result.status in GONE or failures + 1 >= MAX_FAILURES else 'failed'
+        elif result.row is None:
+            status = 'skipped'
+        else:
+            status = 'done'
+
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO attempts (url, wine_type, status, http_status, row, error, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    result.url,
+                    result.wine_type,
+                    status,
+                    result.status,
+                    None if result.row is None else json.dumps(result.row),
+                    result.error,
+                    datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+
+    def published(self):
+        return self.conn.execute('SELECT COUNT(*) FROM published').fetchone()[0] > 0
+
+    def mark_published(self):
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO published (published_at) VALUES (?)', (datetime.now(timezone.utc).isoformat(),)
+            )
+
+    def start_run(self):
+        # Forgets the rows of the published run so that every listing is fetched again. The
+        # failures and the dead letters are kept, they count across runs.
+        with self.conn:
+            self.conn.execute("DELETE FROM attempts WHERE status IN ('done', 'skipped')")
+            self.conn.execute('DELETE FROM published')
+
+    def completed(self):
+        cursor = self.conn.execute(
+            'SELECT DISTINCT wine_type, url FROM attempts WHERE status IN (%s)' % ','.join('?' * len(COMPLETED)),
+            COMPLETED,
+        )
+        return set(cursor)
+
+    def pending(self, listings):
+        # The same URL can be listed under several wine types, so both make up the key
+        completed = self.completed()
+        return [
+            (wine_type, url) for wine_type, url in listings
+            if (wine_type, url) not in completed
+        ]
+
+    def rows(self):
+        for _, row in self.fetched_rows():
+            yield row
+
+    def fetched_rows(self):
+        # Latest successful row per listing, with the time its page was fetched, streamed
+        # from the database
+        cursor = self.conn.execute('''
+            SELECT created_at, row FROM attempts AS a
+            WHERE status = 'done'
+              AND id = (
+                SELECT MAX(id) FROM attempts
+                WHERE url = a.url AND wine_type IS a.wine_type AND status = 'done'
+              )
+            ORDER BY id
+        ''')
+        for fetched_at, row in cursor:
+            yield fetched_at, json.loads(row)
+
+    def dead_letters(self):
+        cursor = self.conn.execute('''
+            SELECT wine_type, url, http_status, error, created_at FROM attempts
+            WHERE status = 'dead'
+            ORDER BY id
+        ''')
+        return list(cursor)
+
+    def export_dead_letters(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['wine_type', 'url', 'http_status', 'error', 'failed_at'])
+            writer.writerows(self.dead_letters())
+
+    def export_csv(self, path):
+        write_csv(self.rows, path)
+
+    def summary(self):
+        cursor = self.conn.execute('''
+            SELECT status, COUNT(*) FROM attempts AS a
+            WHERE id = (SELECT MAX(id) FROM attempts WHERE url = a.url AND wine_type IS a.wine_type)
+            GROUP BY status
+        ''')
+        return dict(cursor)
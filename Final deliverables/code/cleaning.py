@@ -0,0 +1,123 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from normalisation import country_codes
+
+# The cleaning steps of the clean_*.ipynb notebooks as column operations, one function per
+# retailer: scraped listings (data/scrapped/) in, data ready to merge (data/ready to merge/)
+# out. The notebooks keep the exploration and the plots.
+
+# Ages are counted from the year the listings were scraped
+SCRAPE_YEAR = 2022
+# Ratings based on this many reviews or fewer get a score of 0
+MIN_REVIEWS = 5
+# Prices are compared for a standard 75cL bottle
+BOTTLE_SIZE = 75
+
+# Laithwaites takes a word of the name as the year for the cases and collections
+YEARS_TO_DROP = [
+    'Case',
+    'Classics',
+    'Collection',
+    'Gift',
+    'Loire',
+    'Malbecs',
+    'Merlots',
+    'Reds',
+    'Sauvignons',
+    'Selection',
+    'Showcase',
+    'Six',
+    'Trio',
+    'Whites',
+    'Wines',
+]
+
+RENAMES = {'size': 'size(cL)', 'scaledprice': 'scaled_price'}
+
+
+def get_age(year):
+    # 'NV' and other non-numeric years give NaN
+    return SCRAPE_YEAR - pd.to_numeric(year, errors='coerce')
+
+
+def get_score(num_review, rating):
+    return rating.where(num_review > MIN_REVIEWS, 0)
+
+
+def get_scaled_price(price, size):
+    return price * BOTTLE_SIZE / size
+
+
+def fill_most_frequent(values):
+    # Same as SimpleImputer(strategy='most_frequent'): ties go to the smallest value
+    return values.fillna(values.mode()[0])
+
+
+def add_features(data):
+    # Derived columns shared by all the retailers
+    data['age'] = get_age(data['year'])
+    data['score'] = get_score(data['num_review'], data['rating'])
+    data['scaledprice'] = get_scaled_price(data['price'], data['size'])
+    data['logprice'] = np.log10(data['scaledprice'])
+    data['countrycode'] = country_codes(data['country'])
+    data['price_fixed'] = pd.to_numeric(data['price'], errors='coerce')
+    return data.rename(columns=RENAMES)
+
+
+def clean_decantalo(data):
+    data = data.rename(columns={'size (cL)': 'size'})
+    # 'out of stock' prices become NaN
+    data['price'] = pd.to_numeric(data['price'], errors='coerce')
+    data['country'] = data['country'].fillna('unknown')
+    # Some ABVs are > 1000, and the few listings without ABV are dropped too
+    data = data[data['abv'] < 100].reset_index(drop=True)
+    data['size'] = fill_most_frequent(data['size'])
+    return add_features(data)
+
+
+def clean_laithwaites(data):
+    # Mix cases are dropped because their bottles are listed on their own too
+    data = data[~data['Mix Case?'].astype(bool)].drop(columns='Mix Case?')
+    # Sizes are in ml
+    data['size'] = data['size'] / 10
+    data['country'] = data['country'].fillna('unknown')
+    data = data[~data['year'].isin(YEARS_TO_DROP)].reset_index(drop=True)
+    return add_features(data)
+
+
+def clean_morrissons(data):
+    data = data.rename(columns={'size (cL)': 'size'})
+    data['country'] = data['country'].fillna('unknown')
+    data = data.dropna(subset=['abv']).reset_index(drop=True)
+    data['size'] = fill_most_frequent(data['size'])
+    return add_features(data)
+
+
+def clean_virginwines(data):
+    data = data.rename(columns={'size (cL)': 'size'})
+    data['country'] = data['country'].fillna('unknown')
+    return add_features(data)
+
+
+CLEANERS = {
+    'decantalo': clean_decantalo,
+    'laithwaites': clean_laithwaites,
+    'morrissons': clean_morrissons,
+    'virginwines': clean_virginwines,
+}
+
+
+def main():
+    # Run from the 'Final deliverables' folder
+    for retailer, clean in CLEANERS.items():
+        data = clean(pd.read_csv(f'./data/scrapped/{retailer}_listings.csv'))
+        path = Path(f'./data/ready to merge/{retailer}_to_merge.csv')
+        data.to_csv(path, index=False)
+        print(f'{retailer}: {len(data)} listings -> {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+# Precomputed review and price rollups for the dashboards of visualization.ipynb, by
+# retailer x country x wine type x price decile x ABV bucket x age bucket. The measures
+# are sums (listings, reviews, prices, ratings), so any coarser rollup is a sum over the
+# cells, and a new snapshot only changes the cells of the listings it adds or updates.
+# Each listing's contribution is kept next to the cells: an updated listing is taken out
+# of its old cell and added to its new one.
+# The bucket edges are the deciles/quintiles of the data the cube was built from
+# (pd.qcut, as in the notebook), and stay frozen while snapshots land, so the buckets keep
+# their meaning. 'build' recomputes them.
+# Run from the 'Final deliverables' folder:
+#   python code/cube.py build                      (from data/all_retailers.csv)
+#   python code/cube.py update data/pipeline/all_retailers.csv
+#   python code/cube.py most-reviewed country
+import argparse
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+CUBE_PATH = Path('./data/cube.sqlite')
+# Bucket column: (value column, number of quantiles)
+BUCKETS = {
+    'price_decile': ('price', 10),
+    'abv_bucket': ('abv', 5),
+    'age_bucket': ('age', 5),
+}
+DIMENSIONS = ['retailer', 'country', 'wine_type', *BUCKETS]
+MEASURES = ['listings', 'num_review', 'price_sum', 'price_count', 'rating_sum', 'rating_count']
+# Bucket of the listings without a value
+MISSING = -1
+
+
+def quantile_edges(values, quantiles):
+    values = pd.to_numeric(values, errors='coerce').dropna()
+    _, edges = pd.qcut(values, quantiles, retbins=True, duplicates='drop')
+    return edges.tolist()
+
+
+def bucket(values, edges):
+    # Index of the (right-closed) bucket of each value, values outside the edges go to the
+    # first or last bucket
+    values = pd.to_numeric(values, errors='coerce')
+    buckets = np.searchsorted(edges[1:-1], values.to_numpy(), side='left')
+    return pd.Series(np.where(values.isna(), MISSING, buckets), index=values.index)
+
+
+def contributions(data, edges):
+    # One row per listing: its cell and its measures
+    price = pd.to_numeric(data['price'], errors='coerce')
+    rating = pd.to_numeric(data['rating'], errors='coerce')
+    frame = pd.DataFrame({
+        'retailer': data['retailer'],
+        'url': data['url'],
+        'country': data['country'].fillna('unknown'),
+        'wine_type': data['wine_type'].fillna('unknown'),
+    })
+    for column, (value_column, _) in BUCKETS.items():
+        frame[column] = bucket(data[value_column], edges[column])
+    frame['listings'] = 1
+    frame['num_review'] = pd.to_numeric(data['num_review'], errors='coerce').fillna(0)
+    frame['price_sum'] = price.fillna(0)
+    frame['price_count'] = price.notna().astype(int)
+    frame['rating_sum'] = rating.fillna(0)
+    frame['rating_count'] = rating.notna().astype(int)
+    # A listing appearing twice in a snapshot counts once, with its last values
+    return frame.drop_duplicates(['retailer', 'url'], keep='last')
+
+
+class AggregateCube:
+
+    def __init__(self, path=CUBE_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        dimensions = ', '.join(f'{column} NOT NULL' for column in DIMENSIONS)
+        measures = ', '.join(f'{column} REAL NOT NULL' for column in MEASURES)
+        self.conn.executescript(f'''
+            CREATE TABLE IF NOT EXISTS edges (bucket TEXT PRIMARY KEY, edges TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS cells (
+                {dimensions}, {measures},
+                PRIMARY KEY ({', '.join(DIMENSIONS)})
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS listings (
+                url NOT NULL, {dimensions}, {measures},
+                PRIMARY KEY (retailer, url)
+            ) WITHOUT ROWID;
+        ''')
+        self.edges = {
+            column: json.loads(edges) for column, edges in self.conn.execute('SELECT bucket, edges FROM edges')
+        }
+        # Cells as a DataFrame, read again after every change
+        self.frame = None
+
+    def close(self):
+        self.conn.close()
+
+    def build(self, data):
+        # Starts over from data (e.g. all_retailers.csv), with new bucket edges
+        self.edges = {
+            column: quantile_edges(data[value_column], quantiles)
+            for column, (value_column, quantiles) in BUCKETS.items()
+        }
+        with self.conn:
+            self.conn.execute('DELETE FROM edges')
+            self.conn.execute('DELETE FROM cells')
+            self.conn.execute('DELETE FROM listings')
+            self.conn.executemany(
+                'INSERT INTO edges (bucket, edges) VALUES (?, ?)',
+                ((column, json.dumps(edges)) for column, edges in self.edges.items()),
+            )
+        return self.update(data)
+
+    def update(self, data):
+        # Adds the listings of a snapshot (rows of the merged dataset), or replaces their
+        # previous values. Returns the number of cells changed.
+        if not self.edges:
+            return self.build(data)
+        new = contributions(data, self.edges)
+        with self.conn:
+            old = self.stored(new[['retailer', 'url']])
+            changed = self.apply(pd.concat([new, negate(old)]))
+            self.conn.executemany(
+                f'INSERT OR REPLACE INTO listings (url, {", ".join(DIMENSIONS + MEASURES)}) '
+                f'VALUES ({", ".join("?" * (1 + len(DIMENSIONS) + len(MEASURES)))})',
+                new[['url', *DIMENSIONS, *MEASURES]].itertuples(index=False, name=None),
+            )
+        return changed
+
+    def remove(self, retailer, urls):
+        # Delisted listings. Returns the number of cells changed.
+        keys = pd.DataFrame({'retailer': retailer, 'url': list(urls)})
+        with self.conn:
+            old = self.stored(keys)
+            changed = self.apply(negate(old))
+            self.conn.executemany(
+                'DELETE FROM listings WHERE retailer = ? AND url = ?',
+                keys.itertuples(index=False, name=None),
+            )
+        return changed
+
+    def stored(self, keys):
+        # Stored contributions of the listings in keys (retailer, url)
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (retailer, url)')
+        self.conn.execute('DELETE FROM lookup')
+        self.conn.executemany('INSERT INTO lookup VALUES (?, ?)', keys.itertuples(index=False, name=None))
+        return pd.read_sql_query(
+            'SELECT l.* FROM listings l JOIN lookup k ON k.retailer = l.retailer AND k.url = l.url',
+            self.conn,
+        )
+
+    def apply(self, changes):
+        # Adds the measures of changes to their cells, and drops the cells left empty
+        deltas = changes.groupby(DIMENSIONS, as_index=False)[MEASURES].sum()
+        deltas = deltas[deltas[MEASURES].ne(0).any(axis=1)]
+        self.conn.executemany(
+            f'INSERT INTO cells ({", ".join(DIMENSIONS + MEASURES)}) '
+            f'VALUES ({", ".join("?" * (len(DIMENSIONS) + len(MEASURES)))}) '
+            f'ON CONFLICT DO UPDATE SET '
+            + ', '.join(f'{column} = {column} + excluded.{column}' for column in MEASURES),
+            deltas[DIMENSIONS + MEASURES].itertuples(index=False, name=None),
+        )
+        self.conn.execute('DELETE FROM cells WHERE listings <= 0')
+        self.frame = None
+        return len(deltas)
+
+    def cells(self):
+        if self.frame is None:
+            self.frame = pd.read_sql_query('SELECT * FROM cells', self.conn)
+        return self.frame
+
+    def labels(self, column):
+        # Bucket index -> interval of the bucket, like the pd.qcut categories
+        edges = self.edges[column]
+        return {
+            index: pd.Interval(low, high, closed='right')
+            for index, (low, high) in enumerate(zip(edges[:-1], edges[1:]))
+        }
+
+    def rollup(self, by):
+        # Measures summed by the dimensions in by, with the bucket intervals as labels.
+        # Listings without a value for a bucket dimension are left out, as the notebook
+        # drops them before pd.qcut.
+        cells = self.cells()
+        for column in by:
+            if column in BUCKETS:
+                cells = cells[cells[column] != MISSING]
+        rollup = cells.groupby(by, as_index=False)[MEASURES].sum()
+        for column in by:
+            if column in BUCKETS:
+                rollup[column] = rollup[column].map(self.labels(column))
+        rollup['mean_price'] = rollup['price_sum'] / rollup['price_count']
+        rollup['mean_rating'] = rollup['rating_sum'] / rollup['rating_count']
+        return rollup
+
+    def most_reviewed(self, dimension, top=5):
+        # visualization.ipynb's get_most_reviewed(data, dimension)
+        most_reviewed = (
+            self.rollup(['retailer', dimension])[['retailer', dimension, 'num_review']]
+            .sort_values('num_review', ascending=False)
+            .groupby(['retailer'], as_index=False).head(top)
+        )
+        most_reviewed['total_review'] = most_reviewed.groupby('retailer')['num_review'].transform('sum')
+        most_reviewed = most_reviewed.eval('pct_review = num_review / total_review')
+        return most_reviewed
+
+
+def negate(contributions):
+    contributions = contributions.copy()
+    contributions[MEASURES] = -contributions[MEASURES]
+    return contributions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='rebuild the cube, with new bucket edges')
+    build.add_argument('input', nargs='?', default='./data/all_retailers.csv')
+    update = commands.add_parser('update', help='add or update the listings of a merged CSV')
+    update.add_argument('input')
+    most_reviewed = commands.add_parser('most-reviewed')
+    most_reviewed.add_argument('dimension', choices=DIMENSIONS[1:])
+    rollup = commands.add_parser('rollup', help='listings, reviews, mean price and rating')
+    rollup.add_argument('by', nargs='+', choices=DIMENSIONS)
+    args = parser.parse_args()
+
+    cube = AggregateCube()
+    start = time.perf_counter()
+    if args.command in ('build', 'update'):
+        data = pd.read_csv(args.input, index_col=0)
+        changed = cube.build(data) if args.command == 'build' else cube.update(data)
+        print(f'{changed} cells changed in {time.perf_counter() - start:.2f}s')
+    elif args.command == 'most-reviewed':
+        print(cube.most_reviewed(args.dimension).to_string(index=False))
+    else:
+        print(cube.rollup(args.by).to_string(index=False))
+    cube.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+import html as html_entities
+import json
+import re
+
+import lxml.html
+from lxml import etree
+
+from metrics import METRICS
+from parsing import make_tree
+
+# Declarative extraction: each retailer describes its fields as a dict of Field objects
+# and compile_spec() turns it into an Extractor. The extractor walks the document once,
+# checks every element against all the selectors of the spec at the same time, then
+# post-processes the matches. Adding a retailer only needs a new spec.
+# Fields that the retailers also publish as structured data (the schema.org Product of the
+# JSON-LD: name, price, rating, review count, availability, or microdata attributes) are
+# first looked up in it with a regex scan of the raw page, and the document is only parsed
+# and walked for the fields still missing.
+
+SELECTOR_PATTERN = re.compile(
+    r'(?P<tag>^[\w-]+)'
+    r'|\.(?P<cls>[\w-]+)'
+    r'|#(?P<id>[\w-]+)'
+    r'|\[(?P<attr>[\w-]+)(?:=["\']?(?P<value>[^"\'\]]*)["\']?)?\]'
+)
+
+# Errors raised by post-processing functions that mean "value not usable"
+VALUE_ERRORS = (ValueError, TypeError, AttributeError, IndexError, KeyError)
+
+LD_JSON_PATTERN = re.compile(
+    rb'<script[^>]*type=["\']application/ld\+json["\'][^>]*>(.*?)</script>', re.DOTALL | re.IGNORECASE
+)
+ITEMPROP_PATTERN = re.compile(rb'itemprop=["\'](\w+)["\']')
+CONTENT_PATTERN = re.compile(rb'content=["\']([^"\']*)["\']')
+
+
+class ExtractionError(ValueError):
+    pass
+
+
+def text(element):
+    return element.text_content()
+
+
+def attr(name):
+    def get(element):
+        return element.get(name)
+    return get
+
+
+def html(element):
+    return lxml.html.tostring(element, encoding='unicode')
+
+
+class Field:
+    # selector: a single compound selector, e.g. 'span.value.data_features' or
+    #   'meta[itemprop=reviewCount]'. Descendant combinators are not supported so that every
+    #   selector can be checked on one element during the traversal; use get to look
+    #   inside the matched element instead.
+    # source: derive the value from another field instead of a selector
+    # get: element -> raw value (text content by default)
+    # many: keep all the matches (as a list) instead of the first one
+    # post: raw value -> final value. Errors from post, or no match, give default.
+    # fallback: name of another field used when this one ends up None
+    # structured: key of the value in structured_data() (e.g. 'price'), or a function of
+    #   those values, tried before the selector. The value (text) goes through post as a
+    #   value found by the selector does, so both give the same row; the selector is used
+    #   when post fails on it.
+    def __init__(
+        self,
+        selector=None,
+        source=None,
+        get=text,
+        many=False,
+        post=None,
+        default=None,
+        fallback=None,
+        structured=None,
+    ):
+        if (selector is None) == (source is None):
+            raise ValueError('a field needs either a selector or a source')
+        self.selector = selector
+        self.source = source
+        self.get = get
+        self.many = many
+        self.post = post
+        self.default = default
+        self.fallback = fallback
+        self.structured = structured
+
+
+class Matcher:
+    def __init__(self, selector):
+        self.selector = selector
+        self.tag = None
+        self.classes = []
+        self.attrs = {}
+
+        position = 0
+        for match in SELECTOR_PATTERN.finditer(selector):
+            if match.start() != position:
+                raise ValueError(f'unsupported selector {selector!r}')
+            position = match.end()
+
+            if match.group('tag'):
+                self.tag = match.group('tag')
+            elif match.group('cls'):
+                self.classes.append(match.group('cls'))
+            elif match.group('id'):
+                self.attrs['id'] = match.group('id')
+            else:
+                self.attrs[match.group('attr')] = match.group('value')
+        if position != len(selector):
+            raise ValueError(f'unsupported selector {selector!r}')
+
+    def key(self):
+        # Most selective part of the selector, used to dispatch elements to matchers
+        if self.classes:
+            return 'class', self.classes[0]
+        if 'id' in self.attrs:
+            return 'id', self.attrs['id']
+        if self.tag:
+            return 'tag', self.tag
+        return 'attr', next(iter(self.attrs))
+
+    def matches(self, element, classes):
+        if self.tag and element.tag != self.tag:
+            return False
+        for cls in self.classes:
+            if cls not in classes:
+                return False
+        for name, value in self.attrs.items():
+            actual = element.get(name)
+            if actual is None or (value is not None and actual != value):
+                return False
+        return True
+
+
+class Extractor:
+    # name labels the timings of the traversal and of every field in the metrics
+    def __init__(self, spec, name=None):
+        self.spec = spec
+        self.name = name
+        self.matchers = {}
+        self.dispatch = {}
+        for field in spec.values():
+            if field.selector and field.selector not in self.matchers:
+                matcher = Matcher(field.selector)
+                self.matchers[field.selector] = matcher
+                self.dispatch.setdefault(matcher.key(), []).append(matcher)
+        self.attr_names = [name for kind, name in self.dispatch if kind == 'attr']
+        self.structured = {name: field.structured for name, field in spec.items() if field.structured}
+        # Dispatch tables of the fields asked for, by set of fields
+        self.plans = {}
+
+    def plan(self, fields):
+        # Matchers of the selectors that fields (and the ones they derive from) need
+        if fields is None:
+            return self.dispatch, self.attr_names
+        key = frozenset(fields)
+        if key not in self.plans:
+            selectors = set()
+            pending = list(fields)
+            while pending:
+                field = self.spec[pending.pop()]
+                if field.selector:
+                    selectors.add(field.selector)
+                pending.extend(name for name in (field.source, field.fallback) if name)
+            dispatch = {}
+            for matcher_key, matchers in self.dispatch.items():
+                matchers = [matcher for matcher in matchers if matcher.selector in selectors]
+                if matchers:
+                    dispatch[matcher_key] = matchers
+            self.plans[key] = dispatch, [name for kind, name in dispatch if kind == 'attr']
+        return self.plans[key]
+
+    def traverse(self, tree, fields=None):
+        found = {selector: [] for selector in self.matchers}
+        dispatch, attr_names = self.plan(fields)
+
+        for element in tree.iter(etree.Element):
+            candidates = dispatch.get(('tag', element.tag), [])
+            classes = (element.get('class') or '').split()
+            for cls in classes:
+                candidates = candidates + dispatch.get(('class', cls), [])
+            element_id = element.get('id')
+            if element_id:
+                candidates = candidates + dispatch.get(('id', element_id), [])
+            for name in attr_names:
+                if element.get(name) is not None:
+                    candidates = candidates + dispatch[('attr', name)]
+
+            for matcher in candidates:
+                if matcher.matches(element, classes):
+                    found[matcher.selector].append(element)
+        return found
+
+    def parse(self, content):
+        # Fields from the structured data of the page, then from its document for the
+        # ones still missing. The document is not parsed at all if none is missing.
+        values = {}
+        if self.structured:
+            with METRICS.timer('structured_seconds', extractor=self.name):
+                data = structured_data(content)
+            for name, key in self.structured.items():
+                value = key(data) if callable(key) else data.get(key)
+                if value is None:
+                    continue
+                post = self.spec[name].post
+                try:
+                    values[name] = value if post is None else post(value)
+                except VALUE_ERRORS:
+                    pass
+
+        missing = [name for name in self.spec if name not in values]
+        METRICS.count('structured_fields', len(values), extractor=self.name)
+        if missing:
+            values.update(self(make_tree(content), fields=missing))
+        return values
+
+    def __call__(self, tree, fields=None):
+        # fields: only fill these fields (and the ones they derive from)
+        with METRICS.timer('traverse_seconds', extractor=self.name):
+            found = self.traverse(tree, fields)
+
+        values = {}
+        for name, field in self.spec.items():
+            if fields is not None and name not in fields:
+                continue
+            with METRICS.timer('extract_seconds', extractor=self.name, field=name):
+                values[name] = self.extract(name, field, found, values)
+
+        for name, field in self.spec.items():
+            if field.fallback and name in values and values[name] is None:
+                if field.fallback not in values:
+                    values[field.fallback] = self.extract(
+                        field.fallback, self.spec[field.fallback], found, values
+                    )
+                values[name] = values[field.fallback]
+        return values
+
+    def extract(self, name, field, found, values):
+        if field.source and field.source not in values:
+            values[field.source] = self.extract(
+                field.source, self.spec[field.source], found, values
+            )
+
+        try:
+            raw = self.raw_value(field, found, values)
+            if raw is None:
+                raise ExtractionError(f'{name} not found')
+            return raw if field.post is None else field.post(raw)
+        except VALUE_ERRORS:
+            return field.default
+
+    def raw_value(self, field, found, values):
+        if field.source:
+            return values[field.source]
+
+        elements = found[field.selector]
+        if field.many:
+            return [field.get(element) for element in elements]
+        if elements:
+            return field.get(elements[0])
+        return None
+
+
+def compile_spec(spec, name=None):
+    return Extractor(spec, name)
+
+
+def find_products(data):
+    # schema.org Product objects anywhere in a JSON-LD document (lists, @graph...)
+    if isinstance(data, list):
+        for item in data:
+            yield from find_products(item)
+    elif isinstance(data, dict):
+        types = data.get('@type')
+        if types == 'Product' or (isinstance(types, list) and 'Product' in types):
+            yield data
+        for value in data.values():
+            if isinstance(value, (list, dict)):
+                yield from find_products(value)
+
+
+def first(value):
+    return value[0] if isinstance(value, list) and value else value
+
+
+def json_ld_values(content):
+    # Values of the first Product of the JSON-LD blocks, by structured data key
+    for block in LD_JSON_PATTERN.findall(content):
+        try:
+            document = json.loads(block)
+        except ValueError:
+            continue
+        for product in find_products(document):
+            offer = first(product.get('offers')) or {}
+            rating = product.get('aggregateRating') or {}
+            return {
+                'name': product.get('name'),
+                'price': offer.get('price', offer.get('lowPrice')),
+                'availability': offer.get('availability'),
+                'rating': rating.get('ratingValue'),
+                'num_review': rating.get('reviewCount', rating.get('ratingCount')),
+            }
+    return {}
+
+
+def microdata_values(content):
+    # Microdata given in content attributes, e.g. <meta itemprop="reviewCount" content="12">
+    # as {'itemprop.reviewCount': '12'}. Like a selector, the first occurrence wins: reviews
+    # have their own ratingValue, so only the properties a page has once are reliable.
+    values = {}
+    for match in ITEMPROP_PATTERN.finditer(content):
+        key = f'itemprop.{match.group(1).decode()}'
+        if key in values:
+            continue
+        tag = content[content.rfind(b'<', 0, match.start()):content.find(b'>', match.end())]
+        value = CONTENT_PATTERN.search(tag)
+        if value is not None:
+            values[key] = value.group(1).decode('utf-8', 'replace')
+    return values
+
+
+def structured_data(content):
+    # The Product the page publishes as JSON-LD: price, rating and num_review as the text of
+    # a number (as the page would show it, the fields' post then convert it), the name with
+    # its HTML entities decoded, availability as 'in stock' / 'out of stock', keys without a
+    # usable value left out. Then the raw microdata values (microdata_values).
+    if isinstance(content, str):
+        content = content.encode()
+    data = json_ld_values(content)
+
+    values = microdata_values(content)
+    for key, convert in (('price', float), ('rating', float), ('num_review', int)):
+        try:
+            value = str(data[key]).strip()
+            convert(value)
+        except (KeyError, ValueError):
+            continue
+        values[key] = value
+    if isinstance(data.get('name'), str) and data['name'].strip():
+        values['name'] = html_entities.unescape(data['name'])
+    availability = data.get('availability')
+    if isinstance(availability, str) and availability:
+        stock = availability.rstrip('/').rsplit('/', 1)[-1].lower()
+        values['availability'] = 'in stock' if stock in ('instock', 'limitedavailability') else 'out of stock'
+    return values
+
+
+def require(fields, *names):
+    # Listings missing one of these fields are reported as failed instead of exported
+    missing = [name for name in names if fields.get(name) is None]
+    if missing:
+        raise ExtractionError(f'missing {", ".join(missing)}')
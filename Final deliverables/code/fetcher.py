@@ -0,0 +1,447 @@
+import asyncio
+import multiprocessing
+import queue
+import random
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from extraction import ExtractionError
+from metrics import METRICS
+
+# Retailers block requests made programmatically, so reuse the headers of a manual browsing session
+HEADERS = {
+    'User-Agent': (
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+        '(KHTML, like Gecko) Chrome/107.0.0.0 Safari/537.36'
+    ),
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-GB,en;q=0.9',
+}
+
+MAX_CONCURRENCY = 32
+MAX_PER_HOST = 8
+TIMEOUT = 30
+
+# Request rate per host (requests per second). Every host starts at INITIAL_RATE, the rate
+# grows by about RATE_STEP per second while the host answers quickly, and is halved on a
+# 429, a 5xx, a timeout, or when the responses get SLOW_FACTOR times slower than the
+# fastest seen (additive increase, multiplicative decrease).
+INITIAL_RATE = 10
+MIN_RATE = 0.2
+MAX_RATE = 40
+RATE_STEP = 1
+SLOW_FACTOR = 4
+# Requests that can go out at once after a quiet period
+BURST = 4
+# The requests in flight when a host starts failing fail too, the rate is only halved once
+# for all of them
+COOLDOWN = 1
+
+# Failed requests are retried after an exponential backoff with full jitter, and a host
+# asking to wait (Retry-After) is paused for at most MAX_BACKOFF seconds
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 1
+MAX_BACKOFF = 60
+
+# Parsing in processes: pages go out in batches of at most PARSE_BATCH, and at most
+# PARSE_QUEUE fetched pages wait for a free process
+PARSE_BATCH = 32
+PARSE_QUEUE = 256
+
+# One result per listing: row is None when the page was skipped or failed
+Result = namedtuple('Result', ['wine_type', 'url', 'status', 'row', 'error'])
+
+
+def backoff(attempt):
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_after(headers):
+    # Only the number of seconds form is used, HTTP dates fall back to the backoff
+    try:
+        return min(float(headers.get('Retry-After')), MAX_BACKOFF)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    # Rate limit of one host, adapted from the outcome of its requests
+
+    def __init__(self, rate=INITIAL_RATE, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.slowed_at = 0
+        self.fastest = None
+        self.latency = None
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            if wait <= 0:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    def succeeded(self, latency):
+        self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.latency > SLOW_FACTOR * self.fastest:
+            self.slow_down()
+        else:
+            self.rate = min(MAX_RATE, self.rate + RATE_STEP / self.rate)
+
+    def slow_down(self, pause=None):
+        now = time.monotonic()
+        if pause:
+            self.paused_until = max(self.paused_until, now + pause)
+        if now - self.slowed_at < COOLDOWN:
+            return
+        self.slowed_at = now
+        self.rate = max(MIN_RATE, self.rate / 2)
+        # Forget the latency history, or a single slow spell keeps halving the rate
+        self.latency = None
+
+
+class HostLimiter:
+    # At most max_per_host requests in flight per host, started at the rate of its bucket
+
+    def __init__(self, max_per_host=MAX_PER_HOST, rate=INITIAL_RATE):
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.semaphores = {}
+        self.buckets = {}
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate)
+        return self.buckets[host]
+
+    @asynccontextmanager
+    async def slot(self, url):
+        host = urlsplit(url).netloc
+        semaphore = self.semaphores.setdefault(host, asyncio.Semaphore(self.max_per_host))
+        async with semaphore:
+            bucket = self.bucket(url)
+            with METRICS.timer('rate_limit_wait_seconds', host=host):
+                await bucket.acquire()
+            yield bucket
+            METRICS.gauge('rate_limit', round(bucket.rate, 2), host=host)
+
+
+def make_session(max_concurrency=MAX_CONCURRENCY, max_per_host=MAX_PER_HOST):
+    # A single pooled session keeps connections alive between listings on the same host
+    connector = aiohttp.TCPConnector(
+        limit=max_concurrency,
+        limit_per_host=max_per_host,
+        keepalive_timeout=60,
+        ttl_dns_cache=300,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=HEADERS,
+        timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+    )
+
+
+async def fetch(session, limiter, url, cache=None):
+    host = urlsplit(url).netloc
+    headers = {}
+    entry = None
+    if cache is not None:
+        entry = cache.lookup(url)
+        if entry is not None:
+            if cache.is_fresh(entry):
+                METRICS.count('responses', host=host, status='cached')
+                return 200, cache.read(entry)
+            headers = cache.conditional_headers(entry)
+
+    async with limiter.slot(url) as bucket:
+        start = time.monotonic()
+        try:
+            async with session.get(url, headers=headers) as response:
+                content = await response.read()
+        except asyncio.TimeoutError:
+            bucket.slow_down()
+            METRICS.count('responses', host=host, status='timeout')
+            raise
+        latency = time.monotonic() - start
+
+        if response.status in RETRY_STATUSES:
+            bucket.slow_down(retry_after(response.headers))
+        elif response.status in (200, 304):
+            # Error pages are often much faster than real ones, they would skew the latency
+            bucket.succeeded(latency)
+
+    METRICS.observe('request_seconds', latency, host=host)
+    METRICS.count('responses', host=host, status=response.status)
+    METRICS.count('response_bytes', len(content), host=host)
+    if response.status == 304 and entry is not None:
+        cache.revalidate(entry)
+        return 200, cache.read(entry)
+    if cache is not None and response.status == 200:
+        cache.store(url, content, response.headers)
+    return response.status, content
+
+
+async def fetch_with_retries(session, limiter, url, cache=None):
+    # Timeouts, connection errors and RETRY_STATUSES are retried up to MAX_ATTEMPTS times,
+    # the last response (or error) is returned (or raised)
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            status, content = await fetch(session, limiter, url, cache)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == MAX_ATTEMPTS:
+                raise
+        else:
+            if status not in RETRY_STATUSES or attempt == MAX_ATTEMPTS:
+                return status, content
+        METRICS.count('retries', host=urlsplit(url).netloc)
+        await asyncio.sleep(backoff(attempt))
+
+
+async def fetch_listings(
+    listings,
+    parse,
+    max_concurrency=MAX_CONCURRENCY,
+    max_per_host=MAX_PER_HOST,
+    rate=INITIAL_RATE,
+    cache=None,
+    parse_workers=0,
+):
+    # listings: iterable of (wine_type, url) pairs as stored in data/url/*.json
+    # parse: parse(wine_type, url, content) -> dict, or None to skip the listing
+    # cache: optional cache.PageCache, pages are then revalidated with conditional GETs
+    # parse_workers: parse in that many processes instead of the event loop thread (parse
+    #   must then be a module-level function)
+    # Failures are only returned once the retries are exhausted
+    limiter = HostLimiter(max_per_host, rate)
+    results = asyncio.Queue()
+    # Pages waiting for the parser processes, the fetching waits when it is full
+    pages = asyncio.Queue(PARSE_QUEUE)
+    work = iter(listings)
+
+    async def worker(session):
+        # All workers share the same iterator, so each listing is fetched exactly once
+        for wine_type, url in work:
+            start = time.monotonic()
+            try:
+                status, content = await fetch_with_retries(session, limiter, url, cache)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                result = Result(wine_type, url, None, None, repr(e))
+                await results.put(record_outcome(result, type(e).__name__, time.monotonic() - start))
+                continue
+
+            fetch_seconds = time.monotonic() - start
+            if parse_workers and status == 200:
+                await pages.put((wine_type, url, content, fetch_seconds))
+            else:
+                await results.put(parse_page(parse, wine_type, url, status, content, fetch_seconds))
+
+    async def fetch_all(session):
+        await asyncio.gather(*(worker(session) for _ in range(max_concurrency)))
+        await pages.put(None)
+
+    async def parse_all(pool):
+        # Whatever is waiting goes out as one batch, so batches grow when the parsing falls
+        # behind. At most two batches per process are in flight.
+        loop = asyncio.get_running_loop()
+        in_flight = asyncio.Semaphore(2 * parse_workers)
+        deliveries = []
+        finished = False
+        while not finished:
+            batch = [await pages.get()]
+            while len(batch) < PARSE_BATCH and not pages.empty():
+                batch.append(pages.get_nowait())
+            if batch[-1] is None:
+                batch.pop()
+                finished = True
+            if batch:
+                await in_flight.acquire()
+                future = loop.run_in_executor(pool, parse_batch, parse, [page[:3] for page in batch])
+                deliveries.append(asyncio.create_task(deliver(batch, future, in_flight)))
+        await asyncio.gather(*deliveries)
+
+    async def deliver(batch, future, in_flight):
+        try:
+            parsed, metrics = await future
+        finally:
+            in_flight.release()
+        METRICS.merge(metrics)
+        for (wine_type, url, content, fetch_seconds), values in zip(batch, parsed):
+            await results.put(finish_page(wine_type, url, 200, len(content), fetch_seconds, values))
+
+    pool = make_pool(parse_workers) if parse_workers else None
+    try:
+        async with make_session(max_concurrency, max_per_host) as session:
+            stages = [fetch_all(session)]
+            if pool is not None:
+                stages.append(parse_all(pool))
+            pending = asyncio.gather(*stages)
+
+            while True:
+                getter = asyncio.ensure_future(results.get())
+                await asyncio.wait([getter, pending], return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                    continue
+
+                getter.cancel()
+                # Surface worker crashes instead of silently stopping
+                await pending
+                while not results.empty():
+                    yield results.get_nowait()
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def make_pool(parse_workers):
+    # Spawned rather than forked: the parent has an event loop thread and locks
+    return ProcessPoolExecutor(parse_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def failure_reason(error):
+    # The exception type, or for extraction errors the missing fields
+    return str(error) if isinstance(error, ExtractionError) else type(error).__name__
+
+
+def parse_content(parse, wine_type, url, content):
+    # Returns (row, error, failure reason, parse time)
+    start = time.perf_counter()
+    try:
+        row = parse(wine_type, url, content)
+    except Exception as e:
+        return None, repr(e), failure_reason(e), time.perf_counter() - start
+    return row, None, None, time.perf_counter() - start
+
+
+def parse_batch(parse, pages):
+    # Runs in the parser processes: pages are (wine_type, url, content). The metrics
+    # recorded meanwhile (extractor timings, skips) go back with the parsed values.
+    parsed = [parse_content(parse, *page) for page in pages]
+    return parsed, METRICS.drain()
+
+
+def record_outcome(result, reason=None, fetch_seconds=None, size=None, parse_seconds=None):
+    # Outcome counts per host and a line in the per-URL log. reason: why it failed, the
+    # error of the result by default
+    host = urlsplit(result.url).netloc
+    if result.error is None:
+        outcome = 'done' if result.row is not None else 'skipped'
+    else:
+        reason = reason or result.error
+        outcome = f'failed: {reason}'
+        METRICS.count('failures', host=host, reason=reason)
+
+    METRICS.count('listings', host=host, outcome=outcome.split(':')[0])
+    METRICS.record_url(
+        url=result.url,
+        status=result.status,
+        outcome=outcome,
+        fetch_seconds=fetch_seconds,
+        bytes=size,
+        parse_seconds=parse_seconds,
+    )
+    return result
+
+
+def finish_page(wine_type, url, status, size, fetch_seconds, parsed):
+    row, error, reason, parse_seconds = parsed
+    METRICS.observe('parse_seconds', parse_seconds, host=urlsplit(url).netloc)
+    result = Result(wine_type, url, status, row, error)
+    return record_outcome(result, reason, fetch_seconds, size, parse_seconds)
+
+
+def parse_page(parse, wine_type, url, status, content, fetch_seconds=None):
+    if status != 200:
+        result = Result(wine_type, url, status, None, f'HTTP {status}')
+        return record_outcome(result, fetch_seconds=fetch_seconds, size=len(content))
+    parsed = parse_content(parse, wine_type, url, content)
+    return finish_page(wine_type, url, status, len(content), fetch_seconds, parsed)
+
+
+def finish_batch(batch, future):
+    parsed, metrics = future.result()
+    METRICS.merge(metrics)
+    for (wine_type, url, content), values in zip(batch, parsed):
+        yield finish_page(wine_type, url, 200, len(content), None, values)
+
+
+def scrape(listings, parse, **kwargs):
+    # Synchronous wrapper so the scraper scripts can keep a plain for-loop (and tqdm).
+    # The event loop runs in a background thread and hands results over as they arrive.
+    results = queue.Queue()
+    done = object()
+
+    def run():
+        async def pump():
+            async for result in fetch_listings(listings, parse, **kwargs):
+                results.put(result)
+
+        try:
+            asyncio.run(pump())
+        except BaseException as e:
+            results.put(e)
+        results.put(done)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    while True:
+        result = results.get()
+        if result is done:
+            break
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+
+    thread.join()
+
+
+def replay(listings, parse, cache, parse_workers=0):
+    # Offline mode: run the extractors against the cached pages only, without any network
+    # I/O. With parse_workers, pages are parsed in batches in that many processes, and read
+    # at most two batches per process ahead of the results (listings that are not cached
+    # are then returned before the batches in flight).
+    pool = make_pool(parse_workers) if parse_workers else None
+    in_flight = deque()
+    batch = []
+    try:
+        for wine_type, url in listings:
+            entry = cache.lookup(url)
+            if entry is None:
+                yield record_outcome(Result(wine_type, url, None, None, 'not cached'))
+                continue
+            if pool is None:
+                yield parse_page(parse, wine_type, url, 200, cache.read(entry))
+                continue
+
+            batch.append((wine_type, url, cache.read(entry)))
+            if len(batch) == PARSE_BATCH:
+                in_flight.append((batch, pool.submit(parse_batch, parse, batch)))
+                batch = []
+                if len(in_flight) >= 2 * parse_workers:
+                    yield from finish_batch(*in_flight.popleft())
+
+        if batch:
+            in_flight.append((batch, pool.submit(parse_batch, parse, batch)))
+        while in_flight:
+            yield from finish_batch(*in_flight.popleft())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
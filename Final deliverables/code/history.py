@@ -0,0 +1,193 @@
+# Price and rating history of the listings. The scraped CSVs only hold the last run, every
+# run is also appended here as a snapshot: one row per listing and snapshot, never updated.
+# Rows are stored by listing then snapshot (WITHOUT ROWID table), so the history of a
+# listing, or its last values at some date, is a single index lookup, and the queries
+# below only read the rows they return.
+# Run from the 'Final deliverables' folder, e.g.
+#   python code/history.py import --snapshot 2022-11-20     (adds data/scrapped/*.csv)
+#   python code/history.py drops --percent 10 --since 2023-01-01
+import argparse
+import csv
+import sqlite3
+from datetime import date, datetime, time, timezone
+from pathlib import Path
+
+import pandas as pd
+
+from storage import to_float
+
+HISTORY_PATH = Path('./data/history.sqlite')
+RETAILERS = ['decantalo', 'laithwaites', 'morrissons', 'virginwines']
+
+
+def timestamp(value=None):
+    # Snapshots are UTC ISO timestamps, which sort as text. A date means the end of that
+    # day, so 'as of 2023-01-01' includes the runs of the 1st.
+    if value is None:
+        return datetime.now(timezone.utc).isoformat()
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value) if 'T' in value else date.fromisoformat(value)
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time.max, tzinfo=timezone.utc)
+    elif value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat()
+
+
+class PriceHistory:
+
+    def __init__(self, path=HISTORY_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS listings (
+                id INTEGER PRIMARY KEY,
+                retailer TEXT NOT NULL,
+                url TEXT NOT NULL,
+                name TEXT,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL,
+                UNIQUE (retailer, url)
+            );
+            CREATE TABLE IF NOT EXISTS observations (
+                listing_id INTEGER NOT NULL,
+                snapshot TEXT NOT NULL,
+                price REAL,
+                rating REAL,
+                num_review INTEGER,
+                PRIMARY KEY (listing_id, snapshot)
+            ) WITHOUT ROWID;
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def record(self, retailer, rows, snapshot=None):
+        # rows: scraped rows (dicts with url, name, price, rating, num_review), all observed
+        # at snapshot (default: now)
+        snapshot = timestamp(snapshot)
+        return self.record_fetched(retailer, ((snapshot, row) for row in rows))
+
+    def record_fetched(self, retailer, fetched_rows):
+        # fetched_rows: (fetched_at, row) pairs, every row being observed when its page was
+        # fetched, so that a run spread over several days is recorded as it happened. A
+        # listing recorded twice at the same time keeps its first values. Rows without a url
+        # (the Laithwaites mix cases only have a name) can't be told apart and are left out.
+        count = 0
+        with self.conn:
+            for fetched_at, row in fetched_rows:
+                if not row.get('url'):
+                    continue
+                snapshot = timestamp(fetched_at)
+                self.conn.execute(
+                    'INSERT INTO listings (retailer, url, name, first_seen, last_seen) '
+                    'VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (retailer, url) DO UPDATE SET '
+                    'name = excluded.name, '
+                    'first_seen = MIN(first_seen, excluded.first_seen), '
+                    'last_seen = MAX(last_seen, excluded.last_seen)',
+                    (retailer, row['url'], row.get('name'), snapshot, snapshot),
+                )
+                (listing_id,) = self.conn.execute(
+                    'SELECT id FROM listings WHERE retailer = ? AND url = ?', (retailer, row['url'])
+                ).fetchone()
+                num_review = to_float(row.get('num_review'))
+                count += self.conn.execute(
+                    'INSERT OR IGNORE INTO observations (listing_id, snapshot, price, rating, num_review) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (
+                        listing_id,
+                        snapshot,
+                        to_float(row.get('price')),
+                        to_float(row.get('rating')),
+                        None if num_review is None else int(num_review),
+                    ),
+                ).rowcount
+        return count
+
+    def series(self, retailer, url):
+        # Every snapshot of one listing, oldest first
+        return pd.read_sql_query('''
+            SELECT snapshot, price, rating, num_review
+            FROM observations
+            WHERE listing_id = (SELECT id FROM listings WHERE retailer = ? AND url = ?)
+            ORDER BY snapshot
+        ''', self.conn, params=(retailer, url))
+
+    def as_of(self, when, retailer=None):
+        # Last known values of every listing seen by then
+        return pd.read_sql_query('''
+            SELECT l.retailer, l.url, l.name, o.snapshot, o.price, o.rating, o.num_review
+            FROM listings l
+            JOIN observations o ON o.listing_id = l.id AND o.snapshot = (
+                SELECT MAX(snapshot) FROM observations
+                WHERE listing_id = l.id AND snapshot <= :when
+            )
+            WHERE l.first_seen <= :when AND (:retailer IS NULL OR l.retailer = :retailer)
+            ORDER BY l.retailer, l.url
+        ''', self.conn, params={'when': timestamp(when), 'retailer': retailer})
+
+    def price_drops(self, percent, since, retailer=None):
+        # Listings whose last price is at least percent% below their price as of since
+        return pd.read_sql_query('''
+            WITH prices AS (
+                SELECT
+                    l.retailer, l.url, l.name,
+                    (SELECT price FROM observations
+                     WHERE listing_id = l.id AND snapshot <= :since
+                     ORDER BY snapshot DESC LIMIT 1) AS price_before,
+                    (SELECT price FROM observations
+                     WHERE listing_id = l.id
+                     ORDER BY snapshot DESC LIMIT 1) AS price_now
+                FROM listings l
+                WHERE l.first_seen <= :since AND l.last_seen > :since
+                    AND (:retailer IS NULL OR l.retailer = :retailer)
+            )
+            SELECT *, 100.0 * (price_before - price_now) / price_before AS drop_percent
+            FROM prices
+            WHERE price_now <= price_before * (1 - :percent / 100.0)
+            ORDER BY drop_percent DESC
+        ''', self.conn, params={'since': timestamp(since), 'percent': percent, 'retailer': retailer})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add = commands.add_parser('import', help='add the scraped CSVs as a snapshot')
+    add.add_argument('--snapshot', help='date or timestamp of the scrape (default: now)')
+    add.add_argument('--retailer', choices=RETAILERS, action='append')
+
+    series = commands.add_parser('series', help='history of one listing')
+    series.add_argument('retailer', choices=RETAILERS)
+    series.add_argument('url')
+
+    as_of = commands.add_parser('as-of', help='last known values at a date')
+    as_of.add_argument('when')
+    as_of.add_argument('--retailer', choices=RETAILERS)
+
+    drops = commands.add_parser('drops', help='price drops since a date')
+    drops.add_argument('--percent', type=float, default=10)
+    drops.add_argument('--since', required=True)
+    drops.add_argument('--retailer', choices=RETAILERS)
+    args = parser.parse_args()
+
+    history = PriceHistory()
+    if args.command == 'import':
+        for retailer in args.retailer or RETAILERS:
+            with open(f'./data/scrapped/{retailer}_listings.csv', newline='', encoding='utf-8') as f:
+                count = history.record(retailer, csv.DictReader(f), args.snapshot)
+            print(f'{retailer}: {count} listings recorded')
+    elif args.command == 'series':
+        print(history.series(args.retailer, args.url).to_string(index=False))
+    elif args.command == 'as-of':
+        print(history.as_of(args.when, args.retailer).to_string(index=False))
+    else:
+        print(history.price_drops(args.percent, args.since, args.retailer).to_string(index=False))
+    history.close()
+
+
+if __name__ == '__main__':
+    main()
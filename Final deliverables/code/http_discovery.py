@@ -0,0 +1,108 @@
+import asyncio
+from urllib.parse import urljoin
+
+import aiohttp
+from lxml import etree
+
+from fetcher import HostLimiter, fetch_with_retries, make_session
+from parsing import make_tree
+
+# Listing pages fetched at once per category. Pages past the end come back empty, repeat
+# the last page, or are not found (END_STATUSES), which is how the end of a category is
+# detected. Any other page that fails (a first page not found, another error status, or
+# no response after the retries) fails the whole category rather than ending it, as the
+# listings of the pages after it would be missing.
+PAGES_AT_ONCE = 4
+MAX_PAGES = 500
+END_STATUSES = (404, 410)
+
+
+class DiscoveryError(ValueError):
+    pass
+
+
+def compile_links(xpath):
+    # xpath must select the href attributes of the listing links
+    return etree.XPath(xpath)
+
+
+def extract_links(content, page_url, links_xpath):
+    return [urljoin(page_url, str(href)) for href in links_xpath(make_tree(content))]
+
+
+async def discover_category(session, limiter, wine_type, category_url, page_url, links_xpath):
+    # Returns None when the first page has no listings, e.g. when they are rendered by JS
+    listing_urls = []
+    seen = set()
+
+    for first_page in range(1, MAX_PAGES + 1, PAGES_AT_ONCE):
+        page_urls = [
+            page_url(category_url, pagenum)
+            for pagenum in range(first_page, first_page + PAGES_AT_ONCE)
+        ]
+        pages = await asyncio.gather(*(fetch_with_retries(session, limiter, url) for url in page_urls))
+
+        for url, (status, content) in zip(page_urls, pages):
+            if status != 200 and not (status in END_STATUSES and listing_urls):
+                raise DiscoveryError(f'HTTP {status} for {url}')
+            links = extract_links(content, url, links_xpath) if status == 200 else []
+            new_links = [link for link in dict.fromkeys(links) if link not in seen]
+            if not new_links:
+                if not listing_urls:
+                    return None
+                print(f'Found {len(listing_urls)} {wine_type} listings')
+                return listing_urls
+
+            seen.update(new_links)
+            listing_urls.extend([wine_type, link] for link in new_links)
+
+    return listing_urls
+
+
+async def try_discover_category(session, limiter, wine_type, category_url, page_url, links_xpath):
+    # The error is returned, so that one failed category doesn't stop the others
+    try:
+        return await discover_category(session, limiter, wine_type, category_url, page_url, links_xpath)
+    except (aiohttp.ClientError, asyncio.TimeoutError, DiscoveryError) as e:
+        print(f'Discovery of the {wine_type} listings failed: {e!r}')
+        return e
+
+
+async def discover_categories(wine_type_urls, page_url, links_xpath):
+    limiter = HostLimiter()
+    async with make_session() as session:
+        results = await asyncio.gather(*(
+            try_discover_category(session, limiter, wine_type, url, page_url, links_xpath)
+            for wine_type, url in wine_type_urls.items()
+        ))
+    return dict(zip(wine_type_urls, results))
+
+
+def discover_listings_http(wine_type_urls, page_url, links_xpath, fallback=None):
+    # wine_type_urls: {wine_type: category_url}
+    # page_url(category_url, pagenum) -> URL of a listing page
+    # fallback(wine_type_urls) -> listings, used (e.g. with Selenium) for the categories
+    #   whose pages don't contain the links without running JS, or that failed
+    found = asyncio.run(discover_categories(wine_type_urls, page_url, links_xpath))
+
+    missing = {
+        wine_type: url for wine_type, url in wine_type_urls.items()
+        if found[wine_type] is None or isinstance(found[wine_type], Exception)
+    }
+    if missing:
+        if fallback is None:
+            failed = [found[wine_type] for wine_type in missing if found[wine_type] is not None]
+            raise DiscoveryError(
+                f'No listings found over HTTP for {", ".join(map(str, missing))}'
+            ) from (failed[0] if failed else None)
+        print(f'Falling back to the browser for {", ".join(map(str, missing))}')
+        for wine_type in missing:
+            found[wine_type] = []
+        for wine_type, listing_url in fallback(missing):
+            found[wine_type].append([wine_type, listing_url])
+
+    listing_urls = []
+    for wine_type in wine_type_urls:
+        listing_urls.extend(found[wine_type])
+    print(f'Found {len(listing_urls)} listings in total')
+    return listing_urls
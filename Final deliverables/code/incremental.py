@@ -0,0 +1,211 @@
+import csv
+import json
+import sqlite3
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+CHANGES_DIR = Path('./data/changes')
+# Fields compared between two fetches of the same listing. Out of stock listings have
+# price 'out of stock', so stock changes show up as price changes.
+TRACKED = ['price', 'rating', 'num_review']
+
+DAY = 24 * 60 * 60
+# Listings whose price changes at every fetch are re-fetched daily, the ones that never
+# change every two weeks
+MIN_REFETCH = DAY
+MAX_REFETCH = 14 * DAY
+# A category whose discovery finds less than this share of its active listings most likely
+# failed half-way (blocked, a page that failed, layout change...): nothing in it gets
+# delisted then. Checked per category, as one failed category is a small share of a retailer.
+MIN_DISCOVERED = 0.5
+
+
+def refetch_interval(fetch_count, change_count):
+    # Share of the fetches that found a change, smoothed so that one fetch is not enough
+    # to put a listing on the daily or the two-weekly schedule
+    change_rate = (change_count + 1) / (fetch_count + 2)
+    return MAX_REFETCH - (MAX_REFETCH - MIN_REFETCH) * change_rate
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class ListingState:
+    # Latest known row and re-fetch schedule of every listing ever discovered for one
+    # retailer, and the log of the changes found between fetches
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS listings (
+                url TEXT PRIMARY KEY,
+                wine_type TEXT,
+                status TEXT NOT NULL,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                last_fetched REAL,
+                next_due REAL NOT NULL,
+                fetch_count INTEGER NOT NULL DEFAULT 0,
+                change_count INTEGER NOT NULL DEFAULT 0,
+                row TEXT
+            );
+            CREATE INDEX IF NOT EXISTS listings_due ON listings (status, next_due);
+            CREATE TABLE IF NOT EXISTS changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                wine_type TEXT,
+                field TEXT NOT NULL,
+                old TEXT,
+                new TEXT,
+                detected_at TEXT NOT NULL
+            );
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def log_change(self, url, wine_type, field, old, new):
+        change = {
+            'url': url,
+            'wine_type': wine_type,
+            'field': field,
+            'old': old,
+            'new': new,
+            'detected_at': now_iso(),
+        }
+        self.conn.execute(
+            'INSERT INTO changes (url, wine_type, field, old, new, detected_at) '
+            'VALUES (:url, :wine_type, :field, :old, :new, :detected_at)',
+            change,
+        )
+        return change
+
+    def sync(self, listings):
+        # Diff freshly discovered listings against the known ones: new listings are due
+        # straight away, relisted ones too, and the active ones not found any more are
+        # marked as delisted. Returns the changes.
+        now = time.time()
+        # The same URL can be listed under several wine types, the first one is kept
+        discovered = {}
+        for wine_type, url in listings:
+            discovered.setdefault(url, wine_type)
+
+        known = {}
+        # Active listings per category (the wine type they were first discovered under)
+        active = {}
+        for url, wine_type, status in self.conn.execute('SELECT url, wine_type, status FROM listings'):
+            known[url] = status
+            if status == 'active':
+                active.setdefault(wine_type, []).append(url)
+        changes = []
+
+        with self.conn:
+            for url, wine_type in discovered.items():
+                status = known.get(url)
+                if status is None:
+                    self.conn.execute(
+                        'INSERT INTO listings (url, wine_type, status, first_seen, last_seen, next_due) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (url, wine_type, 'active', now, now, now),
+                    )
+                    changes.append(self.log_change(url, wine_type, 'status', None, 'active'))
+                    continue
+
+                if status == 'delisted':
+                    self.conn.execute(
+                        'UPDATE listings SET next_due = ? WHERE url = ?', (now, url)
+                    )
+                    changes.append(self.log_change(url, wine_type, 'status', 'delisted', 'active'))
+                self.conn.execute(
+                    "UPDATE listings SET status = 'active', last_seen = ? WHERE url = ?",
+                    (now, url),
+                )
+
+            found = {}
+            for wine_type, url in set(listings):
+                found[wine_type] = found.get(wine_type, 0) + 1
+            for wine_type, urls in active.items():
+                missing = [url for url in urls if url not in discovered]
+                if missing and found.get(wine_type, 0) < MIN_DISCOVERED * len(urls):
+                    print(
+                        f'Only {found.get(wine_type, 0)} {wine_type} listings discovered for {len(urls)} '
+                        f'active ones, not marking {len(missing)} listings as delisted'
+                    )
+                    continue
+                for url in missing:
+                    changes.extend(self.delist(url))
+        return changes
+
+    def delist(self, url):
+        (wine_type,) = self.conn.execute(
+            'SELECT wine_type FROM listings WHERE url = ?', (url,)
+        ).fetchone()
+        self.conn.execute("UPDATE listings SET status = 'delisted' WHERE url = ?", (url,))
+        return [self.log_change(url, wine_type, 'status', 'active', 'delisted')]
+
+    def due(self):
+        # Most overdue first, so an interrupted run has fetched the most urgent listings
+        cursor = self.conn.execute(
+            "SELECT wine_type, url FROM listings WHERE status = 'active' AND next_due <= ? "
+            'ORDER BY next_due',
+            (time.time(),),
+        )
+        return cursor.fetchall()
+
+    def record(self, result):
+        # result is a fetcher.Result. Returns the changes found since the previous fetch.
+        if result.status in (404, 410):
+            with self.conn:
+                return self.delist(result.url)
+        if result.error:
+            # Still due, it will be retried by the next run
+            return []
+
+        fetch_count, change_count, previous = self.conn.execute(
+            'SELECT fetch_count, change_count, row FROM listings WHERE url = ?', (result.url,)
+        ).fetchone()
+        # Round trip through JSON so both rows compare the same way
+        row = None if result.row is None else json.loads(json.dumps(result.row))
+
+        changes = []
+        with self.conn:
+            if previous is not None and row is not None:
+                previous = json.loads(previous)
+                for field in TRACKED:
+                    if previous.get(field) != row.get(field):
+                        changes.append(self.log_change(
+                            result.url, result.wine_type, field, previous.get(field), row.get(field)
+                        ))
+
+            fetch_count += 1
+            change_count += bool(changes)
+            now = time.time()
+            self.conn.execute(
+                'UPDATE listings SET last_fetched = ?, next_due = ?, fetch_count = ?, '
+                'change_count = ?, row = COALESCE(?, row) WHERE url = ?',
+                (
+                    now,
+                    now + refetch_interval(fetch_count, change_count),
+                    fetch_count,
+                    change_count,
+                    None if row is None else json.dumps(row),
+                    result.url,
+                ),
+            )
+        return changes
+
+    def summary(self):
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM listings GROUP BY status'))
+
+
+def write_change_log(changes, path):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['detected_at', 'url', 'wine_type', 'field', 'old', 'new'])
+        writer.writeheader()
+        writer.writerows(changes)
@@ -0,0 +1,232 @@
+# Links the listings of the same wine across retailers. Listings are only compared within
+# their block (same country, wine type, vintage and bottle size). Names are compared
+# token by token, each token weighted by how rare it is (a shared producer name counts,
+# a shared 'Sauvignon Blanc' hardly does). Candidates come from an inverted index of the
+# tokens, and only the postings of the rarest tokens of a name are read: a listing that
+# shares none of them cannot reach the threshold.
+# Matched listings share a wine_id in data/matches.sqlite, and new listings are matched
+# against the stored ones without re-matching everything.
+# Run from the 'Final deliverables' folder:
+#   python code/matching.py                  (adds the listings of all_retailers.csv)
+import argparse
+import math
+import re
+import sqlite3
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import pandas as pd
+
+from normalisation import normalise_country, normalise_wine_type
+
+MATCHES_PATH = Path('./data/matches.sqlite')
+# Weighted token similarity (0 to 1) from which two listings are the same wine. Below it
+# the matches are mostly different wines of the same producer or grape
+THRESHOLD = 0.84
+
+# Words that don't tell wines apart
+STOP_WORDS = {
+    'and', 'box', 'de', 'del', 'di', 'du', 'el', 'et', 'gift', 'in', 'la', 'le', 'les',
+    'nv', 'of', 'the', 'vino', 'wine', 'wines', 'y',
+}
+YEAR_PATTERN = re.compile(r'^(19|20)\d\d$')
+SIZE_PATTERN = re.compile(r'^\d+(cl|ml|l)$')
+
+
+def name_tokens(name):
+    # 'Château Musar 2015 75cl' -> {'chateau', 'musar'}: vintages and sizes are left out,
+    # they are part of the block already
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode().lower()
+    return {
+        token for token in re.findall(r'[a-z0-9]+', name)
+        if token not in STOP_WORDS
+        and not YEAR_PATTERN.match(token)
+        and not SIZE_PATTERN.match(token)
+    }
+
+
+def vintage(year):
+    try:
+        return str(int(float(year)))
+    except (TypeError, ValueError):
+        return 'NV'
+
+
+def block_key(country, wine_type, year, size):
+    try:
+        size = f'{float(size):g}'
+    except (TypeError, ValueError):
+        size = '75'
+    return '|'.join([
+        normalise_country(country) or 'unknown',
+        normalise_wine_type(wine_type) or 'unknown',
+        vintage(year),
+        size,
+    ])
+
+
+class MatchIndex:
+    # In-memory inverted index (block -> token -> listings) over the listings stored in
+    # the match database, which holds the wine_id of every listing and the matched pairs
+
+    def __init__(self, path=MATCHES_PATH, threshold=THRESHOLD):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.threshold = threshold
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS listings (
+                id INTEGER PRIMARY KEY,
+                retailer TEXT NOT NULL,
+                url TEXT NOT NULL,
+                name TEXT NOT NULL,
+                block TEXT NOT NULL,
+                wine_id INTEGER NOT NULL,
+                UNIQUE (retailer, url)
+            );
+            CREATE INDEX IF NOT EXISTS listings_wine_id ON listings (wine_id);
+            CREATE TABLE IF NOT EXISTS matches (
+                listing_id INTEGER NOT NULL,
+                match_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (listing_id, match_id)
+            );
+        ''')
+
+        self.postings = defaultdict(lambda: defaultdict(list))
+        # Number of listings with each token, for the token weights
+        self.document_frequency = Counter()
+        self.tokens = {}
+        self.retailers = {}
+        self.wine_ids = {}
+        self.members = defaultdict(list)
+        cursor = self.conn.execute('SELECT id, retailer, name, block, wine_id FROM listings')
+        for listing_id, retailer, name, block, wine_id in cursor:
+            self.index(listing_id, retailer, name_tokens(name), block, wine_id)
+
+    def close(self):
+        self.conn.close()
+
+    def index(self, listing_id, retailer, tokens, block, wine_id):
+        self.tokens[listing_id] = tokens
+        self.retailers[listing_id] = retailer
+        self.wine_ids[listing_id] = wine_id
+        self.members[wine_id].append(listing_id)
+        self.document_frequency.update(tokens)
+        postings = self.postings[block]
+        for token in tokens:
+            postings[token].append(listing_id)
+
+    def weight(self, token):
+        # Inverse document frequency, tokens not seen yet count as seen once
+        return math.log(1 + len(self.tokens) / max(self.document_frequency[token], 1))
+
+    def candidates(self, block, tokens, retailer):
+        # Best scoring listing of every other retailer
+        postings = self.postings.get(block)
+        if not postings or not tokens:
+            return []
+
+        weights = {token: self.weight(token) for token in tokens}
+        total = sum(weights.values())
+        # A match needs a shared weight of at least threshold / (2 - threshold) of this
+        # name's total, so it shares at least one of the rare tokens that make up the rest
+        needed = self.threshold / (2 - self.threshold) * total
+        remaining = total
+        candidate_ids = set()
+        for token in sorted(tokens, key=weights.get, reverse=True):
+            if remaining < needed:
+                break
+            candidate_ids.update(postings.get(token, ()))
+            remaining -= weights[token]
+
+        best = {}
+        for listing_id in candidate_ids:
+            other = self.retailers[listing_id]
+            if other == retailer:
+                continue
+            other_tokens = self.tokens[listing_id]
+            shared = sum(weights[token] for token in tokens & other_tokens)
+            other_total = sum(self.weight(token) for token in other_tokens)
+            score = 2 * shared / (total + other_total)
+            if score >= self.threshold and score > best.get(other, (None, 0))[1]:
+                best[other] = (listing_id, score)
+        return list(best.values())
+
+    def merge(self, wine_id, other_wine_id):
+        # The group keeps the smallest wine_id
+        keep, drop = sorted([wine_id, other_wine_id])
+        if keep != drop:
+            self.conn.execute('UPDATE listings SET wine_id = ? WHERE wine_id = ?', (keep, drop))
+            for listing_id in self.members.pop(drop, []):
+                self.wine_ids[listing_id] = keep
+                self.members[keep].append(listing_id)
+        return keep
+
+    def add(self, listings):
+        # listings: rows with retailer, url, name, country, wine_type, year and size(cL).
+        # Listings already in the index are skipped. Returns the number of new matches.
+        known = set(self.conn.execute('SELECT retailer, url FROM listings'))
+        new_matches = 0
+
+        with self.conn:
+            for listing in listings:
+                key = (listing['retailer'], listing['url'])
+                if key in known or not isinstance(listing['name'], str):
+                    continue
+                known.add(key)
+
+                block = block_key(
+                    listing['country'], listing['wine_type'], listing['year'], listing.get('size(cL)')
+                )
+                tokens = name_tokens(listing['name'])
+                matches = self.candidates(block, tokens, listing['retailer'])
+
+                listing_id = self.conn.execute(
+                    'INSERT INTO listings (retailer, url, name, block, wine_id) VALUES (?, ?, ?, ?, 0)',
+                    (*key, listing['name'], block),
+                ).lastrowid
+                wine_id = listing_id
+                for match_id, score in matches:
+                    self.conn.execute(
+                        'INSERT INTO matches (listing_id, match_id, score) VALUES (?, ?, ?)',
+                        (listing_id, match_id, score),
+                    )
+                    wine_id = self.merge(wine_id, self.wine_ids[match_id])
+                self.conn.execute('UPDATE listings SET wine_id = ? WHERE id = ?', (wine_id, listing_id))
+                self.index(listing_id, listing['retailer'], tokens, block, wine_id)
+                new_matches += len(matches)
+        return new_matches
+
+    def groups(self):
+        # Listings sold by more than one retailer, with their wine_id
+        return pd.read_sql_query('''
+            SELECT wine_id, retailer, url, name FROM listings
+            WHERE wine_id IN (
+                SELECT wine_id FROM listings GROUP BY wine_id HAVING COUNT(DISTINCT retailer) > 1
+            )
+            ORDER BY wine_id, retailer
+        ''', self.conn)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default='./data/all_retailers.csv')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    data = pd.read_csv(args.input, index_col=0)
+    start = time.perf_counter()
+    index = MatchIndex(threshold=args.threshold)
+    new_matches = index.add(data.to_dict('records'))
+    groups = index.groups()
+    print(
+        f'{new_matches} new matches in {time.perf_counter() - start:.1f}s, '
+        f'{groups["wine_id"].nunique()} wines sold by more than one retailer'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import csv
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+
+# Counters and timings of a scrape run: request latency and bytes per host, parse time
+# per extractor field, skip and failure reasons, and one line per URL. Everything goes
+# into the module-level METRICS, which the runner prints and writes to data/metrics/ as
+# JSON, Prometheus text format and a per-URL CSV at the end of the run.
+
+METRICS_DIR = Path('./data/metrics')
+# Upper bounds (seconds) of the histogram buckets of the timings
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+URL_COLUMNS = ['url', 'status', 'outcome', 'fetch_seconds', 'bytes', 'parse_seconds']
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'buckets': dict(zip([*map(str, BUCKETS), '+Inf'], self.buckets)),
+        }
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    return ','.join(f'{name}="{escape(value)}"' for name, value in labels)
+
+
+class Metrics:
+    # Shared by the event loop thread of the fetcher and the main thread
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+        self.urls = []
+
+    def count(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            if key not in self.timings:
+                self.timings[key] = Timing()
+            self.timings[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def drain(self):
+        # Counters, gauges and timings recorded since the last drain, e.g. in a parser
+        # process, to be merged into the metrics of the main process
+        with self.lock:
+            drained = self.counters, self.gauges, self.timings
+            self.counters, self.gauges, self.timings = {}, {}, {}
+        return drained
+
+    def merge(self, drained):
+        counters, gauges, timings = drained
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(gauges)
+            for key, timing in timings.items():
+                if key not in self.timings:
+                    self.timings[key] = Timing()
+                self.timings[key].merge(timing)
+
+    def record_url(self, **values):
+        with self.lock:
+            self.urls.append(values)
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'elapsed_seconds': self.elapsed(),
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'gauges': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.gauges.items())
+                ],
+                'timings': [
+                    {'name': name, 'labels': dict(labels), **timing.to_dict()}
+                    for (name, labels), timing in sorted(self.timings.items())
+                ],
+            }
+
+    def to_prometheus(self):
+        lines = [f'scrape_elapsed_seconds {self.elapsed():.3f}']
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'scrape_{name}_total{{{format_labels(labels)}}} {value}')
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f'scrape_{name}{{{format_labels(labels)}}} {value}')
+            for (name, labels), timing in sorted(self.timings.items()):
+                cumulative = 0
+                for bound, count in zip([*map(str, BUCKETS), '+Inf'], timing.buckets):
+                    cumulative += count
+                    bucket_labels = format_labels((*labels, ('le', bound)))
+                    lines.append(f'scrape_{name}_bucket{{{bucket_labels}}} {cumulative}')
+                lines.append(f'scrape_{name}_sum{{{format_labels(labels)}}} {timing.total:.6f}')
+                lines.append(f'scrape_{name}_count{{{format_labels(labels)}}} {timing.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, stem):
+        # stem.json, stem.prom and stem_urls.csv
+        stem = Path(stem)
+        stem.parent.mkdir(parents=True, exist_ok=True)
+        with open(stem.with_suffix('.json'), 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        with open(stem.with_suffix('.prom'), 'w') as f:
+            f.write(self.to_prometheus())
+        with open(stem.parent / f'{stem.name}_urls.csv', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=URL_COLUMNS)
+            writer.writeheader()
+            with self.lock:
+                writer.writerows(self.urls)
+
+    def summary(self):
+        # Time spent in each stage, to see which one limits the throughput
+        elapsed = self.elapsed()
+        with self.lock:
+            pages = len(self.urls)
+            lines = [f'{pages} pages in {elapsed:.1f}s ({pages / elapsed:.1f} pages/s)']
+            lines.append(f'  {"stage":<48}{"count":>8}{"total s":>10}{"mean ms":>10}{"max ms":>10}')
+            for (name, labels), timing in sorted(self.timings.items()):
+                stage = ' '.join([name, *(str(value) for _, value in labels)])
+                lines.append(
+                    f'  {stage:<48}{timing.count:>8}{timing.total:>10.2f}'
+                    f'{1000 * timing.total / timing.count:>10.2f}{1000 * timing.max:>10.1f}'
+                )
+            for (name, labels), value in sorted({**self.counters, **self.gauges}.items()):
+                lines.append(f'  {name} {format_labels(labels)}: {value:g}')
+        return '\n'.join(lines)
+
+
+METRICS = Metrics()
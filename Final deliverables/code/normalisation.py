@@ -0,0 +1,208 @@
+import difflib
+import re
+from functools import lru_cache
+
+import pandas as pd
+import pycountry
+
+# Country and wine type names as used in the merged dataset, from the names used by the
+# retailers. Names that are not in the tables go through a fuzzy match against them
+# (cached, so each distinct name is only matched once); names that match nothing give None.
+#
+# Columns are normalised as categoricals: only the distinct values are looked up, then the
+# category codes are remapped, so the cost does not grow with the number of rows.
+
+COUNTRIES = {
+    ': Portugal': 'Portugal',
+    'Argentina': 'Argentina',
+    'Australia': 'Australia',
+    'Austria': 'Austria',
+    'British': 'UK',
+    'Bulgaria': 'Bulgaria',
+    'Canada': 'Canada',
+    'Chile': 'Chile',
+    'Croatia': 'Croatia',
+    'Czech Republic': 'Czech Republic',
+    'England': 'UK',
+    'France': 'France',
+    'Georgia': 'Georgia',
+    'Germany': 'Germany',
+    'Great Britain': 'UK',
+    'Greece': 'Greece',
+    'Hungary': 'Hungary',
+    'Israel': 'Israel',
+    'Italy': 'Italy',
+    'Lebanon': 'Lebanon',
+    'Moldova': 'Moldova',
+    'Moldova (Republic Of)': 'Moldova',
+    'Multiple Countries': 'Multiple Countries',
+    'New Zealand': 'New Zealand',
+    'Peru': 'Peru',
+    'Portugal': 'Portugal',
+    'Produce of the EU': 'EU',
+    'Romania': 'Romania',
+    'Scotland': 'UK',
+    'Slovenia': 'Slovenia',
+    'South Africa': 'South Africa',
+    'Spain': 'Spain',
+    'Turkey': 'Turkey',
+    'U': 'USA',
+    'USA': 'USA',
+    'United Kingdom': 'UK',
+    'United States': 'USA',
+    'United States of America': 'USA',
+    'Uruguay': 'Uruguay',
+    'Wales': 'UK',
+    'unknown': 'unknown',
+}
+
+# Some listings give the region instead of the country
+REGIONS = {
+    'Alsace': 'France',
+    'Barossa Valley': 'Australia',
+    'Bordeaux': 'France',
+    'Burgundy': 'France',
+    'Cahors': 'France',
+    'California': 'USA',
+    'Champagne': 'France',
+    'Douro': 'Portugal',
+    'Hawkes Bay': 'New Zealand',
+    'Loire': 'France',
+    'Marlborough': 'New Zealand',
+    'Mendoza': 'Argentina',
+    'Napa Valley': 'USA',
+    'Oregon': 'USA',
+    'Piedmont': 'Italy',
+    'Rhone': 'France',
+    'Rioja': 'Spain',
+    'Sicily': 'Italy',
+    'Stellenbosch': 'South Africa',
+    'Tuscany': 'Italy',
+    'Valle Central': 'Chile',
+    'Washington State': 'USA',
+    'Western Australia': 'Australia',
+    'Western Cape': 'South Africa',
+    'the Island of Madeira': 'Portugal',
+}
+
+# ISO codes of the names above that pycountry doesn't know (or knows under another name)
+COUNTRY_CODE_ALIASES = {
+    'Czech Republic': 'CZE',
+    'Moldova': 'MDA',
+    'Turkey': 'TUR',
+    'UK': 'GBR',
+    'USA': 'USA',
+}
+
+WINE_TYPES = {
+    'Dessert': 'Other',
+    'Dessert Wine': 'Other',
+    'Fortified': 'Other',
+    'Low / Alcohol Free Wines': 'Other',
+    'Red': 'Red',
+    'Red Wine': 'Red',
+    'Rose Wine': 'Rose',
+    'Rosé': 'Rose',
+    'Sherry': 'Other',
+    'Sparkling': 'Sparkling',
+    'White': 'White',
+    'White Wine': 'White',
+    'fortified and sherry': 'Other',
+    'fortified_and_other': 'Other',
+    'orange': 'Other',
+    'red': 'Red',
+    'rose': 'Rose',
+    'sparkling': 'Sparkling',
+    'sweet': 'Other',
+    'vermouth': 'Other',
+    'white': 'White',
+}
+
+# Fuzzy matches below this similarity (0 to 1) are not trusted
+FUZZY_CUTOFF = 0.85
+
+
+def simplify(name):
+    # 'Rosé Wine', ': Portugal' and 'rose_wine' all become 'rose wine' / 'portugal'
+    name = name.lower().replace('é', 'e')
+    return re.sub(r'[^a-z]+', ' ', name).strip()
+
+
+def remap(values, resolve):
+    # Vectorised lookup: resolve() runs once per distinct value (and once for the missing
+    # values), then the category codes are remapped
+    categorical = values.astype('category')
+    resolved = [resolve(value) for value in categorical.cat.categories] + [resolve(None)]
+    categories = pd.Index([value for value in dict.fromkeys(resolved) if value is not None])
+
+    # Missing values have code -1, which picks the last entry
+    codes = categories.get_indexer(resolved)[categorical.cat.codes.to_numpy()]
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories), index=values.index, name=values.name
+    )
+
+
+class AliasTable:
+    # Exact lookup first, then the simplified name, then the closest simplified alias
+
+    def __init__(self, aliases):
+        self.aliases = aliases
+        self.simplified = {simplify(alias): value for alias, value in aliases.items()}
+        self.resolve = lru_cache(maxsize=None)(self.lookup)
+
+    def lookup(self, name):
+        if not isinstance(name, str):
+            return None
+        if name in self.aliases:
+            return self.aliases[name]
+        key = simplify(name)
+        if key in self.simplified:
+            return self.simplified[key]
+        matches = difflib.get_close_matches(key, self.simplified, n=1, cutoff=FUZZY_CUTOFF)
+        return self.simplified[matches[0]] if matches else None
+
+    def remap(self, values):
+        return remap(values, self.resolve)
+
+
+def country_code_aliases():
+    # Built once at import: every name pycountry knows, then the names of the tables above
+    codes = {}
+    for country in pycountry.countries:
+        for attribute in ('name', 'common_name', 'official_name'):
+            name = getattr(country, attribute, None)
+            if name:
+                codes[name] = country.alpha_3
+    codes.update(COUNTRY_CODE_ALIASES)
+    return codes
+
+
+COUNTRY_TABLE = AliasTable({**REGIONS, **COUNTRIES})
+WINE_TYPE_TABLE = AliasTable(WINE_TYPES)
+COUNTRY_CODES = country_code_aliases()
+
+
+def normalise_country(country):
+    return COUNTRY_TABLE.resolve(country)
+
+
+def normalise_wine_type(wine_type):
+    return WINE_TYPE_TABLE.resolve(wine_type)
+
+
+@lru_cache(maxsize=None)
+def country_code(country):
+    # Raw names are normalised first, so 'United States' and 'California' give USA too
+    return COUNTRY_CODES.get(normalise_country(country) or country, 'unknown')
+
+
+def normalise_countries(countries):
+    return COUNTRY_TABLE.remap(countries)
+
+
+def normalise_wine_types(wine_types):
+    return WINE_TYPE_TABLE.remap(wine_types)
+
+
+def country_codes(countries):
+    return remap(countries, country_code)
@@ -0,0 +1,38 @@
+import os
+
+import lxml.html
+from bs4 import BeautifulSoup
+from lxml.cssselect import CSSSelector
+
+# Tree builder used by BeautifulSoup. 'lxml' builds the same soup faster than the pure
+# Python 'html.parser', so the get_* extractors work unchanged on top of it.
+# Set SOUP_BACKEND=html.parser to go back to the old behaviour.
+BACKEND = os.environ.get('SOUP_BACKEND', 'lxml')
+
+# All the retailers serve UTF-8. Without this, lxml falls back to latin-1 for pages that
+# don't declare their charset and '£' comes out as 'Â£'.
+HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+
+def make_soup(content, backend=None):
+    return BeautifulSoup(content, backend or BACKEND)
+
+
+def make_tree(content):
+    # Native lxml tree, for the extraction specs and the compiled selectors below
+    return lxml.html.fromstring(content, parser=HTML_PARSER)
+
+
+def compile_selectors(selectors):
+    # CSS selectors are translated to XPath once, at import time of the retailer module
+    return {name: CSSSelector(selector) for name, selector in selectors.items()}
+
+
+def select_first(tree, selector):
+    matches = selector(tree)
+    return matches[0] if matches else None
+
+
+def select_text(tree, selector):
+    element = select_first(tree, selector)
+    return None if element is None else element.text_content()
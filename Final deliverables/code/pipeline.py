@@ -0,0 +1,312 @@
+# Scrape-to-merge in one pass: listings are turned into rows of the merged dataset one at
+# a time, as they come out of the fetcher, instead of going through the scraped CSVs, the
+# clean_*.ipynb notebooks and the merge notebook. Memory use does not depend on the size
+# of the catalogues, and the output file grows while the crawl is running.
+# Run from the 'Final deliverables' folder, e.g.
+#   python code/pipeline.py --retailer virginwines
+#   python code/pipeline.py --source csv        (from the CSVs in data/scrapped/)
+import argparse
+import csv
+import math
+from datetime import date
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cache import PageCache
+from canonical import CanonicalIndex
+from cleaning import BOTTLE_SIZE, MIN_REVIEWS, YEARS_TO_DROP
+from cube import CUBE_PATH, AggregateCube
+from fetcher import replay, scrape
+from normalisation import country_code, normalise_country, normalise_wine_type
+from quality import QUARANTINE_DIR, QuarantineSink, compile_rules
+from runner import enriched, load_listings
+from storage import CATEGORY, MERGED_SCHEMA, to_float
+
+OUTPUT_DIR = Path('./data/pipeline')
+# Same columns as all_retailers.csv
+COLUMNS = [
+    'name', 'abv', 'year', 'size(cL)', 'country', 'wine_type', 'price', 'num_review',
+    'rating', 'url', 'countrycode', 'scaled_price', 'logprice', 'price_fixed', 'age',
+    'score', 'retailer',
+]
+# Rows per Parquet row group
+BATCH_SIZE = 10000
+# Rows checked by the quality rules at a time, small enough for the output to keep up
+# with the crawl
+CHECK_SIZE = 256
+
+
+def to_year(value):
+    year = to_float(value)
+    if year is not None:
+        return int(year)
+    if value in ('NV', 'Non Vintage'):
+        return 'NV'
+    # Laithwaites cases get a word of their name as the year, dropped by clean()
+    return value or None
+
+
+def unify(retailer, row):
+    # Shared shape for the four retailers: sizes in cL and numbers as numbers
+    if 'size' in row:
+        # Laithwaites gives sizes in ml
+        size = to_float(row['size'])
+        size = None if size is None else size / 10
+    else:
+        size = to_float(row.get('size (cL)'))
+
+    return {
+        'retailer': retailer,
+        'name': row.get('name'),
+        'wine_type': row.get('wine_type'),
+        'country': row.get('country') or None,
+        'size(cL)': size,
+        'price': to_float(row.get('price')),
+        'abv': to_float(row.get('abv')),
+        'year': to_year(row.get('year')),
+        'rating': to_float(row.get('rating')),
+        'num_review': to_float(row.get('num_review')),
+        'url': row.get('url'),
+        'mix_case': bool(to_float(row.get('Mix Case?'))),
+        # For the quality rules, e.g. 'out of stock'
+        'raw_price': row.get('price'),
+    }
+
+
+def clean(record):
+    # Record by record version of the cleaning.clean_* functions, None drops the listing
+    retailer = record['retailer']
+    if retailer == 'laithwaites':
+        # Mix cases are dropped because their bottles are listed on their own too
+        if record['mix_case'] or record['year'] in YEARS_TO_DROP:
+            return None
+    elif retailer in ('decantalo', 'morrissons'):
+        # The few listings without ABV are dropped (ABVs > 100 are quarantined by the
+        # quality rules)
+        if record['abv'] is None:
+            return None
+    del record['mix_case']
+    del record['raw_price']
+
+    if record['country'] is None:
+        record['country'] = 'unknown'
+    if record['size(cL)'] is None:
+        # The most frequent size, that the notebooks impute
+        record['size(cL)'] = BOTTLE_SIZE
+    return record
+
+
+def normalise(record):
+    record['country'] = normalise_country(record['country'])
+    record['wine_type'] = normalise_wine_type(record['wine_type'])
+    return record
+
+
+def add_features(record, scrape_year):
+    price = record['price']
+    scaled_price = None if price is None else price * BOTTLE_SIZE / record['size(cL)']
+    num_review = record['num_review']
+    year = record['year']
+
+    record['countrycode'] = country_code(record['country'])
+    record['scaled_price'] = scaled_price
+    record['logprice'] = math.log10(scaled_price) if scaled_price else None
+    record['price_fixed'] = price
+    record['age'] = scrape_year - year if isinstance(year, int) else None
+    record['score'] = record['rating'] if num_review is not None and num_review > MIN_REVIEWS else 0
+    return record
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def process(rows, scrape_year=None, validator=None, quarantine=None):
+    # rows: (retailer, scraped row) pairs, yields rows of the merged dataset. Rows are
+    # checked by the quality rules of the validator (quality.py) CHECK_SIZE at a time,
+    # those breaking one go to quarantine(record, reasons) instead.
+    scrape_year = scrape_year or date.today().year
+    validator = validator or compile_rules()
+    for batch in batches(rows, CHECK_SIZE):
+        records = [unify(retailer, row) for retailer, row in batch]
+        quarantined, reasons = validator.check(records)
+        reasons = iter(reasons)
+        for record, bad in zip(records, quarantined):
+            if bad:
+                if quarantine is not None:
+                    quarantine(record, next(reasons))
+                continue
+            record = clean(record)
+            if record is not None:
+                yield add_features(normalise(record), scrape_year)
+
+
+class CsvSink:
+    # Every row is flushed, so the file can be read while the pipeline runs
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, record):
+        self.writer.writerow(record)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    # Rows are buffered and written a row group at a time, with the types of storage.py
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.schema = MERGED_SCHEMA.append(pa.field('retailer', CATEGORY))
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.batch = []
+
+    def write(self, record):
+        year = record['year']
+        self.batch.append(dict(
+            record,
+            year=year if isinstance(year, int) else None,
+            non_vintage=year == 'NV',
+        ))
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_table(pa.Table.from_pylist(self.batch, schema=self.schema))
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class CubeSink:
+    # Rows go to the aggregate cube of cube.py a batch at a time. The cube must have been
+    # built first ('python code/cube.py build'), as its bucket edges (price deciles...) need
+    # the full dataset, not the first batch of rows
+
+    def __init__(self, path=CUBE_PATH):
+        self.cube = AggregateCube(path)
+        if not self.cube.edges:
+            self.cube.close()
+            raise ValueError(f'No aggregate cube in {path}, build it first with python code/cube.py build')
+        self.batch = []
+
+    def write(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.cube.update(pd.DataFrame(self.batch, columns=COLUMNS))
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.cube.close()
+
+
+def scraped_rows(retailer, module, source, cache, parse_workers=0):
+    if source == 'csv':
+        with open(f'./data/scrapped/{retailer}_listings.csv', newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                yield retailer, row
+        return
+
+    index = CanonicalIndex(load_listings(module.listing_urls_path, module.discover_listings))
+    if source == 'replay':
+        results = replay(index.fetches(), module.parse_listing, cache, parse_workers)
+    else:
+        results = scrape(index.fetches(), module.parse_listing, cache=cache, parse_workers=parse_workers)
+
+    # The enrich step of a script (the Decantalo reviews), so that the rows get what the
+    # script's own CSV would have. As in run_scraper, the replay leaves it out.
+    results = index.fan_out(results)
+    enrich = getattr(module, 'enrich', None)
+    if enrich is not None and source != 'replay':
+        results = enriched(results, enrich, cache)
+    for result in results:
+        if result.error:
+            print(f'Failed {result.url}: {result.error}')
+        elif result.row is not None:
+            yield retailer, result.row
+
+
+def main():
+    import scrape_decantalo
+    import scrape_laithwaites
+    import scrape_morrissons
+    import scrape_virginwines
+
+    retailers = {
+        'decantalo': scrape_decantalo,
+        'laithwaites': scrape_laithwaites,
+        'morrissons': scrape_morrissons,
+        'virginwines': scrape_virginwines,
+    }
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--retailer', choices=retailers, action='append')
+    parser.add_argument(
+        '--source',
+        choices=['scrape', 'replay', 'csv'],
+        default='scrape',
+        help='fetch the listings, re-parse the cached pages or read data/scrapped/',
+    )
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--scrape-year', type=int, help='year the ages are counted from')
+    parser.add_argument('--parse-workers', type=int, default=0, help='parse the pages in that many processes')
+    parser.add_argument('--cube', action='store_true', help='also update the aggregate cube (cube.py)')
+    args = parser.parse_args()
+
+    cube_sinks = []
+    if args.cube:
+        try:
+            cube_sinks.append(CubeSink())
+        except ValueError as e:
+            parser.error(str(e))
+
+    cache = PageCache()
+    path = OUTPUT_DIR / f'all_retailers.{args.format}'
+    sinks = [CsvSink(path) if args.format == 'csv' else ParquetSink(path), *cube_sinks]
+
+    def rows():
+        for retailer in args.retailer or retailers:
+            yield from scraped_rows(retailer, retailers[retailer], args.source, cache, args.parse_workers)
+
+    validator = compile_rules()
+    quarantine = QuarantineSink(QUARANTINE_DIR / f'{path.stem}_{date.today()}.csv')
+    count = 0
+    try:
+        for record in process(rows(), args.scrape_year, validator, quarantine.write):
+            for sink in sinks:
+                sink.write(record)
+            count += 1
+    finally:
+        for sink in [*sinks, quarantine]:
+            sink.close()
+    print(f'{count} listings written to {path}')
+    print(f'{quarantine.count} listings quarantined to {quarantine.path}')
+    print(validator.summary())
+
+
+if __name__ == '__main__':
+    main()
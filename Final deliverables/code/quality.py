@@ -0,0 +1,217 @@
+import csv
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cleaning import BOTTLE_SIZE
+from storage import to_number
+
+# Declarative data-quality rules, for the problems the cleaning notebooks found by eye:
+# ABVs > 1000, the £26000 bottle, gift sets that are not (only) wine, 'out of stock'
+# prices and sizes in ml instead of cL. Each rule is a test over a batch of records of
+# the merged dataset (unified, before cleaning) that gives a mask of the records breaking
+# it. compile_rules() turns a list of rules into a Validator, which runs them all over a
+# batch, every column being read and converted once for all the rules, and sorts the
+# records into kept and quarantined, with the codes of the rules they break.
+# Run from the 'Final deliverables' folder to check the scraped CSVs:
+#   python code/quality.py
+
+QUARANTINE_DIR = Path('./data/quarantine')
+QUARANTINE_COLUMNS = [
+    'reasons', 'retailer', 'name', 'url', 'wine_type', 'country', 'year', 'abv', 'size(cL)',
+    'price', 'raw_price', 'rating', 'num_review',
+]
+# Bottle sizes sold by the retailers, in cL
+BOTTLE_SIZES = [12.5, 18.7, 20, 25, 37.5, 50, 70, 75, 100, 150, 300, 450, 600]
+# Listings that are not (only) wine. 'chocolates' but not 'chocolate', which is in the
+# name of some wines (The Chocolate Block)
+NOT_WINE = ['candle', 'candles', 'diffuser', 'chocolates', 'glasses', 'hamper', 'corkscrew', 'voucher']
+
+
+class Batch:
+    # Columns of a batch of records, read and converted on first use and shared by the rules
+
+    def __init__(self, records):
+        self.records = records
+        self.columns = {}
+        self.numbers = {}
+        self.texts = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def column(self, name):
+        if name not in self.columns:
+            self.columns[name] = [record.get(name) for record in self.records]
+        return self.columns[name]
+
+    def number(self, name):
+        # Values that are not numbers are missing
+        if name not in self.numbers:
+            values = self.column(name)
+            try:
+                # Unified records already hold floats or None
+                self.numbers[name] = np.array(values, dtype=float)
+            except (TypeError, ValueError):
+                self.numbers[name] = to_number(pd.Series(values, dtype=object)).to_numpy(float)
+        return self.numbers[name]
+
+    def text(self, name):
+        # The values of the batch joined in one string, and the offset of each value in it
+        if name not in self.texts:
+            values = ['' if value is None else str(value) for value in self.column(name)]
+            lengths = np.fromiter(map(len, values), dtype=np.intp, count=len(values))
+            starts = np.concatenate([[0], np.cumsum(lengths + 1)[:-1]])
+            self.texts[name] = '\0'.join(values), starts
+        return self.texts[name]
+
+
+class Rule:
+    # code: reason code given to the records breaking the rule
+    # test: Batch -> boolean mask of the records breaking it
+    # quarantine: take the records out of the dataset, otherwise they are only counted
+    def __init__(self, code, test, quarantine=True):
+        self.code = code
+        self.test = test
+        self.quarantine = quarantine
+
+
+def values(column, batch):
+    # column: name of a numeric column, or function of the batch (a derived value)
+    return batch.number(column) if isinstance(column, str) else column(batch)
+
+
+def out_of_range(column, low=None, high=None):
+    # Values below low or above high, bounds included in the range. Missing values pass.
+    def test(batch):
+        numbers = values(column, batch)
+        mask = np.zeros(len(batch), dtype=bool)
+        if low is not None:
+            mask |= numbers < low
+        if high is not None:
+            mask |= numbers > high
+        return mask
+    return test
+
+
+def not_numeric(column):
+    # Values given but not numbers, e.g. 'out of stock' prices
+    def test(batch):
+        given = np.array([value is not None and str(value).strip() != '' for value in batch.column(column)], dtype=bool)
+        return given & np.isnan(batch.number(column))
+    return test
+
+
+def wrong_unit(column, factor, expected):
+    # Values that are not among the expected ones but are once divided by factor, e.g.
+    # a bottle of 750 'cL' (ml)
+    def test(batch):
+        numbers = batch.number(column)
+        return ~np.isin(numbers, expected) & np.isin(numbers / factor, expected)
+    return test
+
+
+def contains(column, words):
+    # Text containing any of the words (case insensitive, whole words)
+    pattern = re.compile(r'\b(?:' + '|'.join(map(re.escape, words)) + r')\b', re.IGNORECASE)
+
+    def test(batch):
+        # One scan of the text of the whole batch, matches are mapped back to their records
+        text, starts = batch.text(column)
+        offsets = [match.start() for match in pattern.finditer(text)]
+        mask = np.zeros(len(batch), dtype=bool)
+        mask[np.searchsorted(starts, offsets, side='right') - 1] = True
+        return mask
+    return test
+
+
+def price_per_bottle(batch):
+    # Price of a 75cL bottle, as the scaled_price of the merged dataset (sizes not given
+    # are imputed with the usual bottle)
+    size = batch.number('size(cL)')
+    return batch.number('price') * BOTTLE_SIZE / np.where(np.isnan(size), BOTTLE_SIZE, size)
+
+
+RULES = [
+    # clean_decantlo.ipynb: 'an extreme value of > 1000'
+    Rule('abv_out_of_range', out_of_range('abv', 0, 100)),
+    Rule('rating_out_of_range', out_of_range('rating', 0, 5)),
+    Rule('num_review_negative', out_of_range('num_review', low=0)),
+    # The notebooks keep the out of stock listings, without a price
+    Rule('price_not_numeric', not_numeric('raw_price'), quarantine=False),
+    Rule('price_not_positive', out_of_range('price', low=0.01)),
+    # The '£26000 bottle' the notebooks leave out of the price plots
+    Rule('price_per_75cl_out_of_range', out_of_range(price_per_bottle, 1, 20000)),
+    # Laithwaites gives sizes in ml
+    Rule('size_in_ml', wrong_unit('size(cL)', 10, BOTTLE_SIZES)),
+    Rule('size_out_of_range', out_of_range('size(cL)', 10, 600)),
+    Rule('not_wine', contains('name', NOT_WINE)),
+]
+
+
+class Validator:
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.codes = np.array([rule.code for rule in rules])
+        self.quarantines = np.array([rule.quarantine for rule in rules])
+        # Records breaking each rule, over all the batches checked
+        self.counts = dict.fromkeys(self.codes.tolist(), 0)
+
+    def check(self, records):
+        # Returns the mask of the records to quarantine, and the reasons of each of them
+        # ('abv_out_of_range;size_in_ml'), rules that don't quarantine included
+        batch = Batch(records)
+        broken = np.column_stack([rule.test(batch) for rule in self.rules])
+        for code, count in zip(self.codes.tolist(), broken.sum(axis=0).tolist()):
+            self.counts[code] += count
+        quarantined = (broken & self.quarantines).any(axis=1)
+        reasons = [';'.join(self.codes[row]) for row in broken[quarantined]]
+        return quarantined, reasons
+
+    def summary(self):
+        lines = [f'  {code}: {count}' for code, count in self.counts.items() if count]
+        return '\n'.join(['Quality rules broken:', *lines] if lines else ['No quality rules broken'])
+
+
+def compile_rules(rules=RULES):
+    return Validator(rules)
+
+
+class QuarantineSink:
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=QUARANTINE_COLUMNS, extrasaction='ignore')
+        self.writer.writeheader()
+        self.count = 0
+
+    def write(self, record, reasons):
+        self.writer.writerow(dict(record, reasons=reasons))
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def main():
+    from pipeline import unify
+
+    validator = compile_rules()
+    for path in sorted(Path('./data/scrapped').glob('*_listings.csv')):
+        retailer = path.name.split('_')[0]
+        with open(path, newline='', encoding='utf-8') as f:
+            records = [unify(retailer, row) for row in csv.DictReader(f)]
+        quarantined, reasons = validator.check(records)
+        print(f'{retailer}: {quarantined.sum()} of {len(records)} listings quarantined')
+        for record, reason in zip(np.array(records, dtype=object)[quarantined][:5], reasons):
+            print(f'  {reason}: {record["name"]} ({record["price"]}, {record["size(cL)"]} cL, {record["abv"]}%)')
+    print(validator.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+# Local query service over the merged dataset, for questions like 'French reds under £15
+# rated 4.5 or more, across retailers' without loading and filtering all_retailers.csv in
+# pandas every time. The latest row of every listing is kept in memory with:
+#   secondary indexes on retailer, country, wine_type and year: value -> row positions
+#   sorted indexes on scaled_price, rating and num_review: row positions by value
+# A query starts from its most selective condition (a posting list, or a binary search
+# in a sorted index) and checks the others on those rows only. Top-k queries without
+# conditions read the sorted index directly. Results (row positions) are kept in an LRU
+# cache held by the index they were computed on: ingesting a snapshot builds a new index,
+# with an empty cache, and the cache of the old one goes away with it.
+# Run from the 'Final deliverables' folder:
+#   python code/query.py serve                  (data/all_retailers.csv, on port 8765)
+#   curl 'localhost:8765/listings?country=France&wine_type=Red&scaled_price_max=15&rating_min=4.5'
+#   curl 'localhost:8765/listings?order_by=num_review&limit=10'
+#   curl -d '{"path": "data/pipeline/all_retailers.csv"}' localhost:8765/ingest
+#   python code/query.py run country=France wine_type=Red scaled_price_max=15 rating_min=4.5
+import argparse
+import json
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from pipeline import COLUMNS
+from storage import read_merged, split_year, to_number
+
+SNAPSHOT_PATH = Path('./data/all_retailers.csv')
+NUMBERS = ['abv', 'size(cL)', 'price', 'num_review', 'rating', 'scaled_price', 'logprice', 'price_fixed', 'age', 'score']
+PORT = 8765
+# Columns with a secondary index (equality, several values mean any of them)
+KEYS = ['retailer', 'country', 'wine_type', 'year']
+# Columns with a sorted index (ranges and ordering)
+SORTED = ['scaled_price', 'rating', 'num_review']
+# A listing: Morrisons lists some products under several categories
+LISTING = ['retailer', 'wine_type', 'url']
+CACHE_SIZE = 1024
+DEFAULT_LIMIT = 100
+
+
+def load_snapshot(path):
+    # Merged dataset from all_retailers.csv, the pipeline's CSV or Parquet output, or the
+    # Parquet dataset of storage.py. Years are kept as text ('2021', 'NV').
+    path = Path(path)
+    if path.is_dir():
+        data = read_merged(root=path)
+    elif path.suffix == '.parquet':
+        data = pd.read_parquet(path)
+    else:
+        data = pd.read_csv(path)
+    if 'non_vintage' in data:
+        year = data['year'].astype('Int16').astype('string')
+        data['year'] = year.mask(data['non_vintage'].fillna(False), 'NV')
+    else:
+        year, non_vintage = split_year(data['year'])
+        data['year'] = year.astype('string').mask(non_vintage, 'NV')
+    data = data.reindex(columns=COLUMNS)
+    data[NUMBERS] = data[NUMBERS].apply(to_number)
+    return data
+
+
+class ListingIndex:
+    # Indexes of one version of the dataset, never changed once built
+
+    def __init__(self, data, cache_size=CACHE_SIZE):
+        # Text columns as numpy objects: taking a few rows of an Arrow string column costs
+        # milliseconds, which would be most of the time of a query
+        self.data = data.reset_index(drop=True).astype({
+            column: object for column, dtype in data.dtypes.items() if isinstance(dtype, pd.StringDtype)
+        })
+        self.codes = {}
+        self.categories = {}
+        self.postings = {}
+        for column in KEYS:
+            values = self.data[column].astype('string').astype('category')
+            codes = values.cat.codes.to_numpy()
+            order = np.argsort(codes, kind='stable')
+            starts = np.searchsorted(codes[order], np.arange(len(values.cat.categories) + 1))
+            self.codes[column] = codes
+            self.categories[column] = {value: code for code, value in enumerate(values.cat.categories)}
+            self.postings[column] = {
+                value: order[start:end]
+                for value, start, end in zip(values.cat.categories, starts[:-1], starts[1:])
+            }
+
+        self.values = {}
+        self.order = {}
+        self.descending = {}
+        self.sorted = {}
+        for column in SORTED:
+            values = pd.to_numeric(self.data[column], errors='coerce').to_numpy(float)
+            present = np.flatnonzero(~np.isnan(values))
+            order = present[np.argsort(values[present], kind='stable')]
+            self.values[column] = values
+            self.order[column] = order
+            # Ties stay in row order both ways
+            self.descending[column] = present[np.lexsort((present, -values[present]))]
+            self.sorted[column] = values[order]
+        self.rows = np.arange(len(self.data))
+        # Results of the queries run on this index
+        self.cached = lru_cache(maxsize=cache_size)(self.compute)
+
+    def __len__(self):
+        return len(self.data)
+
+    def bounds(self, column, low, high):
+        # Slice of the sorted index with low <= value <= high (None: unbounded)
+        values = self.sorted[column]
+        start = 0 if low is None else np.searchsorted(values, low, side='left')
+        end = len(values) if high is None else np.searchsorted(values, high, side='right')
+        return start, max(start, end)
+
+    def size(self, condition):
+        # Number of rows matching a condition, without reading them
+        column, arguments = condition
+        if column in KEYS:
+            postings = self.postings[column]
+            return sum(len(postings[value]) for value in arguments if value in postings)
+        start, end = self.bounds(column, *arguments)
+        return end - start
+
+    def matching(self, condition):
+        # Positions of the rows matching a condition, in row order
+        column, arguments = condition
+        if column in KEYS:
+            postings = self.postings[column]
+            matching = [postings[value] for value in arguments if value in postings]
+            return np.sort(np.concatenate(matching)) if matching else np.array([], dtype=np.intp)
+        start, end = self.bounds(column, *arguments)
+        return np.sort(self.order[column][start:end])
+
+    def check(self, condition, positions):
+        # Mask of the positions matching a condition
+        column, arguments = condition
+        if column in KEYS:
+            categories = self.categories[column]
+            wanted = [categories[value] for value in arguments if value in categories]
+            return np.isin(self.codes[column][positions], wanted)
+        low, high = arguments
+        values = self.values[column][positions]
+        mask = ~np.isnan(values)
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        return mask
+
+    def select(self, conditions, order_by=None, descending=True, limit=DEFAULT_LIMIT):
+        # conditions: (column, values) for KEYS, (column, (low, high)) for SORTED.
+        # Returns the positions of the first limit rows (rows without a value for order_by
+        # come last) and the number of rows matching.
+        if conditions:
+            conditions = sorted(conditions, key=self.size)
+            positions = self.matching(conditions[0])
+            for condition in conditions[1:]:
+                if not len(positions):
+                    break
+                positions = positions[self.check(condition, positions)]
+        else:
+            positions = None
+
+        if order_by is None:
+            positions = self.rows if positions is None else positions
+            return positions[:limit], len(positions)
+        if positions is None:
+            ranked = (self.descending if descending else self.order)[order_by]
+            if len(ranked) < limit:
+                missing = np.setdiff1d(self.rows, ranked, assume_unique=True)
+                ranked = np.concatenate([ranked, missing])
+            return ranked[:limit], len(self)
+
+        values = self.values[order_by][positions]
+        keys = np.where(np.isnan(values), np.inf, -values if descending else values)
+        if 0 < limit < len(positions):
+            # Only the rows up to the limit-th key are sorted, ties with it included so
+            # that they come in row order as in a full sort
+            kth = np.partition(keys, limit - 1)[limit - 1]
+            top = np.flatnonzero(keys <= kth)
+        else:
+            top = np.arange(len(positions))
+        top = top[np.lexsort((positions[top], keys[top]))]
+        return positions[top[:limit]], len(positions)
+
+    def compute(self, conditions, order_by, descending, limit):
+        positions, count = self.select(list(conditions), order_by, descending, limit)
+        positions.flags.writeable = False
+        return positions, count
+
+
+def to_condition(column, value):
+    if column in KEYS:
+        values = [value] if isinstance(value, (str, int)) else value
+        return column, tuple(sorted({str(value) for value in values}))
+    low, high = value
+    return column, (None if low is None else float(low), None if high is None else float(high))
+
+
+class QueryService:
+    # Queries run on the index current when they start. Ingesting builds the next index
+    # without holding the lock, which only guards the swap, so queries don't wait for it.
+
+    def __init__(self, data=None, cache_size=CACHE_SIZE):
+        self.lock = threading.Lock()
+        # One snapshot is merged at a time
+        self.ingesting = threading.Lock()
+        self.cache_size = cache_size
+        self.snapshots = 0
+        self.index = ListingIndex(pd.DataFrame(columns=COLUMNS), cache_size)
+        if data is not None:
+            self.ingest(data)
+
+    def current(self):
+        with self.lock:
+            return self.index
+
+    def ingest(self, data):
+        # Adds the listings of a snapshot, or replaces the previous row of those already
+        # known (same retailer, wine type and URL)
+        with self.ingesting:
+            merged = pd.concat([self.current().data, data.reindex(columns=COLUMNS)], ignore_index=True)
+            merged = merged.drop_duplicates(LISTING, keep='last')
+            index = ListingIndex(merged, self.cache_size)
+            with self.lock:
+                self.index = index
+                self.snapshots += 1
+        return len(index)
+
+    def query(self, order_by=None, descending=True, limit=DEFAULT_LIMIT, **conditions):
+        # e.g. query(country='France', wine_type='Red', scaled_price=(None, 15), rating=(4.5, None))
+        # Returns the matching rows (at most limit) and the number of rows matching
+        unknown = set(conditions) - set(KEYS) - set(SORTED)
+        if unknown:
+            raise ValueError(f'No index on {", ".join(sorted(unknown))}')
+        if order_by is not None and order_by not in SORTED:
+            raise ValueError(f'Can only order by {", ".join(SORTED)}')
+        if int(limit) < 0:
+            raise ValueError('The limit cannot be negative')
+        conditions = tuple(sorted(
+            to_condition(column, value) for column, value in conditions.items() if value is not None
+        ))
+        index = self.current()
+        positions, count = index.cached(conditions, order_by, descending, int(limit))
+        return index.data.iloc[positions], count
+
+    def top(self, column, k=10, **conditions):
+        return self.query(order_by=column, limit=k, **conditions)
+
+    def stats(self):
+        # The cache is the one of the current snapshot
+        with self.lock:
+            index, snapshots = self.index, self.snapshots
+        cache = index.cached.cache_info()
+        return {
+            'listings': len(index),
+            'snapshots': snapshots,
+            'cache': {'hits': cache.hits, 'misses': cache.misses, 'size': cache.currsize},
+        }
+
+
+def parse_query(params):
+    # {'country': ['France'], 'rating_min': ['4.5'], 'limit': ['10'], ...} -> query() arguments
+    # (repeated keys are any of the values, e.g. country=France&country=Italy)
+    arguments = {}
+    ranges = {}
+    for name, values in params.items():
+        if name in KEYS:
+            arguments[name] = values
+        elif name in ('order_by', 'limit'):
+            arguments[name] = values[-1]
+        elif name == 'ascending':
+            arguments['descending'] = values[-1].lower() not in ('1', 'true', 'yes')
+        elif name.endswith(('_min', '_max')) and name[:-4] in SORTED:
+            bound = 0 if name.endswith('_min') else 1
+            ranges.setdefault(name[:-4], [None, None])[bound] = float(values[-1])
+        else:
+            raise ValueError(f'Unknown parameter {name}')
+    arguments.update((column, tuple(bounds)) for column, bounds in ranges.items())
+    return arguments
+
+
+def to_json(rows):
+    return json.loads(rows.to_json(orient='records', force_ascii=False))
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    # GET /listings?<conditions>, GET /stats, POST /ingest {"path": ...}
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/stats':
+            return self.reply(200, self.service.stats())
+        if url.path != '/listings':
+            return self.reply(404, {'error': f'No {url.path}, see /listings and /stats'})
+        start = time.perf_counter()
+        try:
+            rows, count = self.service.query(**parse_query(parse_qs(url.query)))
+        except ValueError as e:
+            return self.reply(400, {'error': str(e)})
+        self.reply(200, {
+            'count': count,
+            'returned': len(rows),
+            'milliseconds': round(1000 * (time.perf_counter() - start), 3),
+            'rows': to_json(rows),
+        })
+
+    def do_POST(self):
+        if urlsplit(self.path).path != '/ingest':
+            return self.reply(404, {'error': f'No {self.path}, see /ingest'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            listings = self.service.ingest(load_snapshot(body['path']))
+        except KeyError as e:
+            return self.reply(400, {'error': f'Missing {e.args[0]}'})
+        except (ValueError, OSError) as e:
+            return self.reply(400, {'error': str(e)})
+        self.reply(200, {'listings': listings})
+
+    def reply(self, status, body):
+        content = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(service, port=PORT):
+    handler = type('Handler', (QueryHandler,), {'service': service})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    print(f'{len(service.current())} listings, serving on http://127.0.0.1:{port}/listings')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    served = commands.add_parser('serve', help='serve queries over HTTP')
+    served.add_argument('--port', type=int, default=PORT)
+    ran = commands.add_parser('run', help='run one query, e.g. country=France rating_min=4.5')
+    ran.add_argument('conditions', nargs='*')
+    for command in (served, ran):
+        command.add_argument(
+            '--snapshot', action='append', help='snapshots to ingest, in order (default: all_retailers.csv)'
+        )
+    args = parser.parse_args()
+
+    service = QueryService()
+    for path in args.snapshot or [SNAPSHOT_PATH]:
+        service.ingest(load_snapshot(path))
+
+    if args.command == 'serve':
+        serve(service, args.port)
+        return
+    params = {}
+    for condition in args.conditions:
+        name, _, value = condition.partition('=')
+        params.setdefault(name, []).append(value)
+    start = time.perf_counter()
+    rows, count = service.query(**parse_query(params))
+    print(rows.to_string(index=False))
+    print(f'{len(rows)} of {count} listings in {1000 * (time.perf_counter() - start):.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+# Decantalo ratings are not in the product pages: the product comments widget loads them
+# with JavaScript, which cost a browser page load per product (and was left out of the
+# runs). Instead, the grades are asked to the widget's JSON endpoint (the productcomments
+# module of PrestaShop, which runs the shop) for BATCH_SIZE products per request, several
+# requests at a time. The product ids come from the cached product pages. Products the
+# endpoint doesn't answer for, or whose id is not in their page, are read from the
+# rendered page by a pool of browsers, at most MAX_FALLBACK per call. When the endpoint
+# doesn't answer at all, or the browsers can't be started, the rows are kept without
+# reviews.
+# Run from the 'Final deliverables' folder against a local stub of the shop:
+#   python code/reviews.py               (add --browser to also try the browser fallback)
+import argparse
+import asyncio
+import json
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import aiohttp
+from selenium.common.exceptions import WebDriverException
+
+from browser_pool import WORKERS, DriverPool
+from canonical import canonical_url
+from fetcher import HostLimiter, fetch_with_retries, make_session
+from metrics import METRICS
+
+BASE_URL = 'https://www.decantalo.com/uk/en'
+GRADES_PATH = '/module/productcomments/CommentGrade'
+BATCH_SIZE = 20
+MAX_CONCURRENCY = 4
+# Products read by the browsers per call to collect_reviews, the others are left without
+# reviews (a page load each, while the endpoint answers for BATCH_SIZE at once)
+MAX_FALLBACK = 10
+PRODUCT_ID_PATTERNS = [
+    re.compile(rb'name=["\']id_product["\']\s+value=["\'](\d+)["\']'),
+    re.compile(rb'data-id-product=["\'](\d+)["\']'),
+]
+FIXTURES_DIR = Path(__file__).parent / 'fixtures' / 'reviews'
+
+
+def product_id(content):
+    for pattern in PRODUCT_ID_PATTERNS:
+        match = pattern.search(content)
+        if match:
+            return match.group(1).decode()
+    return None
+
+
+def grades_url(base_url, ids):
+    return f'{base_url}{GRADES_PATH}?' + urlencode([('id_products[]', product) for product in ids])
+
+
+def parse_grades(content):
+    # {"products": [{"id_product": 12, "average_grade": 4.5, "comments_nb": 3}, ...]} ->
+    # {'12': (4.5, 3)}. Products without reviews get (None, None), as they used to.
+    grades = {}
+    for product in json.loads(content)['products']:
+        count = int(product['comments_nb'])
+        grades[str(product['id_product'])] = (float(product['average_grade']), count) if count else (None, None)
+    return grades
+
+
+async def fetch_grades(base_url, ids, max_concurrency=MAX_CONCURRENCY):
+    # Batches that fail are left out, their products go to the fallback
+    limiter = HostLimiter(max_concurrency)
+
+    async def fetch_batch(session, batch):
+        try:
+            status, content = await fetch_with_retries(session, limiter, grades_url(base_url, batch))
+            if status == 200:
+                return parse_grades(content)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError):
+            pass
+        METRICS.count('review_batches_failed')
+        return {}
+
+    batches = [ids[start:start + BATCH_SIZE] for start in range(0, len(ids), BATCH_SIZE)]
+    async with make_session(max_concurrency, max_concurrency) as session:
+        results = await asyncio.gather(*(fetch_batch(session, batch) for batch in batches))
+    grades = {}
+    for result in results:
+        grades.update(result)
+    return grades
+
+
+def browser_reviews(urls, get_reviews, workers=WORKERS, headless=True):
+    # get_reviews(driver, url) -> (rating, num_review), read from the rendered pages
+    workers = min(workers, len(urls))
+    with DriverPool(workers, headless) as pool:
+        def read(url):
+            with pool.driver() as driver:
+                try:
+                    return get_reviews(driver, url)
+                except WebDriverException:
+                    return None, None
+
+        with ThreadPoolExecutor(workers) as executor:
+            return dict(zip(urls, executor.map(read, urls)))
+
+
+def collect_reviews(urls, cache, base_url=BASE_URL, fallback=None, max_fallback=MAX_FALLBACK):
+    # urls: listing URLs, their variants share the reviews of the product.
+    # Returns {canonical URL: (rating, num_review)}.
+    # fallback(urls) -> the same for the products the endpoint didn't give
+    ids = {}
+    missing = []
+    for url in dict.fromkeys(map(canonical_url, urls)):
+        entry = cache.lookup(url)
+        product = None if entry is None else product_id(cache.read(entry))
+        if product is None:
+            missing.append(url)
+        else:
+            ids[url] = product
+
+    grades = asyncio.run(fetch_grades(base_url, sorted(set(ids.values())))) if ids else {}
+    if ids and not grades:
+        # Not the endpoint the shop has (or it is down): falling back would load every page
+        print(f'Warning: no reviews from {base_url}{GRADES_PATH}, {len(ids)} products left without reviews')
+        ids = {}
+    reviews = {}
+    for url, product in ids.items():
+        if product in grades:
+            reviews[url] = grades[product]
+        else:
+            missing.append(url)
+    METRICS.count('reviews', len(reviews), source='endpoint')
+
+    print(f'Reviews of {len(reviews)} products from the endpoint, {len(missing)} missing')
+    if missing and fallback is not None:
+        if len(missing) > max_fallback:
+            print(f'Warning: {len(missing) - max_fallback} products left without reviews')
+        try:
+            fallen_back = fallback(missing[:max_fallback])
+        except WebDriverException as e:
+            print(f'Warning: no browser for the missing reviews ({e.msg})')
+            fallen_back = {}
+        METRICS.count('reviews', len(fallen_back), source='browser')
+        reviews.update(fallen_back)
+    return reviews
+
+
+def add_reviews(rows, cache, base_url=BASE_URL, fallback=None, max_fallback=MAX_FALLBACK):
+    # Fills the rating and num_review of scraped rows
+    urls = [row['url'] for row in rows if 'url' in row]
+    reviews = collect_reviews(urls, cache, base_url, fallback, max_fallback)
+    for row in rows:
+        if 'url' in row:
+            row['rating'], row['num_review'] = reviews.get(canonical_url(row['url']), (None, None))
+    return rows
+
+
+class StubHandler(SimpleHTTPRequestHandler):
+    # Product pages from the fixtures folder, and the grades endpoint answering from
+    # grades.json (products not in it are not answered for, as for an unknown id)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != GRADES_PATH:
+            return super().do_GET()
+        grades = json.loads((Path(self.directory) / 'grades.json').read_text())
+        ids = parse_qs(url.query).get('id_products[]', [])
+        body = json.dumps({'products': [grades[product] for product in ids if product in grades]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve_stub(root=FIXTURES_DIR):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(StubHandler, directory=str(root)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+
+
+def main():
+    import scrape_decantalo
+    from cache import PageCache
+    from fetcher import scrape
+
+    parser = argparse.ArgumentParser(description='Collect the reviews of the local stub products')
+    parser.add_argument('--browser', action='store_true', help='use the browser fallback (needs Chrome)')
+    args = parser.parse_args()
+
+    with serve_stub() as base_url, tempfile.TemporaryDirectory() as cache_dir:
+        cache = PageCache(cache_dir)
+        listings = [('red', f'{base_url}/{path.name}') for path in sorted(FIXTURES_DIR.glob('*.html'))]
+        rows = [
+            result.row for result in scrape(listings, scrape_decantalo.parse_listing, cache=cache)
+            if result.row is not None
+        ]
+        fallback = partial(browser_reviews, get_reviews=scrape_decantalo.get_reviews) if args.browser else None
+        for row in add_reviews(rows, cache, base_url, fallback):
+            print(f'  {row["name"]}: rating {row["rating"]}, {row["num_review"]} reviews')
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
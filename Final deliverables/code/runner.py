@@ -0,0 +1,172 @@
+import argparse
+import json
+from datetime import date, datetime
+
+from tqdm import tqdm
+
+from cache import PageCache
+from canonical import CanonicalIndex
+from checkpoint import DEAD_LETTERS_DIR, CheckpointStore, write_csv
+from fetcher import replay, scrape
+from history import PriceHistory
+from incremental import CHANGES_DIR, ListingState, write_change_log
+from metrics import METRICS, METRICS_DIR
+from storage import row_batches, write_listings
+
+# Rows enriched together as their pages are fetched (see enriched)
+ENRICH_ROWS = 100
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--replay',
+        action='store_true',
+        help='re-run the extractors on the cached pages only, without any network access',
+    )
+    mode.add_argument(
+        '--incremental',
+        action='store_true',
+        help='re-discover the listings, fetch the new and due ones and write a change log',
+    )
+    parser.add_argument(
+        '--parse-workers',
+        type=int,
+        default=0,
+        help='parse the pages in that many processes (default: in the fetching process)',
+    )
+    return parser.parse_args()
+
+
+def load_listings(listing_urls_path, discover_listings, rediscover=False):
+    if rediscover or not listing_urls_path.exists():
+        listing_urls = discover_listings()
+        with open(listing_urls_path, 'w') as f:
+            json.dump(listing_urls, f, indent=4)
+    else:
+        listing_urls = json.load(open(listing_urls_path))
+
+    # Virgin Wines listings are plain URLs
+    return [
+        tuple(listing) if isinstance(listing, list) else (None, listing)
+        for listing in listing_urls
+    ]
+
+
+def publish(fetched_rows, retailer, export_path):
+    # fetched_rows: function returning the (fetched_at, row) pairs of a run. The rows go to
+    # the CSV, to a typed copy partitioned by retailer and scrape date, and to the price
+    # history as observed when they were fetched, each sink streaming them from a pass of
+    # its own rather than the run being held in memory
+    def rows():
+        return (row for _, row in fetched_rows())
+
+    write_csv(rows, export_path)
+    write_listings(rows(), retailer)
+    PriceHistory().record_fetched(retailer, fetched_rows())
+
+
+def enriched(results, enrich, cache, size=ENRICH_ROWS):
+    # fetcher.Result of the fetched pages -> the same with their rows enriched, size results
+    # at a time so that the run is still streamed. enrich reads the pages from the cache.
+    for batch in row_batches(results, size):
+        rows = iter(enrich([result.row for result in batch if result.row is not None], cache))
+        for result in batch:
+            yield result if result.row is None else result._replace(row=next(rows))
+
+
+def report_metrics(retailer):
+    # End-of-run summary, and the metrics of the run in data/metrics/
+    print(METRICS.summary())
+    path = METRICS_DIR / f'{retailer}_{datetime.now():%Y-%m-%d_%H%M%S}'
+    METRICS.write(path)
+    print(f'Metrics written to {path}.json, .prom and _urls.csv')
+
+
+def run_incremental(listings, parse, state_path, parse_workers=0, enrich=None):
+    state = ListingState(state_path)
+    changes = state.sync(listings)
+    due = state.due()
+    print(f'{len(due)} listings due ({len(changes)} listed or delisted since the last run)')
+
+    # Every due page is revalidated: unchanged pages only cost a 304
+    cache = PageCache(ttl=0)
+    index = CanonicalIndex(due)
+    results = index.fan_out(scrape(index.fetches(), parse, cache=cache, parse_workers=parse_workers))
+    if enrich is not None:
+        results = enriched(results, enrich, cache)
+    rows = []
+    METRICS.reset()
+    for result in tqdm(results, total=len(index)):
+        changes.extend(state.record(result))
+        if result.error:
+            tqdm.write(f'Failed {result.url}: {result.error}')
+        elif result.row is not None:
+            rows.append(result.row)
+
+    print(state.summary())
+    report_metrics(state_path.stem)
+    change_log_path = CHANGES_DIR / f'{state_path.stem}_{date.today()}.csv'
+    write_change_log(changes, change_log_path)
+    print(f'{len(changes)} changes written to {change_log_path}')
+    PriceHistory().record(state_path.stem, rows)
+
+
+def run_scraper(
+    listing_urls_path, discover_listings, parse, checkpoint_path, export_path, state_path, enrich=None
+):
+    # Shared main of the scrape_*.py scripts
+    # enrich(rows, cache) -> rows, adds what the product pages don't have (e.g. the
+    #   Decantalo reviews) to the rows, ENRICH_ROWS at a time as their pages are fetched,
+    #   before they go to the checkpoint (so a crash loses at most that many). The replay
+    #   mode leaves it out.
+    args = parse_args()
+    listings = load_listings(listing_urls_path, discover_listings, rediscover=args.incremental)
+
+    if args.incremental:
+        run_incremental(listings, parse, state_path, args.parse_workers, enrich)
+        return
+
+    cache = PageCache()
+    if args.replay:
+        # Parser iteration: every listing is re-parsed and nothing is checkpointed
+        store = CheckpointStore(':memory:')
+        index = CanonicalIndex(listings)
+        results = replay(index.fetches(), parse, cache, args.parse_workers)
+    else:
+        # Listings already fetched by a previous (crashed) run are skipped, unless that run
+        # was published, then this one is a new run
+        store = CheckpointStore(checkpoint_path)
+        if store.published():
+            store.start_run()
+        pending = store.pending(listings)
+        # Variants and category duplicates of a page share a single fetch
+        index = CanonicalIndex(pending)
+        print(
+            f'{len(listings) - len(pending)} listings already done, {len(pending)} to fetch '
+            f'({len(index.groups)} pages)'
+        )
+        results = scrape(index.fetches(), parse, cache=cache, parse_workers=args.parse_workers)
+
+    results = index.fan_out(results)
+    if enrich is not None and not args.replay:
+        results = enriched(results, enrich, cache)
+    METRICS.reset()
+    for result in tqdm(results, total=len(index)):
+        store.record(result)
+        if result.error:
+            tqdm.write(f'Failed {result.url}: {result.error}')
+
+    print(store.summary())
+    report_metrics(checkpoint_path.stem)
+    dead_letters = store.dead_letters()
+    if dead_letters:
+        dead_letters_path = DEAD_LETTERS_DIR / f'{checkpoint_path.stem}.csv'
+        store.export_dead_letters(dead_letters_path)
+        print(f'Gave up on {len(dead_letters)} listings, see {dead_letters_path}')
+    if args.replay:
+        store.export_csv(export_path)
+    else:
+        publish(store.fetched_rows, checkpoint_path.stem, export_path)
+        store.mark_published()
@@ -1,63 +1,78 @@
-import json
 import re
-import time
 from pathlib import Path
 
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
-from tqdm import tqdm
+
+from browser_pool import WORKERS, crawl_categories, wait_for, wait_for_all, wait_until_stale
+from extraction import Field, compile_spec
+from http_discovery import compile_links, discover_listings_http
+from metrics import METRICS
+from parsing import make_soup
+from reviews import add_reviews, browser_reviews
+from runner import run_scraper
 
 listing_urls_path = Path('./data/url/decantalo_listings.json')
-export_path = './data/scrapped/decantalo_listings_abv.csv'
-
-if not listing_urls_path.exists():
-    driver = webdriver.Chrome()
-
-    wine_type_urls = {
-        'white': 'https://www.decantalo.com/uk/en/wine/white/',
-        'rose': 'https://www.decantalo.com/uk/en/wine/rose/',
-        'fortified and sherry': 'https://www.decantalo.com/uk/en/wine/fortified/',
-        'red': 'https://www.decantalo.com/uk/en/wine/red/',
-        'sweet': 'https://www.decantalo.com/uk/en/wine/sweet/',
-        'orange': 'https://www.decantalo.com/uk/en/wine/orange-wine/',
-        'vermouth': 'https://www.decantalo.com/uk/en/wine/vermouth/'
-    }
-
-    for wine_type, wine_type_url in wine_type_urls.items():
-        driver.get(wine_type_url)
-
-        listing_urls = []
-        while True:
-            listings = driver.find_elements(
-                By.XPATH,
-                '//h3[contains(@class,"h3 mb-0 product-title MerriweatherBold")]'
-            )
-            print(
-                "Found " + str(len(listings)) + " wine advs")
-
-            for listing in listings:
-                listing_url = listing.find_element(By.XPATH, './/a').get_attribute('href')
-                listing_urls.append([wine_type, listing_url])
-
-            next_arrows = driver.find_elements(By.XPATH, '//a[contains(@rel,"next")]')
-            if len(next_arrows):
-                next_arrow = next_arrows[0]
-                if next_arrow.is_enabled():
-                    # We need to wait a little, as the page takes time to load (try setting the wait to 0 and see what happens!)
-                    time.sleep(3)
-                    next_arrow.click()
-                else:
-                    break
-
-    with open(listing_urls_path, 'w') as f:
-        json.dump(listing_urls, f, indent=4)
-else:
-    listing_urls = json.load(
-        open(listing_urls_path))
+export_path = './data/scrapped/decantalo_listings.csv'
+checkpoint_path = Path('./data/checkpoints/decantalo.sqlite')
+state_path = Path('./data/state/decantalo.sqlite')
+
+wine_type_urls = {
+    'white': 'https://www.decantalo.com/uk/en/wine/white/',
+    'rose': 'https://www.decantalo.com/uk/en/wine/rose/',
+    'fortified and sherry': 'https://www.decantalo.com/uk/en/wine/fortified/',
+    'red': 'https://www.decantalo.com/uk/en/wine/red/',
+    'sweet': 'https://www.decantalo.com/uk/en/wine/sweet/',
+    'orange': 'https://www.decantalo.com/uk/en/wine/orange-wine/',
+    'vermouth': 'https://www.decantalo.com/uk/en/wine/vermouth/'
+}
+
+
+def discover_category(driver, wine_type, wine_type_url):
+    driver.get(wine_type_url)
+
+    listing_urls = []
+    while True:
+        listings = wait_for_all(
+            driver,
+            '//h3[contains(@class,"h3 mb-0 product-title MerriweatherBold")]'
+        )
+        print(
+            "Found " + str(len(listings)) + " wine advs")
+
+        for listing in listings:
+            listing_url = listing.find_element(By.XPATH, './/a').get_attribute('href')
+            listing_urls.append([wine_type, listing_url])
+
+        next_arrows = driver.find_elements(By.XPATH, '//a[contains(@rel,"next")]')
+        if not listings or not next_arrows or not next_arrows[0].is_enabled():
+            break
+
+        next_arrows[0].click()
+        # The page takes time to load: wait for the current listings to be replaced
+        wait_until_stale(driver, listings[0])
+
+    return listing_urls
+
+
+def discover_listings_browser(wine_type_urls, workers=WORKERS):
+    return crawl_categories(wine_type_urls, discover_category, workers)
+
+
+# Category pages are URL-addressable, so they are fetched over plain HTTP first
+LISTING_LINKS = compile_links(
+    '//h3[contains(@class,"h3 mb-0 product-title MerriweatherBold")]/descendant::a[1]/@href'
+)
+
+
+def get_page_url(wine_type_url, pagenum):
+    return f'{wine_type_url}?page={pagenum}'
+
+
+def discover_listings():
+    return discover_listings_http(
+        wine_type_urls, get_page_url, LISTING_LINKS, fallback=discover_listings_browser
+    )
 
 
 def get_name(soup):
@@ -140,16 +155,11 @@ def get_reviews(driver, listing_url):
     # Reviews from the page are displayed using JS. We need to use selenium to run the script to get the reviews
     driver.get(listing_url)
 
-    while True:
-        try:
-            reviews = driver.find_element(
-                By.XPATH,
-                '//span[contains(@class,"total_reviews")]',
-            ).text
-            break
-        except NoSuchElementException:
-            # wait for the reviews to show up
-            time.sleep(0.2)
+    try:
+        # wait for the reviews to show up, listings without reviews never get them
+        reviews = wait_for(driver, '//span[contains(@class,"total_reviews")]').text
+    except TimeoutException:
+        return None, None
 
     rating = float(reviews.split('/')[0].replace('(', ''))
     num_reviews = int(reviews.split(' ')[-2])
@@ -157,34 +167,98 @@ def get_reviews(driver, listing_url):
     return rating, num_reviews
 
 
-# driver = webdriver.Chrome()
-
-wine_info_all = []
-for wine_type, listing_url in tqdm(listing_urls[3225:]):
-    listing_page = requests.get(listing_url)
-    soup = BeautifulSoup(listing_page.content, 'html.parser')
+def parse_listing_soup(wine_type, listing_url, content):
+    # Original BeautifulSoup path, kept as the reference for bench_parsing.py
+    soup = make_soup(content)
 
     wine_info = {}
     try:
         wine_info['name'] = get_name(soup)
-    except:
+    except AttributeError:
         # There are pages that are not wine listings, e.g:
         # https://www.decantalo.com/uk/en/world-of-wine.html#/1-volume-75_cl/111-year-2018
-        continue
+        return None
 
     # rating, num_reviews = get_reviews(driver, listing_url)
     # wine_info['rating'] = rating
     # wine_info['num_review'] = num_reviews
 
     wine_info['wine_type'] = wine_type
-    # wine_info['size (cL)'] = get_size(soup)
-    # wine_info['price'] = get_price(soup)
-    # wine_info['country'] = get_country(soup)
-    # wine_info['abv'] = get_abv(soup)
-    # wine_info['year'] = get_year(soup)
+    wine_info['size (cL)'] = get_size(soup)
+    wine_info['price'] = get_price(soup)
+    wine_info['country'] = get_country(soup)
+    wine_info['abv'] = get_abv(soup)
+    wine_info['year'] = get_year(soup)
     wine_info['url'] = listing_url
 
-    wine_info_all.append(wine_info)
+    return wine_info
+
+
+def get_abv_from_features(features):
+    # The ABV is the first of the product features
+    return float(features[0].strip().replace('%', ''))
+
+
+def get_size_from_features(features):
+    for feature in features:
+        if 'cl' in feature:
+            try:
+                return float(feature.split(' ')[0])
+            except ValueError:
+                continue
+
+
+def get_price_from_text(price):
+    return float(price.split('\n')[0].replace('£', '').replace(',', ''))
+
+
+def get_structured_price(data):
+    # Out of stock listings are exported as 'out of stock', found in the page
+    return data.get('price') if data.get('availability') == 'in stock' else None
+
+
+SPEC = {
+    'name': Field('h1.title-product', post=lambda title: re.sub(r'\s+', ' ', title), structured='name'),
+    'features': Field('span.value.data_features', many=True),
+    'size (cL)': Field(source='features', post=get_size_from_features),
+    'price': Field(
+        'span.current-price-display',
+        post=get_price_from_text,
+        default='out of stock',
+        structured=get_structured_price,
+    ),
+    'country': Field('span.image_do', get=lambda span: span.find('.//img').get('alt')),
+    'abv': Field(source='features', post=get_abv_from_features),
+    'year': Field('span.choose_comb.selector-combinaciones', post=lambda year: year.replace('\n', '')),
+}
+EXTRACTOR = compile_spec(SPEC, 'decantalo')
+
+
+def parse_listing(wine_type, listing_url, content):
+    fields = EXTRACTOR.parse(content)
+    if fields['name'] is None:
+        # There are pages that are not wine listings, e.g:
+        # https://www.decantalo.com/uk/en/world-of-wine.html#/1-volume-75_cl/111-year-2018
+        METRICS.count('skipped', retailer='decantalo', reason='not a wine listing')
+        return None
+
+    wine_info = {'name': fields['name'], 'wine_type': wine_type}
+    for column in ['size (cL)', 'price', 'country', 'abv', 'year']:
+        wine_info[column] = fields[column]
+    wine_info['url'] = listing_url
+
+    return wine_info
+
+
+def enrich(rows, cache):
+    # Reviews of the scraped rows, from the review widget's endpoint, the browser only for
+    # a few of the products it misses. Also applied by pipeline.py and the work queue
+    # workers.
+    return add_reviews(rows, cache, fallback=lambda urls: browser_reviews(urls, get_reviews))
+
 
-wine_info_df = pd.DataFrame(wine_info_all).to_clipboard()
-wine_info_df.to_csv(export_path, index=False)
+if __name__ == '__main__':
+    run_scraper(
+        listing_urls_path, discover_listings, parse_listing,
+        checkpoint_path, export_path, state_path, enrich=enrich,
+    )
@@ -1,15 +1,22 @@
 # %%
-import json
-import time
 from pathlib import Path
 
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup
-from selenium.webdriver import Chrome
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import Select
-from tqdm import tqdm
+
+from browser_pool import (
+    WORKERS,
+    accept_cookies,
+    crawl_categories,
+    wait_for,
+    wait_for_all,
+    wait_until_stale,
+)
+from extraction import Field, compile_spec, require
+from http_discovery import compile_links, discover_listings_http
+from parsing import compile_selectors, make_soup
+from runner import run_scraper
 
 
 # %%
@@ -22,30 +29,29 @@ urls = {
     'Dessert Wine': 'https://www.laithwaites.co.uk/wines/Dessert-Wine/_/N-1z141jk'
 }
 
+listing_urls_path = Path('./data/url/laithwaites_listings.json')
+export_path = './data/scrapped/laithwaites_listings.csv'
+checkpoint_path = Path('./data/checkpoints/laithwaites.sqlite')
+state_path = Path('./data/state/laithwaites.sqlite')
+
+
 # %%
-driver = Chrome()
-listing_urls = []
-for winetype,url in urls.items():
+def discover_category(driver, winetype, url):
     #url = 'https://www.laithwaites.co.uk/wines/White-Wine/_/N-1z141yb'
     driver.get(url)
-    time.sleep(0.5)
-    try:
-        cookie_button = driver.find_element(By.XPATH,'//button[@id="onetrust-accept-btn-handler"]')
-        if cookie_button.is_displayed():
-            cookie_check = True
-    except:
-        cookie_check = False
-    
-    if cookie_check:
-        cookie_button.click()
+    accept_cookies(driver)
 
-    
-    select = Select(driver.find_element(By.XPATH,'//select[@id="numPerPage"]'))
+    product_wrappers = wait_for_all(driver, '//div[contains(@class, "product-wrapper")]')
+    select = Select(wait_for(driver, '//select[@id="numPerPage"]'))
     select.select_by_value('50')
+    if product_wrappers:
+        # Changing the page size reloads the listings
+        wait_until_stale(driver, product_wrappers[0])
 
+    listing_urls = []
     while True:
-        product_wrappers = driver.find_elements(
-                By.XPATH,
+        product_wrappers = wait_for_all(
+                driver,
                 '//div[contains(@class, "product-wrapper")]',
             )
         #print(len(product_wrappers))
@@ -54,28 +60,41 @@ for winetype,url in urls.items():
             listing = product_wrapper.find_element(By.XPATH,'.//a')
             listing_urls.append([winetype, listing.get_attribute('href')])
         print(len(listing_urls))
-        
-        try:
-            next_button = driver.find_element(By.XPATH,'//a[@id="nextPage"]')
-            if next_button.is_displayed():
-                click_next = True
-        except:
-            click_next = False
-        
-        if click_next:
-            try:
-                next_button.click()
-            except:
-                break
-        else:
+
+        next_buttons = [
+            button for button in driver.find_elements(By.XPATH,'//a[@id="nextPage"]')
+            if button.is_displayed()
+        ]
+        if not product_wrappers or not next_buttons:
             print('End of type' + winetype)
             break
 
-# %%
-listing_urls_path = Path('./data/url/laithwaites_listings.json')
-export_path = './data/scrapped/virginwines_listings.csv'
-with open(listing_urls_path, 'w') as f:
-        json.dump(listing_urls, f, indent=4)
+        try:
+            next_buttons[0].click()
+        except WebDriverException:
+            break
+        wait_until_stale(driver, product_wrappers[0])
+
+    return listing_urls
+
+
+def discover_listings_browser(urls, workers=WORKERS):
+    return crawl_categories(urls, discover_category, workers)
+
+
+# Category pages are URL-addressable (Nrpp: listings per page, No: offset of the first
+# listing), so they are fetched over plain HTTP first
+LISTING_LINKS = compile_links('//div[contains(@class, "product-wrapper")]/descendant::a[1]/@href')
+PAGE_SIZE = 50
+
+
+def get_page_url(url, pagenum):
+    return f'{url}?Nrpp={PAGE_SIZE}&No={(pagenum - 1) * PAGE_SIZE}'
+
+
+def discover_listings():
+    return discover_listings_http(urls, get_page_url, LISTING_LINKS, fallback=discover_listings_browser)
+
 
 # %%
 def clean_text_data(value):
@@ -105,13 +124,11 @@ def try_catch(web_element):
     except:
         return '0'
 
+
 # %%
-wine_info_all = []
-listing_urls_path = Path('./data/url/laithwaites_listings.json')
-listing_urls = json.load(open(listing_urls_path))
-for winetype,listing_url in tqdm(listing_urls):
-    listing_page = requests.get(listing_url)
-    soup = BeautifulSoup(listing_page.content, 'html.parser')
+def parse_listing_soup(winetype, listing_url, content):
+    # Original BeautifulSoup path, kept as the reference for bench_parsing.py
+    soup = make_soup(content)
     wine_data = {}
     #name
     wine_data['name'] = clean_text_data(try_catch(soup.find('h1', {'class' : 'prod-name'})))
@@ -150,16 +167,76 @@ for winetype,listing_url in tqdm(listing_urls):
         wine_data['rating'] = try_catch(soup.find('span', {'class' : 'rating-score'})).split(' ')[0]
         wine_data['url'] = listing_url
         #print(wine_data)
-    wine_info_all.append(wine_data)
+    return wine_data
 
 
 # %%
-wine_info_all
+INNER_SELECTORS = compile_selectors({
+    'detail_text': 'div.detail-text',
+    'country': 'div.detail-text a',
+})
+
+
+def get_details(info_column):
+    # Texts of the product details listed in one of the two info columns
+    details = []
+    for li in info_column.iter('li'):
+        detail_text = INNER_SELECTORS['detail_text'](li)
+        details.append(clean_text_data(detail_text[0].text_content()) if detail_text else '0')
+    return details
+
+
+def get_country(country_icon):
+    country = INNER_SELECTORS['country'](country_icon.getparent())
+    return clean_text_data(country[0].text_content() if country else '0')
+
+
+SPEC = {
+    'name': Field('h1.prod-name', post=clean_text_data, default='0'),
+    'info_left': Field('div.col-lg-6.no-pad-left'),
+    'info_right': Field('div.col-lg-6.no-pad', get=get_details),
+    'abv': Field(source='info_right', post=lambda details: details[0].split(' ')[0].replace('%', '')),
+    'size': Field(source='info_right', post=lambda details: float(details[2].split(' ')[0])),
+    'country': Field('span.country-icon', get=get_country),
+    # Price per bottle, which may not be the price of the offer in the structured data
+    'price': Field('span.price-per-bottle', post=lambda price: float(price.replace('£', ''))),
+    'num_review': Field(
+        'span.no-reviews',
+        post=lambda reviews: reviews.replace('(', '').replace(')', '').split(' ')[0],
+        default='0',
+        structured='num_review',
+    ),
+    'rating': Field(
+        'span.rating-score', post=lambda rating: rating.split(' ')[0], default='0', structured='rating'
+    ),
+}
+EXTRACTOR = compile_spec(SPEC, 'laithwaites')
 
-# %%
-df = pd.DataFrame(wine_info_all)
 
-export_path = './data/scrapped/laithwaites_listings.csv'
-df.to_csv(export_path, index=False)
+def parse_listing(winetype, listing_url, content):
+    fields = EXTRACTOR.parse(content)
+    wine_data = {'name': fields['name']}
+    if wine_data['name'].split(' ')[-1].lower() == 'mix' or wine_data['name'].split(' ')[0].lower() == 'mystery':
+        wine_data['Mix Case?'] = 1
+        return wine_data
+
+    require(fields, 'info_left', 'info_right', 'size')
+    wine_data['Mix Case?'] = 0
+    wine_data['abv'] = fields['abv']
+    wine_data['year'] = wine_data['name'].split(' ')[-1]
+    wine_data['size'] = fields['size']
+    if fields['country'] is not None:
+        wine_data['country'] = fields['country']
+    wine_data['wine_type'] = winetype
+    for column in ['price', 'num_review', 'rating']:
+        wine_data[column] = fields[column]
+    wine_data['url'] = listing_url
+    return wine_data
 
 
+# %%
+if __name__ == '__main__':
+    run_scraper(
+        listing_urls_path, discover_listings, parse_listing,
+        checkpoint_path, export_path, state_path,
+    )
@@ -1,104 +1,83 @@
-import json
 import re
-import time
 from pathlib import Path
 
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver import Chrome
 from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from tqdm import tqdm
+from selenium.webdriver.support.ui import WebDriverWait
+
+from browser_pool import (
+    WAIT,
+    WORKERS,
+    accept_cookies,
+    click_if_present,
+    crawl_categories,
+    wait_for,
+)
+from extraction import Field, compile_spec, html, require
+from metrics import METRICS
+from parsing import compile_selectors, make_soup
+from runner import run_scraper
 
 listing_urls_path = Path('./data/url/morrissons_listings.json')
-export_path = './data/scraped/morrissons_listings.csv'
-
-if not listing_urls_path.exists():
-    driver = Chrome()
-    listing_urls = []
-
-    wine_type_urls = {
-        'white': 'https://groceries.morrisons.com/browse/beer-wines-spirits-103120/wine-champagne-176432/white-wine-176434',
-        'rose': 'https://groceries.morrisons.com/browse/beer-wines-spirits-103120/wine-champagne-176432/rose-wine-176435',
-        'sparkling': 'https://groceries.morrisons.com/browse/beer-wines-spirits-103120/wine-champagne-176432/champagne-sparkling-wine-176436',
-        'red': 'https://groceries.morrisons.com/browse/beer-wines-spirits-103120/wine-champagne-176432/red-wine-176433',
-        'fortified_and_other': 'https://groceries.morrisons.com/browse/beer-wines-spirits-103120/wine-champagne-176432/fortified-wines-miscellaneous-176441',
-    }
-
-    for wine_type, wine_type_url in wine_type_urls.items():
-        driver.get(wine_type_url)
-
-        driver.maximize_window()
-
-        time.sleep(2)
-
-        # Accept cookies
-        try:
-            cookie_button = driver.find_element(
-                By.XPATH,
-                '//button[@id="onetrust-accept-btn-handler"]'
-            )
-            cookie_button.click()
-        except NoSuchElementException:
-            pass
-
-        # Show all listings
-        while True:
-            banner = driver.find_element(
-                By.XPATH,
-                '//body[@class="app-page"]'
-            )
-            for _ in range(10):
-                banner.send_keys(Keys.PAGE_DOWN)
-                time.sleep(0.2)
-            try:
-                show_more_button = driver.find_element(
-                    By.XPATH,
-                    '//button[@class="btn-primary show-more"]'
-                )
-
-                show_more_button.click()
-                time.sleep(3)
-            except NoSuchElementException:
-                break
-
-        # Shop section
-        shop_section = driver.find_element(
-            By.XPATH,
-            '//ul[contains(@class, "fops fops-regular fops-shelf")]'
+export_path = './data/scrapped/morrissons_listings.csv'
+checkpoint_path = Path('./data/checkpoints/morrissons.sqlite')
+state_path = Path('./data/state/morrissons.sqlite')
+
+wine_type_urls = {
+    'white': 'https://groceries.morrisons.com/browse/beer-wines-spirits-103120/wine-champagne-176432/white-wine-176434',
+    'rose': 'https://groceries.morrisons.com/browse/beer-wines-spirits-103120/wine-champagne-176432/rose-wine-176435',
+    'sparkling': 'https://groceries.morrisons.com/browse/beer-wines-spirits-103120/wine-champagne-176432/champagne-sparkling-wine-176436',
+    'red': 'https://groceries.morrisons.com/browse/beer-wines-spirits-103120/wine-champagne-176432/red-wine-176433',
+    'fortified_and_other': 'https://groceries.morrisons.com/browse/beer-wines-spirits-103120/wine-champagne-176432/fortified-wines-miscellaneous-176441',
+}
+
+
+LISTING_XPATH = (
+    '//ul[contains(@class, "fops fops-regular fops-shelf")]'
+    '//div[contains(@class,"fop-contentWrapper")]'
+)
+
+
+def get_listing_url(driver, listing):
+    # Listings are rendered lazily as the page is scrolled, bring empty ones into view
+    links = listing.find_elements(By.XPATH, './/a')
+    if not links:
+        driver.execute_script('arguments[0].scrollIntoView();', listing)
+        links = [WebDriverWait(listing, WAIT).until(lambda listing: listing.find_element(By.XPATH, './/a'))]
+    return links[0].get_attribute('href')
+
+
+def discover_category(driver, wine_type, wine_type_url):
+    driver.get(wine_type_url)
+
+    accept_cookies(driver)
+
+    # Show all listings
+    wait_for(driver, LISTING_XPATH)
+    while True:
+        shown = len(driver.find_elements(By.XPATH, LISTING_XPATH))
+        driver.execute_script('window.scrollTo(0, document.body.scrollHeight);')
+        if not click_if_present(driver, '//button[@class="btn-primary show-more"]'):
+            break
+
+        # Wait for the next batch of listings instead of sleeping
+        WebDriverWait(driver, WAIT).until(
+            lambda driver: len(driver.find_elements(By.XPATH, LISTING_XPATH)) > shown
         )
 
-        # Find listings
-        listings = shop_section.find_elements(
-            By.XPATH,
-            '//div[contains(@class,"fop-contentWrapper")]'
-        )
+    listings = driver.find_elements(By.XPATH, LISTING_XPATH)
+    return [[wine_type, get_listing_url(driver, listing)] for listing in listings]
 
-        print(f'Found {len(listings)} {wine_type} listings')
 
-        for listing in listings:
-            listing_urls.append(
-                [
-                    wine_type,
-                    listing.find_element(
-                        By.XPATH,
-                        './/a',
-                    ).get_attribute('href'),
-                ]
-            )
+def discover_listings(workers=WORKERS):
+    # Listings are rendered by JS (show more button), so this needs the browser
+    return crawl_categories(wine_type_urls, discover_category, workers)
 
-    print(f'Found {len(listing_urls)} listings in total')
 
-    with open(listing_urls_path, 'w') as f:
-        json.dump(listing_urls, f, indent=4)
-else:
-    listing_urls = json.load(open(listing_urls_path))
+def get_bottle_size(soup):
+    return get_bottle_size_from_text(soup.find(class_='bop-catchWeight').text)
 
 
-def get_bottle_size(soup):
-    size_str = soup.find(class_='bop-catchWeight').text
+def get_bottle_size_from_text(size_str):
     size_numeric = float(re.sub('[a-zA-Z]', '', size_str))
 
     # If size is denoted in L
@@ -150,7 +129,11 @@ def get_num_reviews(soup):
 def get_origin_from_description(soup):
     product_description = soup.find(
         class_='bop-section bop-productDetails gn-accordion')
-    product_description_splitted = re.split('[,.!?<>\']', str(product_description))
+    return get_origin_from_description_html(str(product_description))
+
+
+def get_origin_from_description_html(product_description):
+    product_description_splitted = re.split('[,.!?<>\']', product_description)
 
     # Country of origin is usually specified near the bottom
     for chunk in product_description_splitted[::-1]:
@@ -159,11 +142,9 @@ def get_origin_from_description(soup):
                 return chunk.replace(keyword, '').strip()
 
 
-wine_info_all = []
-
-for wine_type, listing_url in tqdm(listing_urls):
-    listing_page = requests.get(listing_url)
-    soup = BeautifulSoup(listing_page.content, 'html.parser')
+def parse_listing_soup(wine_type, listing_url, content):
+    # Original BeautifulSoup path, kept as the reference for bench_parsing.py
+    soup = make_soup(content)
 
     wine_info = {}
 
@@ -172,7 +153,7 @@ for wine_type, listing_url in tqdm(listing_urls):
         wine_info['size (cL)'] = get_bottle_size(soup)
     except AttributeError:
         # Skip non-wine listings, e.g., https://groceries.morrisons.com/products/freixenet-prosecco-20cl-luxury-scented-candle-gift-set-566440011
-        continue
+        return None
     wine_info['name'] = get_name(soup)
     wine_info['price'] = get_price(soup)
     wine_info['rating'] = get_rating(soup)
@@ -198,7 +179,74 @@ for wine_type, listing_url in tqdm(listing_urls):
         wine_info['country'] = get_origin_from_description(soup)
     wine_info['url'] = listing_url
 
-    wine_info_all.append(wine_info)
+    return wine_info
 
-wine_info_df = pd.DataFrame(wine_info_all)
-wine_info_df.to_csv(export_path, index=False)
+
+INNER_SELECTORS = compile_selectors({
+    'rating': '.gn-rating__inactiveLayer [itemprop="ratingValue"]',
+    'info_content': '.bop-info__content',
+})
+
+
+def get_title_without_size(title_wrapper):
+    title_tag = title_wrapper.find('.//h1')
+
+    # remove the bottle size from the title
+    title_tag.find('.//span').drop_tree()
+
+    return title_tag.text_content().strip()
+
+
+def get_info_field(info_tag):
+    # (title, content) of a product information field, None for fields without any title
+    title = info_tag.find('.//h6')
+    if title is None:
+        return None
+    return title.text_content(), INNER_SELECTORS['info_content'](info_tag)[0].text_content()
+
+
+SPEC = {
+    'size (cL)': Field('.bop-catchWeight', post=get_bottle_size_from_text),
+    'name': Field('.bop-title', get=get_title_without_size),
+    'price': Field('.bop-price__current', post=lambda price: float(price.replace('£', '')), structured='price'),
+    # The product's aggregate rating, the reviews of the page have a ratingValue each
+    'rating': Field(
+        '.bop-titleInfoWrapper',
+        get=lambda wrapper: INNER_SELECTORS['rating'](wrapper)[0].get('content'),
+        post=float,
+        structured='rating',
+    ),
+    'num_review': Field(
+        '.gn-rating__voteCount', post=lambda count: int(re.sub(r'\W+', '', count)), structured='num_review'
+    ),
+    'info': Field('.bop-info__field', many=True, get=get_info_field, post=lambda fields: dict(filter(None, fields))),
+    'origin': Field('.bop-productDetails', get=html, post=get_origin_from_description_html),
+    'country': Field(source='info', post=lambda info: info['Country of Origin'] or None, fallback='origin'),
+    'abv': Field(source='info', post=lambda info: float(info['ABV (%)'])),
+    # Can't convert to int as some listings don't specify the year
+    'year': Field(source='info', post=lambda info: info['Current Vintage']),
+}
+EXTRACTOR = compile_spec(SPEC, 'morrissons')
+
+
+def parse_listing(wine_type, listing_url, content):
+    fields = EXTRACTOR.parse(content)
+    if fields['size (cL)'] is None:
+        # Skip non-wine listings, e.g., https://groceries.morrisons.com/products/freixenet-prosecco-20cl-luxury-scented-candle-gift-set-566440011
+        METRICS.count('skipped', retailer='morrissons', reason='not a wine')
+        return None
+    require(fields, 'name', 'price', 'rating', 'num_review')
+
+    wine_info = {'wine_type': wine_type}
+    for column in ['size (cL)', 'name', 'price', 'rating', 'num_review', 'country', 'abv', 'year']:
+        wine_info[column] = fields[column]
+    wine_info['url'] = listing_url
+
+    return wine_info
+
+
+if __name__ == '__main__':
+    run_scraper(
+        listing_urls_path, discover_listings, parse_listing,
+        checkpoint_path, export_path, state_path,
+    )
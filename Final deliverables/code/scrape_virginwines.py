@@ -1,20 +1,27 @@
-import json
-import time
 from pathlib import Path
 
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup
-from selenium.webdriver import Chrome
-from selenium.webdriver.common.by import By
-from tqdm import tqdm
+from browser_pool import make_driver, wait_for_all
+from extraction import Field, attr, compile_spec, require
+from http_discovery import compile_links, discover_listings_http
+from parsing import make_soup
+from runner import run_scraper
 
 listing_urls_path = Path('./data/url/virginwines_listings.json')
 export_path = './data/scrapped/virginwines_listings.csv'
+checkpoint_path = Path('./data/checkpoints/virginwines.sqlite')
+state_path = Path('./data/state/virginwines.sqlite')
 
-if not listing_urls_path.exists():
-    driver = Chrome()
 
+def discover_listings_browser():
+    driver = make_driver()
+    # A wait that times out must not leave the browser running
+    try:
+        return discover_pages(driver)
+    finally:
+        driver.quit()
+
+
+def discover_pages(driver):
     listing_urls = []
 
     pagenum = 1
@@ -23,9 +30,11 @@ if not listing_urls_path.exists():
 
         driver.get(listing_page_url)
 
-        listings = driver.find_elements(
-            By.XPATH,
+        # Past the last page there is nothing to wait for, so don't wait for too long
+        listings = wait_for_all(
+            driver,
             '//a[contains(@class, "text-underline") and contains(@data-gacategory, "wine-plp")]',
+            timeout=5,
         )
 
         if not listings:
@@ -39,12 +48,30 @@ if not listing_urls_path.exists():
         print(f'Found {len(listings)} listings on page {pagenum}')
 
         pagenum = pagenum + 1
-        time.sleep(1)
 
-    with open(listing_urls_path, 'w') as f:
-        json.dump(listing_urls, f, indent=4)
-else:
-    listing_urls = json.load(open(listing_urls_path))
+    return listing_urls
+
+
+# The browse pages are URL-addressable, so they are fetched over plain HTTP, Selenium is
+# only used when they can't be
+LISTING_LINKS = compile_links(
+    '//a[contains(@class, "text-underline") and contains(@data-gacategory, "wine-plp")]/@href'
+)
+
+
+def get_page_url(browse_url, pagenum):
+    return f'{browse_url}?page={pagenum}&pageSize=96'
+
+
+def discover_listings():
+    listing_urls = discover_listings_http(
+        {None: 'https://www.virginwines.co.uk/browse'},
+        get_page_url,
+        LISTING_LINKS,
+        fallback=lambda _: [(None, listing_url) for listing_url in discover_listings_browser()],
+    )
+    # Virgin Wines listings are stored as plain URLs
+    return [listing_url for _, listing_url in listing_urls]
 
 
 def clean_text_data(value):
@@ -57,8 +84,10 @@ def get_price(soup):
 
 
 def get_bottle_size(li_tags):
-    bottle_size_raw = clean_text_data(li_tags[2].find('span').text)
+    return get_bottle_size_from_text(clean_text_data(li_tags[2].find('span').text))
+
 
+def get_bottle_size_from_text(bottle_size_raw):
     if 'cl' in bottle_size_raw:
         return float(bottle_size_raw.replace('cl', ''))
     elif bottle_size_raw == 'Magnum 1.5L':
@@ -67,11 +96,9 @@ def get_bottle_size(li_tags):
         raise ValueError(f'edge case found {bottle_size_raw}')
 
 
-wine_info_all = []
-
-for listing_url in tqdm(listing_urls):
-    listing_page = requests.get(listing_url)
-    soup = BeautifulSoup(listing_page.content, 'html.parser')
+def parse_listing_soup(wine_type, listing_url, content):
+    # Original BeautifulSoup path, kept as the reference for bench_parsing.py
+    soup = make_soup(content)
 
     wine_data = {}
 
@@ -121,7 +148,49 @@ for listing_url in tqdm(listing_urls):
     )
     wine_data['url'] = listing_url
 
-    wine_info_all.append(wine_data)
+    return wine_data
 
-df = pd.DataFrame(wine_info_all)
-df.to_csv(export_path, index=False)
+
+def get_attribute_text(li_tag):
+    # ABV, vintage and bottle size are shown in black boxes, the value being in a span
+    return clean_text_data(li_tag.find('.//span').text_content())
+
+
+SPEC = {
+    'name': Field('h1.h4.mt-3.mb-2', structured='name'),
+    'attributes': Field('li.text-white.bg-black', many=True, get=get_attribute_text),
+    'abv': Field(source='attributes', post=lambda attributes: float(attributes[0].replace('%', ''))),
+    'year': Field(source='attributes', post=lambda attributes: attributes[1]),
+    'size (cL)': Field(source='attributes', post=lambda attributes: get_bottle_size_from_text(attributes[2])),
+    'country': Field('a[data-gaaction=country-link]', post=clean_text_data),
+    'wine_type': Field('a[data-gaaction=wine-category-link]'),
+    'price': Field('p.price.text-sanchez', post=lambda price: float(price.replace('£', '')), structured='price'),
+    'num_review': Field('meta[itemprop=reviewCount]', get=attr('content'), structured='itemprop.reviewCount'),
+    'rating': Field(
+        'span#prod-content-review-count',
+        get=attr('data-original-title'),
+        post=lambda title: float(title.split(' ')[0]),
+        structured='rating',
+    ),
+}
+EXTRACTOR = compile_spec(SPEC, 'virginwines')
+
+
+def parse_listing(wine_type, listing_url, content):
+    # Virgin Wines listings are not grouped by wine type, it is read from the page instead
+    fields = EXTRACTOR.parse(content)
+    require(fields, 'name', 'abv', 'size (cL)', 'price', 'num_review', 'rating')
+
+    wine_data = {}
+    for column in ['name', 'abv', 'year', 'size (cL)', 'country', 'wine_type', 'price', 'num_review', 'rating']:
+        wine_data[column] = fields[column]
+    wine_data['url'] = listing_url
+
+    return wine_data
+
+
+if __name__ == '__main__':
+    run_scraper(
+        listing_urls_path, discover_listings, parse_listing,
+        checkpoint_path, export_path, state_path,
+    )
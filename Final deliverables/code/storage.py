@@ -0,0 +1,222 @@
+import argparse
+import math
+from datetime import date
+from itertools import islice
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Typed, columnar copies of the scraped and merged datasets. The CSVs lose their dtypes at
+# every pd.read_csv ('NV' years, 'out of stock' prices, 'TBC' ABVs...), the Parquet
+# datasets keep them, and low cardinality columns are dictionary encoded.
+PARQUET_DIR = Path('./data/parquet')
+LISTINGS_DIR = PARQUET_DIR / 'listings'
+MERGED_DIR = PARQUET_DIR / 'all_retailers'
+
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+# Scraped listings, one partition per retailer and scrape date
+LISTINGS_PARTITIONING = pa.schema([('retailer', CATEGORY), ('snapshot', pa.date32())])
+LISTINGS_SCHEMA = pa.schema([
+    ('name', pa.string()),
+    ('wine_type', CATEGORY),
+    ('country', CATEGORY),
+    ('size (cL)', pa.float64()),
+    ('price', pa.float64()),
+    ('in_stock', pa.bool_()),
+    ('abv', pa.float64()),
+    ('year', pa.int16()),
+    ('non_vintage', pa.bool_()),
+    ('rating', pa.float64()),
+    ('num_review', pa.int32()),
+    ('Mix Case?', pa.bool_()),
+    ('url', pa.string()),
+])
+
+# Output of the merge notebook (all_retailers.csv), one partition per retailer
+MERGED_PARTITIONING = pa.schema([('retailer', CATEGORY)])
+MERGED_SCHEMA = pa.schema([
+    ('name', pa.string()),
+    ('abv', pa.float64()),
+    ('year', pa.int16()),
+    ('non_vintage', pa.bool_()),
+    ('size(cL)', pa.float64()),
+    ('country', CATEGORY),
+    ('wine_type', CATEGORY),
+    ('price', pa.float64()),
+    ('num_review', pa.int32()),
+    ('rating', pa.float64()),
+    ('url', pa.string()),
+    ('countrycode', CATEGORY),
+    ('scaled_price', pa.float64()),
+    ('logprice', pa.float64()),
+    ('price_fixed', pa.float64()),
+    ('age', pa.float64()),
+    ('score', pa.float64()),
+])
+
+NON_VINTAGE = ['NV', 'Non Vintage']
+# Scraped rows are converted and written this many at a time
+BATCH_ROWS = 10_000
+
+
+def to_number(values):
+    # Placeholders ('TBC', 'out of stock', ...) become missing values
+    return pd.to_numeric(values, errors='coerce')
+
+
+def to_float(value):
+    # Same for a single scraped value: strings ('TBC', 'out of stock', '') or numbers
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) else value
+
+
+def split_year(values):
+    # Years come as 2021, '2021.0', 'NV' or words picked up from the name ('Gift', 'Case')
+    text = values.astype('string').str.strip()
+    year = to_number(text)
+    year = year.where(year.between(1800, 2100)).astype('Int16')
+    return year, text.isin(NON_VINTAGE)
+
+
+def to_table(data, schema):
+    # Missing columns are filled with nulls, extra ones are dropped
+    data = data.reindex(columns=schema.names)
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            data[field.name] = data[field.name].astype('string').astype('category')
+    return pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+
+
+def listings_table(rows):
+    # rows: scraped listings (dicts or a DataFrame) of a single retailer
+    data = pd.DataFrame(rows)
+    if 'size' in data:
+        # Laithwaites gives sizes in ml
+        data['size (cL)'] = to_number(data.pop('size')) / 10
+    if 'price' in data:
+        data['in_stock'] = data['price'] != 'out of stock'
+    if 'year' in data:
+        data['year'], data['non_vintage'] = split_year(data['year'])
+    if 'Mix Case?' in data:
+        data['Mix Case?'] = data['Mix Case?'].fillna(0).astype(bool)
+
+    for column in ['size (cL)', 'price', 'abv', 'rating']:
+        if column in data:
+            data[column] = to_number(data[column])
+    if 'num_review' in data:
+        data['num_review'] = to_number(data['num_review']).astype('Int32')
+    return to_table(data, LISTINGS_SCHEMA)
+
+
+def merged_table(data):
+    data = data.drop(columns=['Unnamed: 0'], errors='ignore').copy()
+    data['year'], data['non_vintage'] = split_year(data['year'])
+    for column in ['abv', 'size(cL)', 'price', 'rating', 'scaled_price', 'logprice', 'price_fixed', 'age', 'score']:
+        data[column] = to_number(data[column])
+    data['num_review'] = to_number(data['num_review']).astype('Int32')
+    table = to_table(data, MERGED_SCHEMA)
+    return table.append_column('retailer', pa.array(data['retailer'].astype(str)).dictionary_encode())
+
+
+def write_dataset(table, root, partitioning):
+    # Partitions being written are replaced, e.g. when a retailer is re-scraped on the same day
+    pq.write_to_dataset(
+        table,
+        root,
+        partitioning=ds.partitioning(partitioning, flavor='hive'),
+        existing_data_behavior='delete_matching',
+    )
+
+
+def row_batches(rows, size=BATCH_ROWS):
+    # rows: a DataFrame, or an iterable of dicts that is only read size rows at a time
+    if isinstance(rows, pd.DataFrame):
+        for start in range(0, len(rows), size):
+            yield rows.iloc[start:start + size]
+        return
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_listings(rows, retailer, snapshot=None, root=LISTINGS_DIR):
+    # rows: scraped listings of a single retailer, streamed to the partition of the retailer
+    # and snapshot BATCH_ROWS at a time
+    schema = LISTINGS_SCHEMA.append(pa.field('retailer', CATEGORY)).append(pa.field('snapshot', pa.date32()))
+
+    def batches():
+        for batch in row_batches(rows):
+            table = listings_table(batch)
+            table = table.append_column(
+                'retailer', pa.array([retailer] * len(table), CATEGORY.value_type).dictionary_encode()
+            )
+            table = table.append_column(
+                'snapshot', pa.array([snapshot or date.today()] * len(table), pa.date32())
+            )
+            yield from table.to_batches()
+
+    # The partition being written is replaced, e.g. when a retailer is re-scraped on the same day
+    ds.write_dataset(
+        batches(),
+        root,
+        schema=schema,
+        format='parquet',
+        partitioning=ds.partitioning(LISTINGS_PARTITIONING, flavor='hive'),
+        existing_data_behavior='delete_matching',
+    )
+
+
+def write_merged(data, root=MERGED_DIR):
+    write_dataset(merged_table(data), root, MERGED_PARTITIONING)
+
+
+def read_dataset(root, partitioning, columns=None, filters=None):
+    # Dictionary columns come back as pandas categoricals
+    table = pq.read_table(
+        root,
+        columns=columns,
+        filters=filters,
+        partitioning=ds.partitioning(partitioning, flavor='hive', dictionaries='infer'),
+    )
+    return table.to_pandas()
+
+
+def read_listings(columns=None, filters=None, root=LISTINGS_DIR):
+    # e.g. read_listings(filters=[('retailer', '=', 'decantalo'), ('snapshot', '>=', date(2022, 11, 1))])
+    return read_dataset(root, LISTINGS_PARTITIONING, columns, filters)
+
+
+def read_merged(columns=None, filters=None, root=MERGED_DIR):
+    return read_dataset(root, MERGED_PARTITIONING, columns, filters)
+
+
+def main():
+    # Converts the existing CSVs, run from the 'Final deliverables' folder
+    parser = argparse.ArgumentParser(description='Convert the scraped and merged CSVs to Parquet')
+    parser.add_argument('--snapshot', type=date.fromisoformat, default=date.today(),
+                        help='scrape date of the CSVs in data/scrapped/ (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    for path in sorted(Path('./data/scrapped').glob('*_listings.csv')):
+        retailer = path.name.split('_')[0]
+        write_listings(pd.read_csv(path), retailer, args.snapshot)
+        print(f'{path} -> {LISTINGS_DIR}')
+
+    merged_path = Path('./data/all_retailers.csv')
+    if merged_path.exists():
+        write_merged(pd.read_csv(merged_path))
+        print(f'{merged_path} -> {MERGED_DIR}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+# Shared work queue, so a run can be spread over several worker processes (or hosts).
+# The listings of data/url/*.json are queued once per run, one task per page (canonical
+# URL, see canonical.py), and the results of a page are copied back to all its listings
+# on export. Workers lease the pages in batches,
+# fetch and parse them with the extractors of the scrape_*.py scripts, and hand the results
+# back. A lease that is not completed within LEASE_SECONDS (crashed or stuck worker) goes
+# back to the queue. A result is only accepted from the current holder of the lease, in
+# the same transaction that marks the listing done, so every listing has exactly one
+# result per run however many workers fetched it.
+#
+# The queue is a SQLite file, fine for the processes of one machine. For several hosts,
+# lease() and complete() are the only operations to move to a shared database (or Redis).
+# Run from the 'Final deliverables' folder:
+#   python code/work_queue.py enqueue --run 2023-01-15
+#   python code/work_queue.py work --run 2023-01-15        (as many times as wanted)
+#   python code/work_queue.py export --run 2023-01-15
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+from cache import PageCache
+from canonical import CanonicalIndex
+from fetcher import Result, scrape
+from runner import enriched, load_listings, publish
+
+QUEUE_PATH = Path('./data/queue.sqlite')
+# Workers that don't complete a lease within this time are considered dead
+LEASE_SECONDS = 300
+BATCH_SIZE = 50
+# Listings leased this many times without a result (e.g. crashing the workers) are given up
+MAX_LEASES = 3
+# Wait between two checks for expired leases, when everything left is leased
+POLL_SECONDS = 5
+
+
+def retailer_modules():
+    import scrape_decantalo
+    import scrape_laithwaites
+    import scrape_morrissons
+    import scrape_virginwines
+
+    return {
+        'decantalo': scrape_decantalo,
+        'laithwaites': scrape_laithwaites,
+        'morrissons': scrape_morrissons,
+        'virginwines': scrape_virginwines,
+    }
+
+
+class WorkQueue:
+    # The connection is shared with the fetcher thread (which pulls the leased listings),
+    # so every operation holds the lock
+
+    def __init__(self, path=QUEUE_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY,
+                run TEXT NOT NULL,
+                retailer TEXT NOT NULL,
+                wine_type TEXT,
+                url TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                lease_token TEXT,
+                lease_expires REAL NOT NULL DEFAULT 0,
+                leases INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (run, retailer, url, wine_type)
+            );
+            -- Virgin Wines listings have no wine type, and NULLs are never equal in UNIQUE
+            CREATE UNIQUE INDEX IF NOT EXISTS tasks_key ON tasks (run, retailer, url, IFNULL(wine_type, ''));
+            CREATE INDEX IF NOT EXISTS tasks_lease ON tasks (run, retailer, status, lease_expires);
+            CREATE TABLE IF NOT EXISTS listings (
+                run TEXT NOT NULL,
+                retailer TEXT NOT NULL,
+                wine_type TEXT,
+                url TEXT NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS listings_key ON listings (run, retailer, url, IFNULL(wine_type, ''));
+            CREATE TABLE IF NOT EXISTS results (
+                task_id INTEGER PRIMARY KEY REFERENCES tasks (id),
+                http_status INTEGER,
+                row TEXT,
+                error TEXT,
+                worker TEXT NOT NULL,
+                finished_at TEXT NOT NULL
+            );
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock at once, so two workers can't read the same
+        # free tasks before either marks them leased
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def enqueue(self, run, retailer, listings):
+        # Variants and category duplicates of a page share a single task. Queuing the same
+        # listings twice for a run does nothing. Returns the number of pages queued.
+        index = CanonicalIndex(listings)
+        with self.lock:
+            self.transaction()
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO listings (run, retailer, wine_type, url) VALUES (?, ?, ?, ?)',
+                ((run, retailer, wine_type, url) for group in index.groups.values() for wine_type, url in group),
+            )
+            count = self.conn.executemany(
+                'INSERT OR IGNORE INTO tasks (run, retailer, wine_type, url) VALUES (?, ?, ?, ?)',
+                ((run, retailer, wine_type, url) for wine_type, url in index.fetches()),
+            ).rowcount
+            self.conn.execute('COMMIT')
+        return count
+
+    def lease(self, run, retailer, count=BATCH_SIZE, lease_seconds=LEASE_SECONDS):
+        # Queued listings, or listings whose lease has expired. Returns (id, token, wine_type,
+        # url) tuples, the token is needed to complete them.
+        now = time.time()
+        with self.lock:
+            self.transaction()
+            self.conn.execute(
+                "UPDATE tasks SET status = 'dead' "
+                "WHERE run = ? AND retailer = ? AND status = 'leased' AND lease_expires < ? AND leases >= ?",
+                (run, retailer, now, MAX_LEASES),
+            )
+            tasks = self.conn.execute(
+                "SELECT id, wine_type, url FROM tasks "
+                "WHERE run = ? AND retailer = ? AND status IN ('queued', 'leased') AND lease_expires < ? "
+                "ORDER BY lease_expires, id LIMIT ?",
+                (run, retailer, now, count),
+            ).fetchall()
+            token = uuid.uuid4().hex
+            self.conn.executemany(
+                "UPDATE tasks SET status = 'leased', lease_token = ?, lease_expires = ?, leases = leases + 1 "
+                "WHERE id = ?",
+                ((token, now + lease_seconds, task_id) for task_id, _, _ in tasks),
+            )
+            self.conn.execute('COMMIT')
+        return [(task_id, token, wine_type, url) for task_id, wine_type, url in tasks]
+
+    def complete(self, worker, completed):
+        # completed: ((task_id, token), fetcher.Result) pairs. Results whose lease has been
+        # taken over by another worker are dropped. Returns the number of results kept.
+        finished_at = datetime.now(timezone.utc).isoformat()
+        kept = 0
+        with self.lock:
+            self.transaction()
+            for (task_id, token), result in completed:
+                done = self.conn.execute(
+                    "UPDATE tasks SET status = 'done' WHERE id = ? AND lease_token = ? AND status = 'leased'",
+                    (task_id, token),
+                ).rowcount
+                if not done:
+                    continue
+                self.conn.execute(
+                    'INSERT INTO results (task_id, http_status, row, error, worker, finished_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (
+                        task_id,
+                        result.status,
+                        None if result.row is None else json.dumps(result.row),
+                        result.error,
+                        worker,
+                        finished_at,
+                    ),
+                )
+                kept += 1
+            self.conn.execute('COMMIT')
+        return kept
+
+    def unfinished(self, run, retailer):
+        with self.lock:
+            (count,) = self.conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE run = ? AND retailer = ? AND status IN ('queued', 'leased')",
+                (run, retailer),
+            ).fetchone()
+        return count
+
+    def listings(self, run, retailer):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT wine_type, url FROM listings WHERE run = ? AND retailer = ? ORDER BY rowid',
+                (run, retailer),
+            ).fetchall()
+
+    def results(self, run, retailer):
+        # fetcher.Result of every page done
+        for _, result in self.finished_results(run, retailer):
+            yield result
+
+    def finished_results(self, run, retailer):
+        # (finished_at, fetcher.Result) of every page done. Streamed BATCH_SIZE results at a
+        # time, the lock is only held while fetching a batch.
+        with self.lock:
+            cursor = self.conn.execute('''
+                SELECT r.finished_at, t.wine_type, t.url, r.http_status, r.row, r.error
+                FROM results r JOIN tasks t ON t.id = r.task_id
+                WHERE t.run = ? AND t.retailer = ?
+                ORDER BY t.id
+            ''', (run, retailer))
+        while True:
+            with self.lock:
+                batch = cursor.fetchmany(BATCH_SIZE)
+            if not batch:
+                return
+            for finished_at, wine_type, url, status, row, error in batch:
+                row = None if row is None else json.loads(row)
+                yield finished_at, Result(wine_type, url, status, row, error)
+
+    def rows(self, run, retailer):
+        # Rows of every listing, from the result of its page
+        for _, row in self.fetched_rows(run, retailer):
+            yield row
+
+    def fetched_rows(self, run, retailer):
+        # (fetched_at, row) of every listing, from the result of its page
+        index = CanonicalIndex(self.listings(run, retailer))
+        for finished_at, result in self.finished_results(run, retailer):
+            for listing in index.fan_out([result]):
+                if listing.row is not None:
+                    yield finished_at, listing.row
+
+    def summary(self, run):
+        with self.lock:
+            cursor = self.conn.execute('''
+                SELECT t.retailer, t.status, r.row IS NOT NULL, r.error IS NOT NULL, COUNT(*)
+                FROM tasks t LEFT JOIN results r ON r.task_id = t.id
+                WHERE t.run = ?
+                GROUP BY 1, 2, 3, 4
+            ''', (run,))
+            summary = {}
+            for retailer, status, has_row, has_error, count in cursor:
+                if status == 'done':
+                    status = 'failed' if has_error else ('done' if has_row else 'skipped')
+                counts = summary.setdefault(retailer, {})
+                counts[status] = counts.get(status, 0) + count
+        return summary
+
+
+def work(queue, run, retailer, parse, worker, cache=None, batch_size=BATCH_SIZE, enrich=None):
+    # Fetches the leased listings of one retailer until none is left to lease. enrich is
+    # the retailer's (see run_scraper), applied to the rows before they are handed back.
+    leases = {}
+
+    def leased_listings():
+        # Pulled by the fetcher workers, a new batch is leased when the previous one is used up
+        while True:
+            tasks = queue.lease(run, retailer, batch_size)
+            if not tasks:
+                return
+            for task_id, token, wine_type, url in tasks:
+                leases[(wine_type, url)] = (task_id, token)
+                yield wine_type, url
+
+    completed = []
+    kept = 0
+    results = scrape(leased_listings(), parse, cache=cache)
+    if enrich is not None:
+        results = enriched(results, enrich, cache)
+    for result in results:
+        lease = leases.pop((result.wine_type, result.url), None)
+        if lease is None:
+            # Leased again by this worker after its lease expired, the result of the
+            # latest lease has already been handed back
+            continue
+        completed.append((lease, result))
+        if len(completed) >= batch_size:
+            kept += queue.complete(worker, completed)
+            completed = []
+    return kept + queue.complete(worker, completed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('enqueue', 'work', 'export', 'status'):
+        command = commands.add_parser(name)
+        command.add_argument('--run', required=True, help='name of the run, e.g. its date')
+        command.add_argument('--retailer', action='append')
+    args = parser.parse_args()
+
+    modules = retailer_modules()
+    retailers = args.retailer or list(modules)
+    queue = WorkQueue()
+
+    if args.command == 'enqueue':
+        for retailer in retailers:
+            module = modules[retailer]
+            listings = load_listings(module.listing_urls_path, module.discover_listings)
+            count = queue.enqueue(args.run, retailer, listings)
+            print(f'{retailer}: {count} pages queued for {len(listings)} listings')
+
+    elif args.command == 'work':
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        cache = PageCache()
+        for retailer in retailers:
+            # Wait for the listings leased by other workers, in case their leases expire
+            while queue.unfinished(args.run, retailer):
+                module = modules[retailer]
+                kept = work(
+                    queue, args.run, retailer, module.parse_listing, worker, cache,
+                    enrich=getattr(module, 'enrich', None),
+                )
+                print(f'{retailer}: {kept} results')
+                if queue.unfinished(args.run, retailer):
+                    time.sleep(POLL_SECONDS)
+
+    elif args.command == 'export':
+        for retailer in retailers:
+            if queue.unfinished(args.run, retailer):
+                print(f'{retailer}: {queue.unfinished(args.run, retailer)} listings not done yet')
+                continue
+            publish(lambda: queue.fetched_rows(args.run, retailer), retailer, modules[retailer].export_path)
+            print(f'{retailer}: exported to {modules[retailer].export_path}')
+
+    else:
+        for retailer, counts in queue.summary(args.run).items():
+            print(f'{retailer}: {counts}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# The modules are the scripts of code/, which import each other by name
+CODE_DIR = Path(__file__).resolve().parent.parent / 'code'
+sys.path.insert(0, str(CODE_DIR))
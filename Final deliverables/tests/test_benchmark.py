@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import benchmark
+from benchmark import compare, fingerprint, measure
+
+
+def result(commit, name, rate, peak_mb=10.0, inputs='abc'):
+    return {'commit': commit, 'benchmark': name, 'inputs': inputs, 'rate': rate, 'peak_mb': peak_mb}
+
+
+@pytest.fixture
+def results(tmp_path, monkeypatch):
+    path = tmp_path / 'results.jsonl'
+    monkeypatch.setattr(benchmark, 'RESULTS_PATH', path)
+
+    def write(*results):
+        with open(path, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    return write
+
+
+def test_compare_reports_regressions(results, capsys):
+    results(
+        result('aaa', 'merge', 1000),
+        result('aaa', 'parse_decantalo', 100),
+        result('aaa', 'aggregations', 500, peak_mb=10),
+        result('aaa', 'parse_laithwaites', 100, inputs='abc'),
+    )
+    results(
+        # Within the tolerance
+        result('bbb', 'merge', 950),
+        # Slower, then bigger, by more than the tolerance
+        result('bbb', 'parse_decantalo', 80),
+        result('bbb', 'aggregations', 500, peak_mb=12),
+        result('bbb', 'parse_laithwaites', 50, inputs='def'),
+    )
+    # The last commit measured against the one before it
+    assert compare() == 2
+    out = capsys.readouterr().out
+    assert out.startswith('bbb against aaa')
+    assert 'parse_laithwaites         measured on different inputs, not compared' in out
+    assert out.count('REGRESSION') == 2
+
+    # The other way round, everything got faster
+    assert compare('aaa', 'bbb') == 0
+
+
+def test_compare_latest_results_of_a_commit(results):
+    results(result('aaa', 'merge', 1000), result('bbb', 'merge', 500), result('bbb', 'merge', 1000))
+    assert compare() == 0
+
+
+def test_compare_without_base(results, capsys):
+    assert compare() == 0
+    results(result('aaa', 'merge', 1000))
+    assert compare() == 0
+    assert 'Only aaa has been measured' in capsys.readouterr().out
+
+
+def test_measure():
+    seconds, peak = measure(lambda n: [0] * n, 100_000, repeat=2)
+    assert seconds > 0
+    assert peak >= 100_000 * 8
+    assert fingerprint(b'page', 1) == fingerprint(b'page', '1') != fingerprint(b'page', 2)
@@ -0,0 +1,119 @@
+import asyncio
+
+import cache as cache_module
+from cache import PageCache
+from fetcher import HostLimiter, fetch
+
+URL = 'https://example.com/a'
+
+
+class Clock:
+    # time.time() of the cache, moved by hand
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class Response:
+    def __init__(self, status, content=b'', headers=None):
+        self.status = status
+        self.content = content
+        self.headers = headers or {}
+
+    async def read(self):
+        return self.content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class Session:
+    # Answers every request with the same response, and keeps the headers sent
+    def __init__(self, response):
+        self.response = response
+        self.sent = []
+
+    def get(self, url, headers=None):
+        self.sent.append(headers)
+        return self.response
+
+
+def test_hit(tmp_path):
+    cache = PageCache(tmp_path)
+    cache.store(URL, b'<html>a</html>', {'ETag': '"v1"'})
+    # The fragment never reaches the server, variants share the page
+    entry = cache.lookup(URL + '#/19-volume-magnum')
+    assert entry.etag == '"v1"'
+    assert cache.read(entry) == b'<html>a</html>'
+    assert cache.lookup('https://example.com/b') is None
+
+
+def test_missing_object_is_a_miss(tmp_path):
+    cache = PageCache(tmp_path)
+    cache.store(URL, b'<html>a</html>', {})
+    cache.object_path(cache.lookup(URL).sha).unlink()
+    assert cache.lookup(URL) is None
+    assert cache.conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0] == 0
+
+
+def test_expiry(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module, 'time', clock)
+    cache = PageCache(tmp_path, ttl=60)
+    cache.store(URL, b'<html>a</html>', {})
+    assert cache.is_fresh(cache.lookup(URL))
+    clock.now += 61
+    assert not cache.is_fresh(cache.lookup(URL))
+
+
+def test_revalidated_on_304(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module, 'time', clock)
+    cache = PageCache(tmp_path, ttl=60)
+    cache.store(URL, b'<html>a</html>', {'ETag': '"v1"', 'Last-Modified': 'Sun, 01 Jan 2023 00:00:00 GMT'})
+    clock.now += 61
+
+    session = Session(Response(304))
+    assert asyncio.run(fetch(session, HostLimiter(), URL, cache)) == (200, b'<html>a</html>')
+    assert session.sent == [
+        {'If-None-Match': '"v1"', 'If-Modified-Since': 'Sun, 01 Jan 2023 00:00:00 GMT'}
+    ]
+    # Good for another TTL, served without asking the server
+    assert cache.is_fresh(cache.lookup(URL))
+    assert asyncio.run(fetch(session, HostLimiter(), URL, cache)) == (200, b'<html>a</html>')
+    assert len(session.sent) == 1
+
+
+def test_changed_page_replaced(tmp_path):
+    cache = PageCache(tmp_path, ttl=0)
+    cache.store(URL, b'<html>a</html>', {'ETag': '"v1"'})
+    old = cache.object_path(cache.lookup(URL).sha)
+
+    session = Session(Response(200, b'<html>b</html>', {'ETag': '"v2"'}))
+    assert asyncio.run(fetch(session, HostLimiter(), URL, cache)) == (200, b'<html>b</html>')
+    assert session.sent == [{'If-None-Match': '"v1"'}]
+    assert cache.lookup(URL).etag == '"v2"'
+    assert not old.exists()
+
+
+def test_least_recently_used_evicted(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module, 'time', clock)
+    cache = PageCache(tmp_path, max_bytes=100)
+    for name in 'abc':
+        clock.now += 1
+        if name == 'c':
+            # a is used again, b is now the least recently used page
+            cache.read(cache.lookup('https://example.com/a'))
+            clock.now += 1
+        cache.store(f'https://example.com/{name}', name.encode() * 40, {})
+
+    assert cache.lookup('https://example.com/b') is None
+    assert cache.lookup('https://example.com/a') is not None
+    assert cache.lookup('https://example.com/c') is not None
+    assert cache.total_bytes == 80
@@ -0,0 +1,87 @@
+import csv
+
+from checkpoint import MAX_FAILURES, CheckpointStore
+from fetcher import Result
+
+LISTINGS = [('red', 'https://example.com/a'), ('red', 'https://example.com/b'), ('white', 'https://example.com/a')]
+
+
+def done(wine_type, url, price):
+    return Result(wine_type, url, 200, {'url': url, 'wine_type': wine_type, 'price': price}, None)
+
+
+def failed(wine_type, url, status=503):
+    return Result(wine_type, url, status, None, f'HTTP {status}')
+
+
+def test_resume_skips_completed_listings(tmp_path):
+    path = tmp_path / 'run.sqlite'
+    store = CheckpointStore(path)
+    store.record(done('red', 'https://example.com/a', 10))
+    store.record(failed('red', 'https://example.com/b'))
+    store.close()
+
+    # The same URL under another wine type is a listing of its own
+    store = CheckpointStore(path)
+    assert store.pending(LISTINGS) == [('red', 'https://example.com/b'), ('white', 'https://example.com/a')]
+
+
+def test_listing_dead_after_max_failures(tmp_path):
+    store = CheckpointStore(tmp_path / 'run.sqlite')
+    for _ in range(MAX_FAILURES - 1):
+        store.record(failed('red', 'https://example.com/b'))
+        assert store.pending(LISTINGS[1:2]) == LISTINGS[1:2]
+    store.record(failed('red', 'https://example.com/b'))
+    assert store.pending(LISTINGS[1:2]) == []
+    assert store.summary() == {'dead': 1}
+
+
+def test_gone_listing_dead_at_once(tmp_path):
+    store = CheckpointStore(tmp_path / 'run.sqlite')
+    store.record(failed('red', 'https://example.com/b', 404))
+    assert [letter[:3] for letter in store.dead_letters()] == [('red', 'https://example.com/b', 404)]
+
+
+def test_rows_latest_per_listing(tmp_path):
+    store = CheckpointStore(tmp_path / 'run.sqlite')
+    store.record(done('red', 'https://example.com/a', 10))
+    store.record(done('white', 'https://example.com/a', 11))
+    store.record(done('red', 'https://example.com/a', 12))
+    store.record(Result('red', 'https://example.com/b', 200, None, None))
+    assert [(row['wine_type'], row['price']) for row in store.rows()] == [('white', 11), ('red', 12)]
+
+    path = tmp_path / 'listings.csv'
+    store.export_csv(path)
+    with open(path, newline='', encoding='utf-8') as f:
+        assert list(csv.DictReader(f)) == [
+            {'url': 'https://example.com/a', 'wine_type': 'white', 'price': '11'},
+            {'url': 'https://example.com/a', 'wine_type': 'red', 'price': '12'},
+        ]
+
+
+def test_rows_kept_with_their_fetch_time(tmp_path):
+    store = CheckpointStore(tmp_path / 'run.sqlite')
+    store.record(done('red', 'https://example.com/a', 10))
+    store.record(done('red', 'https://example.com/b', 12))
+    fetched = list(store.fetched_rows())
+    assert [row['price'] for _, row in fetched] == [10, 12]
+    assert fetched[0][0] <= fetched[1][0]
+    assert fetched[0][0].endswith('+00:00')
+
+
+def test_published_run_started_over(tmp_path):
+    store = CheckpointStore(tmp_path / 'run.sqlite')
+    store.record(done('red', 'https://example.com/a', 10))
+    store.record(failed('red', 'https://example.com/b'))
+    assert not store.published()
+    store.mark_published()
+    assert store.published()
+
+    # The rows are fetched again, the failures still count towards the dead letters
+    store.start_run()
+    assert not store.published()
+    assert list(store.rows()) == []
+    assert store.pending(LISTINGS[:2]) == LISTINGS[:2]
+    for _ in range(MAX_FAILURES - 1):
+        store.record(failed('red', 'https://example.com/b'))
+    assert store.summary() == {'dead': 1}
@@ -0,0 +1,37 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from cleaning import CLEANERS, MIN_REVIEWS, SCRAPE_YEAR, fill_most_frequent, get_age, get_scaled_price, get_score
+
+DATA_DIR = Path(__file__).resolve().parent.parent / 'data'
+
+
+@pytest.mark.parametrize('retailer', list(CLEANERS))
+def test_same_as_the_notebooks(retailer):
+    # The committed ready-to-merge CSVs come from the notebooks' row loops
+    cleaned = CLEANERS[retailer](pd.read_csv(DATA_DIR / 'scrapped' / f'{retailer}_listings.csv'))
+    expected = pd.read_csv(DATA_DIR / 'ready to merge' / f'{retailer}_to_merge.csv')
+    assert sorted(cleaned.columns) == sorted(expected.columns)
+    cleaned = cleaned[expected.columns]
+
+    columns = [column for column in expected.columns if column != 'countrycode']
+    pd.testing.assert_frame_equal(cleaned[columns], expected[columns], check_dtype=False)
+    # The countries the notebooks left without a code now get one (see normalisation)
+    changed = cleaned['countrycode'] != expected['countrycode']
+    assert (expected.loc[changed, 'countrycode'] == 'unknown').all()
+    assert (cleaned.loc[changed, 'countrycode'] != 'unknown').all()
+
+
+def test_features():
+    assert get_age(pd.Series(['2019', 'NV'])).tolist()[0] == SCRAPE_YEAR - 2019
+    assert get_age(pd.Series(['NV'])).isna().all()
+
+    num_review = pd.Series([MIN_REVIEWS, MIN_REVIEWS + 1])
+    assert get_score(num_review, pd.Series([4.5, 4.5])).tolist() == [0, 4.5]
+
+    assert get_scaled_price(pd.Series([10.0, 10.0]), pd.Series([75, 150])).tolist() == [10.0, 5.0]
+
+    # Ties go to the smallest value, as with SimpleImputer
+    assert fill_most_frequent(pd.Series([150, 75, None, 150, 75])).tolist() == [150, 75, 75, 150, 75]
@@ -0,0 +1,168 @@
+import shutil
+
+import pytest
+
+import browser_pool
+import fetcher
+import http_discovery
+import scrape_decantalo
+import scrape_laithwaites
+import scrape_morrissons
+from browser_pool import DriverPool, crawl_categories, fixture_urls, serve_fixtures
+from http_discovery import DiscoveryError, discover_listings_http
+
+RETAILERS = {
+    'decantalo': scrape_decantalo,
+    'laithwaites': scrape_laithwaites,
+    'morrissons': scrape_morrissons,
+}
+# Listing URLs of the fixture categories (red and white, three listings over two pages)
+LISTING_PATHS = {
+    'decantalo': '/uk/en/{wine_type}-wine-{number}.html',
+    'laithwaites': '/product/{wine_type}-wine-{number}/00{number}',
+    'morrissons': '/products/{wine_type}-wine-{number}',
+}
+
+
+def expected(base_url, retailer):
+    return [
+        [wine_type, base_url + LISTING_PATHS[retailer].format(wine_type=wine_type, number=number)]
+        for wine_type in ('red', 'white')
+        for number in (1, 2, 3)
+    ]
+
+
+def fixture_page(category_url, pagenum):
+    # <wine_type>.html, then <wine_type>-2.html, which pages past the end repeat as the
+    # sites do
+    return category_url if pagenum == 1 else category_url.replace('.html', '-2.html')
+
+
+@pytest.mark.parametrize('retailer', ['decantalo', 'laithwaites'])
+def test_http_discovery(retailer):
+    with serve_fixtures() as base_url:
+        listing_urls = discover_listings_http(
+            fixture_urls(base_url, retailer), fixture_page, RETAILERS[retailer].LISTING_LINKS
+        )
+    # Listings of the same page are not in page order on the white fixtures
+    assert sorted(listing_urls) == expected(base_url, retailer)
+
+
+def test_http_discovery_falls_back_for_pages_without_links():
+    # Morrisons renders its listings with JS, so the links are not in the pages
+    fallen_back = []
+
+    def fallback(wine_type_urls):
+        fallen_back.extend(wine_type_urls)
+        return [(wine_type, f'{url}#listing') for wine_type, url in wine_type_urls.items()]
+
+    with serve_fixtures() as base_url:
+        wine_type_urls = fixture_urls(base_url, 'morrissons')
+        listing_urls = discover_listings_http(
+            wine_type_urls, fixture_page, scrape_decantalo.LISTING_LINKS, fallback=fallback
+        )
+        assert fallen_back == ['red', 'white']
+        assert listing_urls == [[wine_type, f'{url}#listing'] for wine_type, url in wine_type_urls.items()]
+
+        with pytest.raises(DiscoveryError):
+            discover_listings_http(wine_type_urls, fixture_page, scrape_decantalo.LISTING_LINKS)
+
+
+def test_http_discovery_pages_past_the_end_not_found():
+    # Pages past the end are 404s instead of repeating the last page
+    def page_url(category_url, pagenum):
+        return category_url.replace('.html', f'-{pagenum}.html') if pagenum > 1 else category_url
+
+    with serve_fixtures() as base_url:
+        wine_type_urls = fixture_urls(base_url, 'decantalo')
+        listing_urls = discover_listings_http(wine_type_urls, page_url, scrape_decantalo.LISTING_LINKS)
+        assert sorted(listing_urls) == expected(base_url, 'decantalo')
+
+        # Unless the first page is not found
+        wine_type_urls['rose'] = f'{base_url}/decantalo/rose.html'
+        with pytest.raises(DiscoveryError):
+            discover_listings_http(wine_type_urls, page_url, scrape_decantalo.LISTING_LINKS)
+
+
+def test_http_discovery_failed_page_fails_category(monkeypatch):
+    # The second page of the red wines fails: the red listings found on the first page
+    # must not be taken as the whole category
+    async def fetch_with_retries(session, limiter, url, cache=None):
+        if url.endswith('red-2.html'):
+            return 503, b''
+        return await fetcher.fetch_with_retries(session, limiter, url, cache)
+
+    monkeypatch.setattr(http_discovery, 'fetch_with_retries', fetch_with_retries)
+    fallen_back = []
+
+    def fallback(wine_type_urls):
+        fallen_back.extend(wine_type_urls)
+        return []
+
+    with serve_fixtures() as base_url:
+        wine_type_urls = fixture_urls(base_url, 'decantalo')
+        listing_urls = discover_listings_http(
+            wine_type_urls, fixture_page, scrape_decantalo.LISTING_LINKS, fallback=fallback
+        )
+        assert fallen_back == ['red']
+        assert sorted(listing_urls) == expected(base_url, 'decantalo')[3:]
+
+        with pytest.raises(DiscoveryError):
+            discover_listings_http(wine_type_urls, fixture_page, scrape_decantalo.LISTING_LINKS)
+
+
+def test_http_discovery_connection_error_fails_one_category(monkeypatch):
+    monkeypatch.setattr(fetcher, 'MAX_ATTEMPTS', 1)
+    fallen_back = []
+
+    def fallback(wine_type_urls):
+        fallen_back.extend(wine_type_urls)
+        return [('rose', 'https://example.com/rose-wine-1')]
+
+    with serve_fixtures() as base_url:
+        wine_type_urls = fixture_urls(base_url, 'decantalo')
+        # Nothing listens on port 9 (discard) of the loopback
+        wine_type_urls['rose'] = 'http://127.0.0.1:9/rose.html'
+        listing_urls = discover_listings_http(
+            wine_type_urls, fixture_page, scrape_decantalo.LISTING_LINKS, fallback=fallback
+        )
+    assert fallen_back == ['rose']
+    assert sorted(listing_urls) == sorted(
+        expected(base_url, 'decantalo') + [['rose', 'https://example.com/rose-wine-1']]
+    )
+
+
+class Driver:
+    def __init__(self):
+        self.quit_called = False
+
+    def quit(self):
+        self.quit_called = True
+
+
+def test_driver_pool_quits_started_drivers_when_one_fails(monkeypatch):
+    started = []
+
+    def make_driver(headless=True):
+        if len(started) == 2:
+            raise RuntimeError('chrome crashed')
+        started.append(Driver())
+        return started[-1]
+
+    monkeypatch.setattr(browser_pool, 'make_driver', make_driver)
+    with pytest.raises(RuntimeError):
+        DriverPool(4)
+    assert [driver.quit_called for driver in started] == [True, True]
+
+
+@pytest.mark.skipif(
+    not (shutil.which('chromedriver') and (shutil.which('google-chrome') or shutil.which('chromium'))),
+    reason='needs Chrome',
+)
+@pytest.mark.parametrize('retailer', list(RETAILERS))
+def test_browser_discovery(retailer):
+    with serve_fixtures() as base_url:
+        listing_urls = crawl_categories(
+            fixture_urls(base_url, retailer), RETAILERS[retailer].discover_category, workers=2
+        )
+    assert sorted(listing_urls) == expected(base_url, retailer)
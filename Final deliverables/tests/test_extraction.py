@@ -0,0 +1,74 @@
+from pathlib import Path
+
+import pytest
+
+import scrape_decantalo
+import scrape_laithwaites
+import scrape_morrissons
+import scrape_virginwines
+from metrics import METRICS
+from parsing import make_tree
+
+PAGES_DIR = Path(scrape_decantalo.__file__).parent / 'fixtures' / 'pages'
+RETAILERS = {
+    'decantalo': scrape_decantalo,
+    'laithwaites': scrape_laithwaites,
+    'morrissons': scrape_morrissons,
+    'virginwines': scrape_virginwines,
+}
+URL = 'https://example.com/wine.html'
+
+
+def page(retailer):
+    return (PAGES_DIR / f'{retailer}.html').read_bytes()
+
+
+@pytest.mark.parametrize('retailer', list(RETAILERS))
+def test_spec_matches_soup_extractors(retailer):
+    module = RETAILERS[retailer]
+    content = page(retailer)
+    assert module.parse_listing('red', URL, content) == module.parse_listing_soup('red', URL, content)
+
+
+@pytest.mark.parametrize('retailer', list(RETAILERS))
+def test_structured_data_matches_document(retailer):
+    # The fields found in the structured data give the same values as their selectors
+    extractor = RETAILERS[retailer].EXTRACTOR
+    content = page(retailer)
+    METRICS.reset()
+    fields = extractor.parse(content)
+    [structured] = [
+        counter['value'] for counter in METRICS.to_dict()['counters'] if counter['name'] == 'structured_fields'
+    ]
+    assert structured == len(extractor.structured)
+    assert fields == extractor(make_tree(content))
+
+
+def test_decantalo_listing():
+    assert scrape_decantalo.parse_listing('red', URL, page('decantalo')) == {
+        'name': 'Enate Chardonnay 234',
+        'wine_type': 'red',
+        'size (cL)': 75.0,
+        'price': 10.55,
+        'country': 'Spain',
+        'abv': 13.5,
+        'year': '2021',
+        'url': URL,
+    }
+
+
+def test_laithwaites_listing():
+    row = scrape_laithwaites.parse_listing('Red Wine', URL, page('laithwaites'))
+    assert row == {
+        'name': 'Cabalié 2021',
+        'Mix Case?': 0,
+        'abv': '13.0',
+        'year': '2021',
+        'size': 750.0,
+        'country': 'France',
+        'wine_type': 'Red Wine',
+        'price': 11.99,
+        'num_review': '7475',
+        'rating': '4.5',
+        'url': URL,
+    }
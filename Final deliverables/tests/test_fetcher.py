@@ -0,0 +1,162 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+import fetcher
+from fetcher import (
+    COOLDOWN, INITIAL_RATE, MAX_ATTEMPTS, MAX_BACKOFF, MIN_RATE, RATE_STEP, HostLimiter, TokenBucket, backoff,
+    fetch_with_retries, retry_after,
+)
+from metrics import METRICS
+
+URL = 'https://example.com/a'
+
+
+class Clock:
+    # time.monotonic() of the fetcher, moved by the sleeps instead of waiting
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.slept.append(seconds)
+        # At least a millisecond, as a real sleep: a wait too short to move the clock would
+        # be waited again and again
+        self.now += max(seconds, 0.001)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(fetcher, 'time', clock)
+    monkeypatch.setattr(fetcher.asyncio, 'sleep', clock.sleep)
+    monkeypatch.setattr(fetcher, 'backoff', lambda attempt: 0)
+    METRICS.reset()
+    return clock
+
+
+class Response:
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or {}
+
+    async def read(self):
+        return f'HTTP {self.status}'.encode()
+
+    async def __aenter__(self):
+        if isinstance(self.status, Exception):
+            raise self.status
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class Session:
+    # Answers the requests with the given responses, in turn
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = 0
+
+    def get(self, url, headers=None):
+        self.requests += 1
+        return self.responses.pop(0)
+
+
+def counted(name):
+    return sum(counter['value'] for counter in METRICS.to_dict()['counters'] if counter['name'] == name)
+
+
+def test_retry_after():
+    assert retry_after({'Retry-After': '5'}) == 5
+    assert retry_after({'Retry-After': '3600'}) == MAX_BACKOFF
+    # Only the seconds form is used
+    assert retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) is None
+    assert retry_after({}) is None
+
+
+def test_backoff_full_jitter():
+    for attempt in range(1, 10):
+        delays = [backoff(attempt) for _ in range(50)]
+        assert all(0 <= delay <= min(MAX_BACKOFF, 2 ** attempt) for delay in delays)
+        assert len(set(delays)) > 1
+
+
+def test_429_waits_for_retry_after(clock):
+    limiter = HostLimiter()
+    start = clock.now
+    session = Session(Response(429, {'Retry-After': '5'}), Response(200))
+    assert asyncio.run(fetch_with_retries(session, limiter, URL)) == (200, b'HTTP 200')
+    # The host is paused for 5 seconds, and its rate halved
+    assert clock.now >= start + 5
+    assert limiter.bucket(URL).rate < INITIAL_RATE
+    assert counted('retries') == 1
+
+
+def test_5xx_then_success(clock):
+    session = Session(Response(503), Response(502), Response(200))
+    assert asyncio.run(fetch_with_retries(session, HostLimiter(), URL)) == (200, b'HTTP 200')
+    assert session.requests == 3
+    assert counted('retries') == 2
+
+
+def test_gives_up_after_max_attempts(clock):
+    # The last response is returned, to be recorded as a failure (and dead-lettered)
+    session = Session(*(Response(503) for _ in range(MAX_ATTEMPTS)))
+    assert asyncio.run(fetch_with_retries(session, HostLimiter(), URL)) == (503, b'HTTP 503')
+    assert session.requests == MAX_ATTEMPTS
+
+    session = Session(*(Response(aiohttp.ClientConnectionError('reset')) for _ in range(MAX_ATTEMPTS)))
+    with pytest.raises(aiohttp.ClientConnectionError):
+        asyncio.run(fetch_with_retries(session, HostLimiter(), URL))
+    assert session.requests == MAX_ATTEMPTS
+
+
+def test_not_retried_statuses(clock):
+    session = Session(Response(404))
+    assert asyncio.run(fetch_with_retries(session, HostLimiter(), URL)) == (404, b'HTTP 404')
+    assert session.requests == 1
+
+
+def test_rate_halved_then_recovers(clock):
+    bucket = TokenBucket()
+    bucket.succeeded(0.1)
+    assert bucket.rate == INITIAL_RATE + RATE_STEP / INITIAL_RATE
+
+    rate = bucket.rate
+    bucket.slow_down()
+    assert bucket.rate == rate / 2
+    # The requests in flight that fail with it only count once
+    bucket.slow_down()
+    assert bucket.rate == rate / 2
+
+    clock.now += COOLDOWN
+    bucket.slow_down()
+    assert bucket.rate == rate / 4
+
+    # Additive increase while the host answers quickly
+    for _ in range(100):
+        bucket.succeeded(0.1)
+    assert bucket.rate > rate
+
+    # Never below MIN_RATE
+    for _ in range(20):
+        clock.now += COOLDOWN
+        bucket.slow_down()
+    assert bucket.rate == MIN_RATE
+
+
+def test_rate_halved_on_slow_responses(clock):
+    bucket = TokenBucket()
+    bucket.succeeded(0.1)
+    rate = bucket.rate
+    # The average latency gets more than SLOW_FACTOR times the fastest
+    for _ in range(20):
+        bucket.succeeded(2)
+        if bucket.rate < rate:
+            break
+    assert bucket.rate < rate
@@ -0,0 +1,53 @@
+import csv
+
+from history import PriceHistory
+
+
+def test_record_snapshots(tmp_path):
+    history = PriceHistory(tmp_path / 'history.sqlite')
+    url = 'https://example.com/a'
+    row = {'url': url, 'name': 'Enate', 'price': '10.5', 'num_review': '12'}
+    assert history.record('decantalo', [row], '2023-01-01') == 1
+    assert history.record('decantalo', [{'url': url, 'name': 'Enate', 'price': 'out of stock'}], '2023-01-08') == 1
+
+    series = history.series('decantalo', url)
+    assert series['price'].isna().tolist() == [False, True]
+    assert series['num_review'].tolist()[0] == 12
+    assert history.as_of('2023-01-05')['price'].tolist() == [10.5]
+
+
+def test_rows_without_url_left_out(tmp_path):
+    # Laithwaites mix cases come with their name only, and with an empty url from the CSVs
+    path = tmp_path / 'laithwaites_listings.csv'
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['name', 'Mix Case?', 'price', 'url'])
+        writer.writeheader()
+        writer.writerow({'name': 'Cabalié 2021', 'Mix Case?': 0, 'price': '11.99', 'url': 'https://example.com/a'})
+        writer.writerow({'name': 'Wine Lovers Mix', 'Mix Case?': 1})
+        writer.writerow({'name': 'Mystery Reds', 'Mix Case?': 1})
+
+    history = PriceHistory(tmp_path / 'history.sqlite')
+    scraped = [
+        {'name': 'Cabalié 2021', 'Mix Case?': 0, 'price': 11.99, 'url': 'https://example.com/a'},
+        {'name': 'Wine Lovers Mix', 'Mix Case?': 1},
+    ]
+    assert history.record('laithwaites', scraped, '2023-01-01') == 1
+    with open(path, newline='', encoding='utf-8') as f:
+        assert history.record('laithwaites', csv.DictReader(f), '2023-01-08') == 1
+    assert history.as_of('2023-01-08')['url'].tolist() == ['https://example.com/a']
+
+
+def test_rows_recorded_when_fetched(tmp_path):
+    # A run resumed the next day: each row is an observation of the day it was fetched
+    history = PriceHistory(tmp_path / 'history.sqlite')
+    fetched_rows = [
+        ('2023-01-01T10:00:00+00:00', {'url': 'https://example.com/a', 'price': 10.0}),
+        ('2023-01-02T09:00:00+00:00', {'url': 'https://example.com/b', 'price': 20.0}),
+    ]
+    assert history.record_fetched('decantalo', fetched_rows) == 2
+    assert history.as_of('2023-01-01')['url'].tolist() == ['https://example.com/a']
+    assert history.as_of('2023-01-02')['url'].tolist() == ['https://example.com/a', 'https://example.com/b']
+
+    # Publishing the same run again records nothing new
+    assert history.record_fetched('decantalo', fetched_rows) == 0
+    assert len(history.series('decantalo', 'https://example.com/a')) == 1
@@ -0,0 +1,74 @@
+from fetcher import Result
+from incremental import ListingState
+
+LISTINGS = [('red', f'https://example.com/{number}') for number in range(4)]
+
+
+def statuses(state):
+    return dict(state.conn.execute('SELECT url, status FROM listings'))
+
+
+def status_changes(changes):
+    return [(change['url'], change['old'], change['new']) for change in changes]
+
+
+def test_sync_new_delisted_relisted(tmp_path):
+    state = ListingState(tmp_path / 'state.sqlite')
+    changes = state.sync(LISTINGS)
+    assert status_changes(changes) == [(url, None, 'active') for _, url in LISTINGS]
+    assert sorted(state.due()) == sorted(LISTINGS)
+
+    changes = state.sync(LISTINGS[1:])
+    assert status_changes(changes) == [('https://example.com/0', 'active', 'delisted')]
+    assert statuses(state)['https://example.com/0'] == 'delisted'
+
+    changes = state.sync(LISTINGS)
+    assert status_changes(changes) == [('https://example.com/0', 'delisted', 'active')]
+    assert set(statuses(state).values()) == {'active'}
+
+
+def test_sync_partial_discovery_delists_nothing(tmp_path):
+    state = ListingState(tmp_path / 'state.sqlite')
+    state.sync(LISTINGS)
+    assert state.sync(LISTINGS[:1]) == []
+    assert set(statuses(state).values()) == {'active'}
+
+
+def test_sync_guard_per_category(tmp_path):
+    state = ListingState(tmp_path / 'state.sqlite')
+    reds = [('red', f'https://example.com/red-{number}') for number in range(10)]
+    whites = [('white', f'https://example.com/white-{number}') for number in range(4)]
+    state.sync(reds + whites)
+
+    # Most of the retailer is found, but only the first white is: the whites are kept
+    # while the red that is gone is delisted
+    changes = state.sync(reds[1:] + whites[:1])
+    assert status_changes(changes) == [('https://example.com/red-0', 'active', 'delisted')]
+    assert state.summary() == {'active': 13, 'delisted': 1}
+
+
+def test_record_tracked_changes(tmp_path):
+    state = ListingState(tmp_path / 'state.sqlite')
+    state.sync(LISTINGS[:1])
+    wine_type, url = LISTINGS[0]
+    row = {'url': url, 'name': 'Enate', 'price': 10.5, 'rating': 4.5, 'num_review': 12}
+    assert state.record(Result(wine_type, url, 200, row, None)) == []
+    # Fetched, so not due again straight away
+    assert state.due() == []
+
+    changed = dict(row, name='Enate Chardonnay', price=9.5, num_review=13)
+    changes = state.record(Result(wine_type, url, 200, changed, None))
+    assert [(change['field'], change['old'], change['new']) for change in changes] == [
+        ('price', 10.5, 9.5),
+        ('num_review', 12, 13),
+    ]
+
+
+def test_record_gone_delists(tmp_path):
+    state = ListingState(tmp_path / 'state.sqlite')
+    state.sync(LISTINGS)
+    wine_type, url = LISTINGS[2]
+    assert state.record(Result(wine_type, url, 503, None, 'HTTP 503')) == []
+    changes = state.record(Result(wine_type, url, 404, None, 'HTTP 404'))
+    assert status_changes(changes) == [(url, 'active', 'delisted')]
+    assert state.summary() == {'active': 3, 'delisted': 1}
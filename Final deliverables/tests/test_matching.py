@@ -0,0 +1,73 @@
+from matching import THRESHOLD, MatchIndex, block_key, name_tokens
+
+
+def listing(retailer, number, name, country='Lebanon', wine_type='red', year=2015, size=75):
+    return {
+        'retailer': retailer,
+        'url': f'https://{retailer}.example.com/{number}',
+        'name': name,
+        'country': country,
+        'wine_type': wine_type,
+        'year': year,
+        'size(cL)': size,
+    }
+
+
+LISTINGS = [
+    listing('decantalo', 1, 'Château Musar 2015 75cl'),
+    listing('laithwaites', 1, 'Chateau Musar'),
+    # Just under the threshold (0.8)
+    listing('virginwines', 2, 'Chateau Musar Red'),
+    # Another vintage, or another wine of the same producer
+    listing('laithwaites', 2, 'Chateau Musar', year=2016),
+    listing('morrissons', 1, 'Hochar Pere et Fils Chateau Musar'),
+    # The same grape only
+    listing('decantalo', 2, 'Cloudy Bay Sauvignon Blanc', 'Marlborough', 'white', 2021),
+    listing('virginwines', 1, 'Villa Maria Sauvignon Blanc', 'New Zealand', 'White Wine', 2021),
+    listing('laithwaites', 3, 'Cloudy Bay Sauvignon Blanc', 'New Zealand', 'White', 2021),
+]
+
+
+def wine_ids(index):
+    return {
+        (retailer, url.rsplit('/', 1)[1]): wine_id
+        for retailer, url, wine_id in index.conn.execute('SELECT retailer, url, wine_id FROM listings')
+    }
+
+
+def test_name_tokens_and_blocks():
+    assert name_tokens('Château Musar 2015 75cl') == {'chateau', 'musar'}
+    assert name_tokens('Vino de la Tierra') == {'tierra'}
+    assert block_key('Marlborough', 'White Wine', '2021.0', 75) == 'New Zealand|White|2021|75'
+    assert block_key('Spain', 'red', 'NV', None) == 'Spain|Red|NV|75'
+
+
+def test_listings_of_the_same_wine_matched(tmp_path):
+    index = MatchIndex(tmp_path / 'matches.sqlite')
+    assert index.add(LISTINGS) == 2
+    ids = wine_ids(index)
+    assert ids[('decantalo', '1')] == ids[('laithwaites', '1')]
+    assert ids[('decantalo', '2')] == ids[('laithwaites', '3')]
+    assert len(set(ids.values())) == 6
+
+    scores = [score for (score,) in index.conn.execute('SELECT score FROM matches')]
+    assert all(score >= THRESHOLD for score in scores)
+    groups = index.groups()
+    assert sorted(groups['retailer']) == ['decantalo', 'decantalo', 'laithwaites', 'laithwaites']
+    index.close()
+
+
+def test_new_listings_matched_against_stored_ones(tmp_path):
+    path = tmp_path / 'matches.sqlite'
+    index = MatchIndex(path)
+    index.add(LISTINGS)
+    index.close()
+
+    index = MatchIndex(path)
+    # Listings already stored are skipped
+    assert index.add(LISTINGS) == 0
+    # Matched with the best listing of every other retailer
+    assert index.add([listing('morrissons', 2, 'Chateau Musar 2015')]) == 2
+    ids = wine_ids(index)
+    assert ids[('morrissons', '2')] == ids[('decantalo', '1')] == ids[('laithwaites', '1')]
+    index.close()
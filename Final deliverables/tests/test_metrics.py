@@ -0,0 +1,67 @@
+import csv
+import json
+import pickle
+
+from metrics import BUCKETS, URL_COLUMNS, Metrics
+
+
+def test_drain_and_merge():
+    # As the parser processes hand their metrics to the main process
+    worker = Metrics()
+    worker.count('skipped', reason='no price')
+    worker.count('skipped', 2, reason='no price')
+    worker.gauge('rate_limit', 5, host='a.com')
+    worker.observe('parse_seconds', 0.002, field='price')
+    drained = pickle.loads(pickle.dumps(worker.drain()))
+    assert worker.drain() == ({}, {}, {})
+
+    main = Metrics()
+    main.count('skipped', reason='no price')
+    main.observe('parse_seconds', 0.3, field='price')
+    main.merge(drained)
+
+    metrics = main.to_dict()
+    assert metrics['counters'] == [{'name': 'skipped', 'labels': {'reason': 'no price'}, 'value': 4}]
+    assert metrics['gauges'] == [{'name': 'rate_limit', 'labels': {'host': 'a.com'}, 'value': 5}]
+    [timing] = metrics['timings']
+    assert (timing['count'], timing['max']) == (2, 0.3)
+    assert timing['buckets']['0.005'] == 1 and timing['buckets']['0.5'] == 1
+
+
+def test_prometheus_export():
+    metrics = Metrics()
+    metrics.count('responses', host='a.com', status=200)
+    metrics.gauge('rate_limit', 2.5, host='a.com')
+    metrics.observe('request_seconds', 0.2, host='a.com')
+    metrics.observe('request_seconds', 20, host='a.com')
+    metrics.count('skipped', reason='say "no"')
+    lines = metrics.to_prometheus().splitlines()
+
+    assert lines[0].startswith('scrape_elapsed_seconds ')
+    assert 'scrape_responses_total{host="a.com",status="200"} 1' in lines
+    assert 'scrape_skipped_total{reason="say \\"no\\""} 1' in lines
+    assert 'scrape_rate_limit{host="a.com"} 2.5' in lines
+    # Cumulative buckets, ending with +Inf
+    buckets = [line for line in lines if line.startswith('scrape_request_seconds_bucket')]
+    assert len(buckets) == len(BUCKETS) + 1
+    assert 'scrape_request_seconds_bucket{host="a.com",le="0.25"} 1' in buckets
+    assert 'scrape_request_seconds_bucket{host="a.com",le="10"} 1' in buckets
+    assert buckets[-1] == 'scrape_request_seconds_bucket{host="a.com",le="+Inf"} 2'
+    assert 'scrape_request_seconds_sum{host="a.com"} 20.200000' in lines
+    assert 'scrape_request_seconds_count{host="a.com"} 2' in lines
+
+
+def test_write(tmp_path):
+    metrics = Metrics()
+    metrics.count('responses', host='a.com', status=200)
+    metrics.record_url(
+        url='https://a.com/1', status=200, outcome='done', fetch_seconds=0.1, bytes=10, parse_seconds=0.01
+    )
+    metrics.write(tmp_path / 'decantalo')
+
+    assert json.loads((tmp_path / 'decantalo.json').read_text())['counters'][0]['value'] == 1
+    assert 'scrape_responses_total{host="a.com",status="200"} 1' in (tmp_path / 'decantalo.prom').read_text()
+    with open(tmp_path / 'decantalo_urls.csv', newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert list(rows[0]) == URL_COLUMNS
+    assert rows[0]['outcome'] == 'done'
@@ -0,0 +1,49 @@
+import pandas as pd
+
+from normalisation import (
+    country_code, country_codes, normalise_countries, normalise_country, normalise_wine_type, normalise_wine_types,
+)
+
+
+def test_countries():
+    assert normalise_country('England') == 'UK'
+    assert normalise_country('Moldova (Republic Of)') == 'Moldova'
+    # Regions given instead of the country
+    assert normalise_country('Marlborough') == 'New Zealand'
+    assert normalise_country('Western Cape') == 'South Africa'
+    # Simplified and fuzzy matches
+    assert normalise_country('new zealand') == 'New Zealand'
+    assert normalise_country('Portugall') == 'Portugal'
+    assert normalise_country('Atlantis') is None
+    assert normalise_country(None) is None
+
+
+def test_wine_types():
+    assert normalise_wine_type('Rosé') == 'Rose'
+    assert normalise_wine_type('rose_wine') == 'Rose'
+    assert normalise_wine_type('fortified and sherry') == 'Other'
+    assert normalise_wine_type('Red Wine') == 'Red'
+
+
+def test_country_codes():
+    assert country_code('France') == 'FRA'
+    # Names pycountry doesn't know
+    assert country_code('USA') == 'USA'
+    assert country_code('England') == 'GBR'
+    assert country_code('Czech Republic') == 'CZE'
+    assert country_code('Moldova') == 'MDA'
+    # Regions go through their country
+    assert country_code('Marlborough') == 'NZL'
+    assert country_code('California') == 'USA'
+    assert country_code('unknown') == 'unknown'
+
+
+def test_columns_remapped():
+    countries = pd.Series(['England', 'Marlborough', None, 'England', 'Atlantis'], index=[3, 4, 5, 6, 7])
+    normalised = normalise_countries(countries)
+    assert normalised.index.tolist() == [3, 4, 5, 6, 7]
+    assert normalised.tolist()[:2] == ['UK', 'New Zealand']
+    assert normalised.isna().tolist() == [False, False, True, False, True]
+
+    assert country_codes(countries).tolist() == ['GBR', 'NZL', 'unknown', 'GBR', 'unknown']
+    assert normalise_wine_types(pd.Series(['red', 'Rosé'])).tolist() == ['Red', 'Rose']
@@ -0,0 +1,87 @@
+import json
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import pipeline
+from cache import PageCache
+from cube import AggregateCube
+from fetcher import Result
+from pipeline import COLUMNS, CubeSink, scraped_rows
+
+
+def record(number, price):
+    return dict.fromkeys(COLUMNS) | {
+        'retailer': 'decantalo',
+        'url': f'https://example.com/{number}',
+        'country': 'Spain',
+        'wine_type': 'Red',
+        'price': price,
+        'abv': 13.5,
+        'age': 2,
+        'num_review': 10,
+        'rating': 4.5,
+    }
+
+
+def test_cube_sink_needs_built_cube(tmp_path):
+    with pytest.raises(ValueError, match='cube.py build'):
+        CubeSink(tmp_path / 'cube.sqlite')
+
+
+def test_cube_sink_keeps_built_edges(tmp_path):
+    path = tmp_path / 'cube.sqlite'
+    cube = AggregateCube(path)
+    cube.build(pd.DataFrame([record(number, price) for number, price in enumerate(range(5, 105, 10))]))
+    edges = cube.edges
+    cube.close()
+
+    # A batch of expensive wines only, which must not become the price deciles
+    sink = CubeSink(path)
+    for number in range(10, 15):
+        sink.write(record(number, 1000 + number))
+    sink.close()
+
+    cube = AggregateCube(path)
+    assert cube.edges == edges
+    rollup = cube.rollup(['price_decile'])
+    assert rollup['listings'].sum() == 15
+    assert rollup.loc[rollup['price_decile'] == rollup['price_decile'].max(), 'listings'].item() == 6
+
+
+def test_scraped_rows_enriched(tmp_path, monkeypatch):
+    # A retailer script with an enrich step gets it in the pipeline as in its own runs,
+    # except for the replay, which stays offline
+    listings = [['red', 'https://example.com/a'], ['red', 'https://example.com/a#/19-volume-magnum']]
+    listing_urls_path = tmp_path / 'listings.json'
+    listing_urls_path.write_text(json.dumps(listings))
+    cache = PageCache(tmp_path / 'cache')
+    cache.store('https://example.com/a', b'<html></html>', {})
+    enriched = []
+
+    def enrich(rows, cache):
+        enriched.append(len(rows))
+        return [dict(row, rating=4.5) for row in rows]
+
+    module = SimpleNamespace(
+        listing_urls_path=listing_urls_path,
+        discover_listings=None,
+        parse_listing=lambda wine_type, url, content: {'url': url, 'wine_type': wine_type},
+        enrich=enrich,
+    )
+    rows = list(scraped_rows('decantalo', module, 'replay', cache))
+    assert enriched == []
+    assert rows == [('decantalo', {'url': url, 'wine_type': 'red'}) for _, url in listings]
+
+    # Pages are parsed without being fetched
+    def scrape(listings, parse, cache=None, parse_workers=0):
+        for wine_type, url in listings:
+            yield Result(wine_type, url, 200, parse(wine_type, url, b''), None)
+
+    monkeypatch.setattr(pipeline, 'scrape', scrape)
+    rows = list(scraped_rows('decantalo', module, 'scrape', cache))
+    assert enriched == [2]
+    assert rows == [
+        ('decantalo', {'url': url, 'wine_type': 'red', 'rating': 4.5}) for _, url in listings
+    ]
@@ -0,0 +1,55 @@
+import pytest
+
+from quality import RULES, compile_rules
+
+VALID = {
+    'retailer': 'decantalo',
+    'name': 'Enate Chardonnay 234',
+    'url': 'https://example.com/a',
+    'abv': 13.5,
+    'size(cL)': 75.0,
+    'price': 10.55,
+    'raw_price': '10.55',
+    'rating': 4.5,
+    'num_review': 12.0,
+}
+
+
+@pytest.mark.parametrize('changes, reasons', [
+    ({'abv': 1350.0}, 'abv_out_of_range'),
+    ({'rating': 7.0}, 'rating_out_of_range'),
+    ({'num_review': -1.0}, 'num_review_negative'),
+    ({'price': 0.0, 'raw_price': '0'}, 'price_not_positive;price_per_75cl_out_of_range'),
+    ({'price': 26000.0, 'raw_price': '26000'}, 'price_per_75cl_out_of_range'),
+    # A half bottle of 375ml
+    ({'size(cL)': 375.0}, 'size_in_ml'),
+    ({'size(cL)': 5.0}, 'size_out_of_range'),
+    ({'name': 'Red Wine & Chocolates Hamper'}, 'not_wine'),
+    # Breaking several rules gives all their codes
+    ({'abv': -1.0, 'rating': -1.0}, 'abv_out_of_range;rating_out_of_range'),
+])
+def test_rules(changes, reasons):
+    quarantined, found = compile_rules().check([VALID, dict(VALID, **changes)])
+    assert quarantined.tolist() == [False, True]
+    assert found == [reasons]
+
+
+def test_not_wine_whole_words():
+    records = [dict(VALID, name='The Chocolate Block'), dict(VALID, name='Wine Glasses')]
+    quarantined, reasons = compile_rules().check(records)
+    assert quarantined.tolist() == [False, True]
+    assert reasons == ['not_wine']
+
+
+def test_out_of_stock_counted_not_quarantined():
+    validator = compile_rules()
+    quarantined, reasons = validator.check([dict(VALID, price=None, raw_price='out of stock'), dict(VALID, price=None)])
+    assert quarantined.tolist() == [False, False]
+    assert reasons == []
+    assert validator.counts == dict.fromkeys([rule.code for rule in RULES], 0) | {'price_not_numeric': 1}
+
+
+def test_missing_values_pass():
+    record = dict.fromkeys(VALID)
+    quarantined, _ = compile_rules().check([record])
+    assert quarantined.tolist() == [False]
@@ -0,0 +1,53 @@
+import gc
+import weakref
+
+import pandas as pd
+
+from query import QueryService
+
+
+def snapshot(prices, retailer='decantalo'):
+    return pd.DataFrame([
+        {
+            'retailer': retailer,
+            'name': f'Wine {number}',
+            'url': f'https://example.com/{number}',
+            'country': 'France' if number % 2 else 'Spain',
+            'wine_type': 'Red',
+            'year': '2020',
+            'scaled_price': price,
+            'rating': 4.0 + number / 10,
+            'num_review': number,
+        }
+        for number, price in enumerate(prices)
+    ])
+
+
+def test_query_conditions_and_order():
+    service = QueryService(snapshot([8, 12, 20, 14]))
+    rows, count = service.query(country='France', scaled_price=(None, 15), order_by='rating')
+    assert count == 2
+    assert rows['name'].tolist() == ['Wine 3', 'Wine 1']
+
+
+def test_ingest_replaces_cached_results():
+    service = QueryService(snapshot([8, 12, 20, 14]))
+    assert service.query(scaled_price=(None, 15))[1] == 3
+    assert service.query(scaled_price=(None, 15))[1] == 3
+    assert service.stats()['cache'] == {'hits': 1, 'misses': 1, 'size': 1}
+
+    # The new snapshot updates a price: the result cached on the old index is not served
+    service.ingest(snapshot([8, 12, 20, 30]))
+    assert service.query(scaled_price=(None, 15))[1] == 2
+    assert service.stats()['snapshots'] == 2
+    assert service.stats()['cache'] == {'hits': 0, 'misses': 1, 'size': 1}
+
+
+def test_old_index_released():
+    service = QueryService(snapshot([8, 12, 20, 14]))
+    service.query(country='France')
+    old = weakref.ref(service.current())
+    service.ingest(snapshot([10], retailer='laithwaites'))
+    gc.collect()
+    assert old() is None
+    assert len(service.current()) == 5
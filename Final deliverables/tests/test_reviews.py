@@ -0,0 +1,134 @@
+import asyncio
+import json
+
+from selenium.common.exceptions import WebDriverException
+
+import reviews
+from cache import PageCache
+from metrics import METRICS
+from reviews import FIXTURES_DIR, collect_reviews, fetch_grades, parse_grades, product_id, serve_stub
+
+PAGES = ['enate-chardonnay', 'jose-pariente-verdejo', 'paco-lola', 'martin-codax-albarino']
+
+
+def counted(name):
+    return sum(counter['value'] for counter in METRICS.to_dict()['counters'] if counter['name'] == name)
+
+
+def cached_pages(tmp_path, base_url):
+    cache = PageCache(tmp_path / 'cache')
+    for page in PAGES:
+        cache.store(f'{base_url}/{page}.html', (FIXTURES_DIR / f'{page}.html').read_bytes(), {})
+    return cache
+
+
+def test_product_id():
+    assert product_id((FIXTURES_DIR / 'enate-chardonnay.html').read_bytes()) == '101'
+    assert product_id((FIXTURES_DIR / 'paco-lola.html').read_bytes()) == '103'
+    assert product_id((FIXTURES_DIR / 'martin-codax-albarino.html').read_bytes()) is None
+
+
+def test_parse_grades():
+    content = json.dumps({'products': [
+        {'id_product': 101, 'average_grade': '4.5', 'comments_nb': '12'},
+        {'id_product': 102, 'average_grade': 0, 'comments_nb': 0},
+    ]})
+    assert parse_grades(content) == {'101': (4.5, 12), '102': (None, None)}
+
+
+def test_fetch_grades_in_batches(tmp_path, monkeypatch):
+    grades = {str(i): {'id_product': i, 'average_grade': 4, 'comments_nb': i} for i in range(1, 46)}
+    (tmp_path / 'grades.json').write_text(json.dumps(grades))
+    monkeypatch.setattr(reviews, 'BATCH_SIZE', 20)
+    METRICS.reset()
+
+    with serve_stub(tmp_path) as base_url:
+        found = asyncio.run(fetch_grades(base_url, [str(i) for i in range(1, 51)]))
+
+    assert found == {str(i): (4.0, i) for i in range(1, 46)}
+    assert counted('responses') == 3
+
+
+def test_fetch_grades_failed_batches():
+    METRICS.reset()
+    with serve_stub() as base_url:
+        # No endpoint there: every batch gets a 404
+        assert asyncio.run(fetch_grades(f'{base_url}/nowhere', ['101', '102'])) == {}
+    assert counted('review_batches_failed') == 1
+
+
+def test_collect_reviews(tmp_path):
+    fallen_back = []
+
+    def fallback(urls):
+        fallen_back.extend(urls)
+        return {url: (3.0, 1) for url in urls}
+
+    with serve_stub() as base_url:
+        cache = cached_pages(tmp_path, base_url)
+        # Variants of a product share its reviews
+        urls = [f'{base_url}/{page}.html' for page in PAGES] + [f'{base_url}/enate-chardonnay.html#/1-volume-75_cl']
+        found = collect_reviews(urls, cache, base_url, fallback)
+        cache.close()
+
+    assert found == {
+        f'{base_url}/enate-chardonnay.html': (4.5, 12),
+        f'{base_url}/jose-pariente-verdejo.html': (None, None),
+        # Not known by the endpoint, and without a product id
+        f'{base_url}/paco-lola.html': (3.0, 1),
+        f'{base_url}/martin-codax-albarino.html': (3.0, 1),
+    }
+    assert sorted(fallen_back) == [f'{base_url}/martin-codax-albarino.html', f'{base_url}/paco-lola.html']
+
+
+def test_add_reviews(tmp_path):
+    with serve_stub() as base_url:
+        cache = cached_pages(tmp_path, base_url)
+        rows = [
+            {'name': 'Enate', 'url': f'{base_url}/enate-chardonnay.html#/2-volume-magnum'},
+            {'name': 'Martin Codax', 'url': f'{base_url}/martin-codax-albarino.html'},
+        ]
+        reviews.add_reviews(rows, cache, base_url)
+        cache.close()
+
+    assert [(row['rating'], row['num_review']) for row in rows] == [(4.5, 12), (None, None)]
+
+
+def test_endpoint_unavailable(tmp_path, capsys):
+    fallen_back = []
+
+    def fallback(urls):
+        fallen_back.extend(urls)
+        return {}
+
+    with serve_stub() as base_url:
+        cache = cached_pages(tmp_path, base_url)
+        urls = [f'{base_url}/{page}.html' for page in PAGES]
+        # No endpoint there: only the page without a product id goes to the browsers
+        assert collect_reviews(urls, cache, f'{base_url}/nowhere', fallback) == {}
+        cache.close()
+
+    assert fallen_back == [f'{base_url}/martin-codax-albarino.html']
+    assert 'Warning: no reviews from' in capsys.readouterr().out
+
+
+def test_fallback_capped_and_without_browser(tmp_path, capsys):
+    asked = []
+
+    def fallback(urls):
+        asked.extend(urls)
+        raise WebDriverException('chrome not found')
+
+    with serve_stub() as base_url:
+        cache = cached_pages(tmp_path, base_url)
+        rows = [{'url': f'{base_url}/{page}.html'} for page in PAGES]
+        reviews.add_reviews(rows, cache, base_url, fallback, max_fallback=1)
+        cache.close()
+
+    assert len(asked) == 1
+    assert [(row['rating'], row['num_review']) for row in rows] == [
+        (4.5, 12), (None, None), (None, None), (None, None)
+    ]
+    out = capsys.readouterr().out
+    assert 'Warning: 1 products left without reviews' in out
+    assert 'Warning: no browser for the missing reviews' in out
@@ -0,0 +1,30 @@
+from fetcher import Result
+from runner import enriched
+
+
+def result(number, row=True):
+    url = f'https://example.com/{number}'
+    return Result('red', url, 200, {'url': url} if row else None, None)
+
+
+def test_rows_enriched_in_batches():
+    batches = []
+
+    def enrich(rows, cache):
+        batches.append([row['url'][-1] for row in rows])
+        return [dict(row, rating=4.5) for row in rows]
+
+    results = [result(1), result(2, row=False), result(3), result(4), result(5)]
+    stream = enriched(iter(results), enrich, None, size=2)
+
+    # The first batch is handed out before the next one is read
+    assert next(stream).row == {'url': 'https://example.com/1', 'rating': 4.5}
+    assert batches == [['1']]
+    rest = list(stream)
+    assert batches == [['1'], ['3', '4'], ['5']]
+    assert [r.row for r in rest] == [
+        None,
+        {'url': 'https://example.com/3', 'rating': 4.5},
+        {'url': 'https://example.com/4', 'rating': 4.5},
+        {'url': 'https://example.com/5', 'rating': 4.5},
+    ]
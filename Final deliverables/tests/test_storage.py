@@ -0,0 +1,38 @@
+from datetime import date
+
+import storage
+from storage import read_listings, write_listings
+
+SNAPSHOT = date(2023, 1, 15)
+
+
+def rows(count, retailer='decantalo'):
+    # A generator, as the rows streamed from a checkpoint store
+    for number in range(count):
+        yield {
+            'name': f'{retailer} wine {number}',
+            'wine_type': 'red' if number % 2 else 'white',
+            'price': 'out of stock' if number == 3 else 10 + number,
+            'year': 'NV' if number == 1 else 2020,
+            'url': f'https://example.com/{number}',
+        }
+
+
+def test_write_listings_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'BATCH_ROWS', 3)
+    write_listings(rows(8), 'decantalo', SNAPSHOT, root=tmp_path)
+    write_listings(rows(2, 'laithwaites'), 'laithwaites', SNAPSHOT, root=tmp_path)
+
+    data = read_listings(root=tmp_path)
+    decantalo = data[data['retailer'] == 'decantalo']
+    assert decantalo['name'].tolist() == [f'decantalo wine {number}' for number in range(8)]
+    assert decantalo['in_stock'].tolist() == [number != 3 for number in range(8)]
+    assert decantalo['non_vintage'].tolist() == [number == 1 for number in range(8)]
+    assert sorted(decantalo['wine_type'].astype(str).unique()) == ['red', 'white']
+
+    # Re-scraping a retailer on the same day replaces its partition only
+    write_listings(rows(4), 'decantalo', SNAPSHOT, root=tmp_path)
+    assert read_listings(root=tmp_path)['retailer'].astype(str).value_counts().to_dict() == {
+        'decantalo': 4,
+        'laithwaites': 2,
+    }
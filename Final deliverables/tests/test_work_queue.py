@@ -0,0 +1,91 @@
+import work_queue
+from fetcher import Result
+from work_queue import MAX_LEASES, WorkQueue, work
+
+LISTINGS = [('red', 'https://example.com/a'), ('red', 'https://example.com/b')]
+
+
+def result(wine_type, url):
+    return Result(wine_type, url, 200, {'url': url, 'wine_type': wine_type}, None)
+
+
+def test_enqueue_once(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.sqlite')
+    assert queue.enqueue('run', 'decantalo', LISTINGS) == 2
+    assert queue.enqueue('run', 'decantalo', LISTINGS) == 0
+    assert queue.unfinished('run', 'decantalo') == 2
+    assert queue.unfinished('run', 'laithwaites') == 0
+
+
+def test_enqueue_listings_without_wine_type_once(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.sqlite')
+    listings = [(None, url) for _, url in LISTINGS]
+    assert queue.enqueue('run', 'virginwines', listings) == 2
+    assert queue.enqueue('run', 'virginwines', listings) == 0
+    assert queue.listings('run', 'virginwines') == listings
+
+
+def test_pages_fanned_out_to_listings(tmp_path, monkeypatch):
+    # Decantalo lists a product once per vintage and size, Morrisons under several categories
+    page = 'https://example.com/enate-234.html'
+    listings = [
+        ('red', page),
+        ('red', page + '#/19-volume-magnum/201-year-2021'),
+        ('rose', page),
+        ('red', 'https://example.com/b'),
+    ]
+    queue = WorkQueue(tmp_path / 'queue.sqlite')
+    assert queue.enqueue('run', 'decantalo', listings) == 2
+
+    def parse(wine_type, url, content):
+        return {'url': url, 'wine_type': wine_type, 'size (cL)': 75.0, 'year': '2020'}
+
+    # Pages are parsed without being fetched
+    def scrape(listings, parse, cache=None):
+        for wine_type, url in listings:
+            yield Result(wine_type, url, 200, parse(wine_type, url, b''), None)
+
+    monkeypatch.setattr(work_queue, 'scrape', scrape)
+    assert work(queue, 'run', 'decantalo', parse, 'worker') == 2
+    assert list(queue.rows('run', 'decantalo')) == [
+        {'url': page, 'wine_type': 'red', 'size (cL)': 75.0, 'year': '2020'},
+        {'url': listings[1][1], 'wine_type': 'red', 'size (cL)': 150.0, 'year': '2021'},
+        {'url': page, 'wine_type': 'rose', 'size (cL)': 75.0, 'year': '2020'},
+        {'url': 'https://example.com/b', 'wine_type': 'red', 'size (cL)': 75.0, 'year': '2020'},
+    ]
+    # Every listing of a page observed when its page was done
+    fetched = list(queue.fetched_rows('run', 'decantalo'))
+    assert [row for _, row in fetched] == list(queue.rows('run', 'decantalo'))
+    assert fetched[0][0] == fetched[1][0] == fetched[2][0]
+
+
+def test_leased_listings_not_leased_again(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.sqlite')
+    queue.enqueue('run', 'decantalo', LISTINGS)
+    assert [task[2:] for task in queue.lease('run', 'decantalo', count=1)] == LISTINGS[:1]
+    assert [task[2:] for task in queue.lease('run', 'decantalo')] == LISTINGS[1:]
+    assert queue.lease('run', 'decantalo') == []
+
+
+def test_expired_lease_taken_over(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.sqlite')
+    queue.enqueue('run', 'decantalo', LISTINGS[:1])
+    [(task_id, stale, wine_type, url)] = queue.lease('run', 'decantalo', lease_seconds=0)
+    [(_, token, _, _)] = queue.lease('run', 'decantalo')
+    assert token != stale
+
+    # The result of the worker whose lease expired is dropped
+    assert queue.complete('crashed', [((task_id, stale), result(wine_type, url))]) == 0
+    assert queue.complete('worker', [((task_id, token), result(wine_type, url))]) == 1
+    assert queue.complete('worker', [((task_id, token), result(wine_type, url))]) == 0
+    assert list(queue.rows('run', 'decantalo')) == [{'url': url, 'wine_type': wine_type}]
+    assert queue.unfinished('run', 'decantalo') == 0
+
+
+def test_listing_dead_after_max_leases(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.sqlite')
+    queue.enqueue('run', 'decantalo', LISTINGS[:1])
+    for _ in range(MAX_LEASES):
+        assert len(queue.lease('run', 'decantalo', lease_seconds=0)) == 1
+    assert queue.lease('run', 'decantalo') == []
+    assert queue.summary('run') == {'decantalo': {'dead': 1}}